@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Compare listing files matching a tag expression with the in-memory tag
+index and with a query joining FileTag for each tag.
+
+A temporary gallery database is filled with files, each given a few random
+tags, without any actual files to scan.
+
+    $ python benchmarks/tag_query.py --files 50000 --tags 300
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+PAGE_SIZE = 500
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=50000)
+    parser.add_argument("--tags", type=int, default=300)
+    parser.add_argument("--tags-per-file", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        os.environ["VGLOSS_BASE"] = root
+        os.environ["DJANGO_SETTINGS_MODULE"] = "vgloss.settings"
+        import django
+        from django.conf import settings
+        from django.core.management import call_command
+        django.setup()
+        from django.db.models import Exists, OuterRef, Q
+        from vgloss import models, tag_index
+
+        os.makedirs(settings.DATA_DIR)
+        call_command("migrate", verbosity=0, interactive=False)
+        random.seed(0)
+        tags = [models.Tag.objects.create(name=f"tag{i}") for i in range(args.tags)]
+        files = models.File.objects.bulk_create(
+            models.File(hash=f"{i:0128x}", name=f"file{i}.jpg", mimetype="image/jpeg")
+            for i in range(args.files)
+        )
+        models.FileTag.objects.bulk_create(
+            models.FileTag(file=file, tag=tag)
+            for file in files
+            for tag in random.sample(tags, args.tags_per_file)
+        )
+        a, b, c = (tag.id for tag in tags[:3])
+
+        def tagged(tag):
+            return Q(Exists(models.FileTag.objects.filter(file=OuterRef("pk"), tag=tag)))
+
+        # A page of the file list, like FileListApi
+        def first_page(qs):
+            return list(qs.order_by("name", "hash").values_list("hash", flat=True)[:PAGE_SIZE])
+
+        def with_joins(condition):
+            return first_page(models.File.objects.filter(condition))
+
+        def with_index(expression):
+            hashes, negated = tag_index.index.match(expression)
+            if negated:
+                return first_page(models.File.objects.exclude(hash__in=hashes))
+            return first_page(models.File.objects.filter(hash__in=hashes))
+
+        start = time.perf_counter()
+        tag_index.index.refresh()
+        print(f"{args.files} files, a page of {PAGE_SIZE}")
+        print(f"{'build':>10}: {(time.perf_counter() - start)*1000:7.1f}ms")
+        for expression, condition in [
+            (f"{a}&{b}", tagged(a) & tagged(b)),
+            (f"{a}|{b}", tagged(a) | tagged(b)),
+            (f"{a}&{b}|!{c}", (tagged(a) & tagged(b)) | ~tagged(c)),
+        ]:
+            assert with_joins(condition) == with_index(expression)
+            print(expression)
+            for name, run in (
+                ("joins", lambda: with_joins(condition)),
+                ("index", lambda: with_index(expression)),
+                ("evaluate", lambda: tag_index.index.match(expression)),
+            ):
+                times = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    run()
+                    times.append(time.perf_counter() - start)
+                print(f"{name:>10}: {min(times)*1000:7.1f}ms")
+
+if __name__ == "__main__":
+    main()
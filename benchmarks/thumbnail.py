@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Compare the per-image latency of the thumbnail backends on synthetic
+camera-sized JPEGs.
+
+Each JPEG has a 1/4 scale preview appended, like camera files embed, to also
+compare making thumbnails from the preview. Backends which aren't installed
+are skipped.
+
+    $ python benchmarks/thumbnail.py --count 20 --width 6000 --height 4000
+    $ python benchmarks/thumbnail.py --sizes 250 500 1280 --formats jpeg webp
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from vgloss import thumbnail_backends, preview  # noqa: E402
+
+
+def make_images(root, count, width, height):
+    """Return `(path, metadata)` for each image, where `metadata` is what
+    exiftool would report for the embedded preview."""
+    images = []
+    for i in range(count):
+        # Noise so the JPEGs are about as hard to decode as photos
+        bands = [Image.effect_noise((width, height), 40+i) for _ in range(3)]
+        image = Image.merge("RGB", bands)
+        path = os.path.join(root, f"image{i}.jpg")
+        image.save(path, quality=90)
+
+        # Decoders ignore data after the end of the JPEG
+        start = os.path.getsize(path)
+        with open(path, "ab") as f:
+            image.resize((width//4, height//4)).save(f, "JPEG", quality=90)
+        images.append((path, {
+            "ImageWidth": width,
+            "ImageHeight": height,
+            "PreviewImageStart": start,
+            "PreviewImageLength": os.path.getsize(path) - start,
+        }))
+    return images
+
+def from_preview(abspath, out_paths, metadata):
+    if preview.thumbnails_from_preview(abspath, metadata, out_paths) is None:
+        raise ValueError("Preview not used")
+
+def get_out_paths(out_dir, prefix, sizes, formats):
+    return {
+        (size, format): os.path.join(out_dir, f"{prefix}_{size}.{format}")
+        for size in sizes
+        for format in formats
+    }
+
+def bench(name, generate, images, out_dir, sizes, formats):
+    # Warm up, so one-time setup like loading libraries isn't counted
+    try:
+        generate(*images[0], get_out_paths(out_dir, "warmup", sizes, formats))
+    except Exception as e:
+        print(f"{name:>14}: unavailable ({e})")
+        return
+
+    latencies = []
+    for i, (path, metadata) in enumerate(images):
+        out_paths = get_out_paths(out_dir, f"{name}{i}", sizes, formats)
+        start = time.perf_counter()
+        generate(path, metadata, out_paths)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    p95 = latencies[min(len(latencies)-1, int(len(latencies) * 0.95))]
+    print(f"{name:>14}: mean {statistics.mean(latencies)*1000:7.1f}ms  "
+          f"median {statistics.median(latencies)*1000:7.1f}ms  "
+          f"p95 {p95*1000:7.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[250])
+    parser.add_argument("--formats", nargs="+", default=["jpeg"],
+                        choices=list(thumbnail_backends.FORMATS))
+    parser.add_argument("--backends", nargs="+",
+                        default=list(thumbnail_backends.BACKENDS),
+                        choices=list(thumbnail_backends.BACKENDS))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        out_dir = os.path.join(root, "out")
+        os.mkdir(out_dir)
+        images = make_images(root, args.count, args.width, args.height)
+        for name in args.backends:
+            backend = thumbnail_backends.BACKENDS[name]
+            bench(name, lambda path, metadata, out_paths: backend(path, out_paths),
+                  images, out_dir, args.sizes, args.formats)
+        bench("preview", lambda path, metadata, out_paths:
+              from_preview(path, out_paths, metadata),
+              images, out_dir, args.sizes, args.formats)
+
+if __name__ == "__main__":
+    main()
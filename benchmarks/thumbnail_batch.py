@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Compare loading a page of the gallery grid with one request per thumbnail
+and with batched requests.
+
+A temporary gallery of small JPEGs is scanned and its thumbnails generated,
+then served over HTTP from a thread. Each run times how long it takes for
+every thumbnail on the page to arrive, like the grid's first full render.
+Needs exiftool, like vgloss itself.
+
+    $ python benchmarks/thumbnail_batch.py --count 300
+"""
+import os
+import sys
+import time
+import struct
+import argparse
+import tempfile
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# What a browser allows at once
+CONNECTIONS = 6
+BATCH_SIZE = 50
+BATCHES_IN_FLIGHT = 2
+
+
+def make_gallery(root, count):
+    for i in range(count):
+        image = Image.effect_noise((800, 600), 40 + i % 20).convert("RGB")
+        image.save(os.path.join(root, f"image{i}.jpg"), quality=90)
+
+def serve():
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadedWSGIServer(("127.0.0.1", 0), QuietHandler)
+    server.set_app(WSGIHandler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def request(port, url):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    try:
+        conn.request("GET", url, headers={"Accept": "image/webp,image/*"})
+        response = conn.getresponse()
+        content = response.read()
+        assert response.status == 200, (url, response.status)
+        return content
+    finally:
+        conn.close()
+
+def load_individual(port, hashes, size):
+    def get(hash):
+        return request(port, f"/file/{hash}/thumbnail?size={size}")
+    with ThreadPoolExecutor(CONNECTIONS) as executor:
+        return sum(len(content) for content in executor.map(get, hashes))
+
+def load_batched(port, hashes, size):
+    def get(batch):
+        content = request(port, f"/file/thumbnails?hashes={','.join(batch)}"
+                                f"&size={size}")
+        index_length = struct.unpack(">I", content[:4])[0]
+        return len(content) - 4 - index_length
+    batches = [hashes[i:i+BATCH_SIZE] for i in range(0, len(hashes), BATCH_SIZE)]
+    with ThreadPoolExecutor(BATCHES_IN_FLIGHT) as executor:
+        return sum(executor.map(get, batches))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=300,
+                        help="Images on the page")
+    parser.add_argument("--size", type=int, default=250)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        os.environ["VGLOSS_BASE"] = root
+        os.environ["DJANGO_SETTINGS_MODULE"] = "vgloss.settings"
+        import django
+        from django.conf import settings
+        from django.core.management import call_command
+        django.setup()
+        from vgloss import models
+        from vgloss.scan import scan_all
+        from vgloss.thumbnail import generate_all_thumbnails
+
+        make_gallery(root, args.count)
+        os.makedirs(settings.DATA_DIR)
+        call_command("migrate", verbosity=0, interactive=False)
+        scan_all()
+        generate_all_thumbnails()
+        hashes = list(models.File.objects.values_list("hash", flat=True))
+
+        server = serve()
+        port = server.server_address[1]
+        try:
+            for name, load in (("individual", load_individual),
+                               ("batched", load_batched)):
+                times = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    total = load(port, hashes, args.size)
+                    times.append(time.perf_counter() - start)
+                print(f"{name:>10}: {min(times)*1000:7.1f}ms for {len(hashes)} "
+                      f"thumbnails ({total / 1024:.0f}KiB)")
+        finally:
+            server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Compare reading thumbnails from loose files and from pack files.
+
+Thumbnails are random bytes of a typical size. Each store is filled, then
+every thumbnail is read back in random order.
+
+    $ python benchmarks/thumbnail_store.py --count 100000 --size 15000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from vgloss import thumbnail_store  # noqa: E402
+
+
+def bench(name, store, root, keys, size):
+    data = os.urandom(size)
+    start = time.perf_counter()
+    for key in keys:
+        path = os.path.join(root, "staged")
+        with open(path, "wb") as f:
+            f.write(data)
+        store.put(key, path)
+    write_seconds = time.perf_counter() - start
+
+    keys = random.sample(keys, len(keys))
+    start = time.perf_counter()
+    for key in keys:
+        bytes(store.get(key))
+    read_seconds = time.perf_counter() - start
+
+    print(f"{name:>6}: write {len(keys) / write_seconds:9.0f}/s  "
+          f"read {len(keys) / read_seconds:9.0f}/s "
+          f"({read_seconds / len(keys) * 1e6:.1f}us each)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=15000,
+                        help="Bytes per thumbnail")
+    args = parser.parse_args()
+
+    keys = [f"{random.getrandbits(512):0128x}_250.jpg" for _ in range(args.count)]
+    for name, store_class in thumbnail_store.STORES.items():
+        with tempfile.TemporaryDirectory() as root:
+            bench(name, store_class(root), root, keys, args.size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Compare the scanner's directory walker with the os.walk() based one it
+replaced, on a synthetic directory tree.
+
+Network mounts are simulated with `--latency`, which adds a delay to every
+directory listing. (File stats aren't delayed, since DirEntry.stat() can't be
+patched.)
+
+    $ python benchmarks/walk.py --latency 2
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import functools
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from vgloss import walk  # noqa: E402
+
+
+def make_tree(root, depth, dirs_per_dir, files_per_dir):
+    for i in range(files_per_dir):
+        open(os.path.join(root, f"file{i}.jpg"), "w").close()
+    if depth > 0:
+        for i in range(dirs_per_dir):
+            subdir = os.path.join(root, f"dir{i}")
+            os.mkdir(subdir)
+            make_tree(subdir, depth-1, dirs_per_dir, files_per_dir)
+
+def old_walk(root, exclude):
+    """The walker previously used by vgloss.scan."""
+    for cwd, dirs, paths in os.walk(root):
+        if cwd.startswith(exclude):
+            continue
+        for path in paths:
+            abspath = os.path.join(cwd, path)
+            try:
+                stat = os.stat(abspath)
+            except FileNotFoundError:
+                continue
+            yield os.path.relpath(abspath, root), abspath, stat
+
+def new_walk(root, exclude, jobs):
+    return walk.walk(root, [exclude], jobs)
+
+def add_latency(latency):
+    """Patch os.scandir, used by both walkers, to sleep before returning."""
+    scandir = os.scandir
+    @functools.wraps(scandir)
+    def delayed_scandir(*args, **kwargs):
+        time.sleep(latency)
+        return scandir(*args, **kwargs)
+    os.scandir = delayed_scandir
+
+def bench(name, func):
+    start = time.perf_counter()
+    count = sum(1 for _ in func())
+    elapsed = time.perf_counter() - start
+    print(f"{name:>20}: {elapsed:8.3f}s  {count} files  "
+          f"{count/elapsed:10.0f} files/s")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--dirs", type=int, default=8,
+                        help="Subdirectories per directory")
+    parser.add_argument("--files", type=int, default=50,
+                        help="Files per directory")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Milliseconds added to each directory listing")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, args.depth, args.dirs, args.files)
+        exclude = os.path.join(root, ".vgloss")
+        os.mkdir(exclude)
+        if args.latency:
+            add_latency(args.latency / 1000)
+
+        bench("os.walk", lambda: old_walk(root, exclude))
+        for jobs in args.jobs:
+            bench(f"walk (jobs={jobs})", lambda: new_walk(root, exclude, jobs))
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,38 @@
 import { apiFileList } from "./urls.js";
 import { apiRequest } from "./utils.js";
 
+// Files requested at a time
+const FILE_PAGE_SIZE = 500;
+
+/* Query the first page of a file list. Resolves to `{files, next}`, where
+ * `next` is the URL of the next page for queryFileListPage(), or null if
+ * there are no more. */
 export async function queryFileList(params) {
-  let response = await apiRequest("GET", apiFileList(params));
-  return response.json();
+  return queryFileListPage(
+    apiFileList({...params, limit: FILE_PAGE_SIZE, columns: 1})
+  );
+}
+
+/* Turn a page of files listed as columns into an object per file. */
+function filesFromColumns(columns) {
+  let fields = Object.keys(columns);
+  let files = [];
+  for(let i=0; i < columns.hash.length; i++) {
+    let file = {};
+    for(let field of fields) {
+      file[field] = columns[field][i];
+    }
+    files.push(file);
+  }
+  return files;
+}
+
+export async function queryFileListPage(url) {
+  let response = await apiRequest("GET", url);
+  let link = response.headers.get("Link");
+  let next = link ? link.match(/<([^>]*)>;\s*rel="next"/) : null;
+  return {
+    files: filesFromColumns(await response.json()),
+    next: next ? next[1] : null,
+  };
 }
@@ -0,0 +1,123 @@
+import * as urls from "./urls.js";
+import { apiRequest } from "./utils.js";
+
+/* Loading thumbnails for the gallery grid.
+ *
+ * In "batch" mode (the default) thumbnails are requested a page at a time
+ * from the bundle endpoint, and each one is given an object URL. Bundles are
+ * cached by the browser like thumbnails are, so showing a page again only
+ * checks they haven't changed. In
+ * "individual" mode each thumbnail is its own request, which can be chosen
+ * with:
+ *
+ *     localStorage.setItem("vgloss.thumbnailLoading", "individual")
+ */
+
+// Hashes per bundle request, as many as fit in a URL on the server
+const BATCH_SIZE = 50;
+
+// Bundle requests in flight at once
+const MAX_IN_FLIGHT = 2;
+
+export function thumbnailLoadingMode() {
+  try {
+    return localStorage.getItem("vgloss.thumbnailLoading") || "batch";
+  } catch(e) {
+    return "batch";
+  }
+}
+
+let _supportsWebp = null;
+function supportsWebp() {
+  if(_supportsWebp === null) {
+    let canvas = document.createElement("canvas");
+    canvas.width = canvas.height = 1;
+    _supportsWebp = canvas.toDataURL("image/webp").startsWith("data:image/webp");
+  }
+  return _supportsWebp;
+}
+
+/* Parse a bundle response body into `{hash: Blob}`. Hashes without a
+ * thumbnail are left out. */
+export function parseBundle(buffer) {
+  let indexLength = new DataView(buffer).getUint32(0);
+  let index = JSON.parse(
+    new TextDecoder().decode(new Uint8Array(buffer, 4, indexLength))
+  );
+  let dataStart = 4 + indexLength;
+  let blobs = {};
+  for(let entry of index) {
+    if(entry.error) continue;
+    let start = dataStart + entry.offset;
+    blobs[entry.hash] = new Blob(
+      [buffer.slice(start, start + entry.length)],
+      {type: entry.type}
+    );
+  }
+  return blobs;
+}
+
+async function fetchBundle(hashes, size) {
+  let response = await apiRequest("GET", urls.fileThumbnails(
+    hashes,
+    size,
+    // What an <img> would send, which fetch() doesn't
+    supportsWebp() ? "image/webp,image/*" : "image/*",
+  ));
+  return parseBundle(await response.arrayBuffer());
+}
+
+/* Loads thumbnails for lists of files, calling `onLoad(hash, url)` as each
+ * one is ready. `clear()` stops loading, and revokes the object URLs. */
+export class ThumbnailLoader {
+  constructor(onLoad) {
+    this.onLoad = onLoad;
+    this._objectUrls = [];
+    this._generation = 0;
+  }
+
+  async load(hashes, size) {
+    let generation = this._generation;
+    let batches = [];
+    for(let i=0; i < hashes.length; i += BATCH_SIZE) {
+      batches.push(hashes.slice(i, i + BATCH_SIZE));
+    }
+
+    let next = async () => {
+      while(batches.length && generation === this._generation) {
+        let batch = batches.shift();
+        let blobs;
+        try {
+          blobs = await fetchBundle(batch, size);
+        } catch(e) {
+          blobs = {};
+        }
+        if(generation !== this._generation) return;
+        for(let hash of batch) {
+          // Anything missing falls back to its own request
+          let url;
+          if(blobs[hash]) {
+            url = URL.createObjectURL(blobs[hash]);
+            this._objectUrls.push(url);
+          } else {
+            url = urls.fileThumbnail(hash, size);
+          }
+          this.onLoad(hash, url);
+        }
+      }
+    };
+    let workers = [];
+    for(let i=0; i < MAX_IN_FLIGHT; i++) {
+      workers.push(next());
+    }
+    await Promise.all(workers);
+  }
+
+  clear() {
+    this._generation += 1;
+    for(let url of this._objectUrls) {
+      URL.revokeObjectURL(url);
+    }
+    this._objectUrls = [];
+  }
+}
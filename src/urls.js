@@ -60,10 +60,24 @@ export function fileRaw(fileHash) {
   return "/file/"+fileHash+"/raw";
 }
 
-export function fileThumbnail(fileHash) {
-  return "/file/"+fileHash+"/thumbnail";
+/* Thumbnail URL for a file. If `size` is given, the server picks the
+ * smallest thumbnail at least that many pixels wide and tall. */
+export function fileThumbnail(fileHash, size=null) {
+  var url = "/file/"+fileHash+"/thumbnail";
+  if(size !== null) {
+    url += "?size=" + Math.round(size);
+  }
+  return url;
 }
 
 export const fileTags = "/api/filetag/";
 
 export const action = "/api/action";
+
+/* Bundle of the thumbnails of a list of hashes, in one response. `size` is
+ * like `fileThumbnail()`, and `accept` is what an <img> would send as its
+ * Accept header. */
+export function fileThumbnails(fileHashes, size, accept) {
+  return "/file/thumbnails?hashes=" + fileHashes.join(",") +
+    "&size=" + Math.round(size) + "&accept=" + encodeURIComponent(accept);
+}
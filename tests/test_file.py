@@ -1,9 +1,15 @@
+import os
 import unittest
+from unittest import mock
 
+from asgiref.sync import async_to_sync
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections
 from django.test import TestCase, Client
 from django.urls import reverse
 
 from vgloss import models, scan
+from vgloss.asgi import application
 from tests import testdata
 
 class TestScan(TestCase):
@@ -66,6 +72,149 @@ class TestScan(TestCase):
             {"white_square.jpg"}
         )
 
+    def test_file_list_filtered_subtree(self):
+        # Files tagged with a tag under the one filtered by are listed too
+        colors = models.Tag.objects.create(name="colors")
+        self.tag_white.parent = colors
+        self.tag_white.save()
+        models.update_tag_ancestors()
+        models.Tag.objects.create(name="black", parent=colors)
+
+        response = self.client.get(self.url+"?tag="+str(colors.id))
+        self.assertSetEqual(
+            set(f["name"] for f in response.data),
+            {"white_square.jpg"}
+        )
+        response = self.client.get(f"{self.url}?tag={colors.id},{self.tag_black.id}")
+        self.assertSetEqual(
+            set(f["name"] for f in response.data),
+            {"white_square.jpg", "black_square1.jpg"}
+        )
+
+    def test_file_list_tag_expression(self):
+        red = models.Tag.objects.create(name="red")
+        for name, tags in [("black_square1.jpg", [red]),
+                           ("not_image.txt", [self.tag_white, red])]:
+            for tag in tags:
+                models.FileTag.objects.create(
+                    tag=tag, file=models.File.objects.get(name=name)
+                )
+        white, black, red = self.tag_white.id, self.tag_black.id, red.id
+
+        def listed(expression):
+            response = self.client.get(self.url, {"tag": expression})
+            self.assertEqual(response.status_code, 200)
+            return {f["name"] for f in response.data}
+
+        for expression, expected in [
+            (f"{white}&{red}", {"not_image.txt"}),
+            (f"{white}|{black}", {"white_square.jpg", "black_square1.jpg",
+                                  "not_image.txt"}),
+            (f"!{red}", {"white_square.jpg"}),
+            (f"{red}&!{white}", {"black_square1.jpg"}),
+            (f"!{white}&!{black}", set()),
+            (f"!({white}&{red})", {"white_square.jpg", "black_square1.jpg"}),
+            (f"{red}|!{white}", {"black_square1.jpg", "not_image.txt"}),
+            (f"{black}|{white}&{red}", {"black_square1.jpg", "not_image.txt"}),
+        ]:
+            self.assertEqual(listed(expression), expected, expression)
+            # Checking matches as files are read gives the same
+            with mock.patch("vgloss.api.MAX_TAG_MATCH_PARAMS", 0), \
+                    mock.patch("vgloss.api.TAG_MATCH_SCAN_SIZE", 1):
+                self.assertEqual(listed(expression), expected, expression)
+
+        for expression in ["1&", "(1", "1)", "a"]:
+            response = self.client.get(self.url, {"tag": expression})
+            self.assertEqual(response.status_code, 400, expression)
+
+    def test_folder_list(self):
+        response = self.client.get(reverse("api-folders"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [
+            {"path": "", "parent": None, "file_count": 4},
+            {"path": "dir1", "parent": "", "file_count": 1},
+        ])
+        response = self.client.get(reverse("api-folders"), {"parent": "dir1"})
+        self.assertEqual(response.data, [])
+
+    def get_pages(self, params):
+        """Return the files of each page listed, following Link headers."""
+        pages = []
+        url = self.url + "?" + params
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.data)
+            link = response.get("Link")
+            url = link[1:link.index(">")] if link else None
+        return pages
+
+    def test_file_list_pages(self):
+        # Timestamps that tie, and no timestamp, sort by hash
+        models.File.objects.filter(name="white_square.jpg").update(timestamp=None)
+        models.File.objects.exclude(name="white_square.jpg").update(
+            timestamp="2020-01-01T12:00:00Z"
+        )
+        files = {file.hash: file for file in models.File.objects.all()}
+        by_name = sorted(files, key=lambda h: (files[h].name, h))
+        by_timestamp = sorted(files, key=lambda h: (files[h].timestamp is not None,
+                                                    files[h].timestamp, h))
+        by_path = [path.file_id for path in models.FilePath.objects.order_by("path")]
+        for sort, expected in [
+            ("name", by_name),
+            ("-name", by_name[::-1]),
+            ("timestamp", by_timestamp),
+            ("-timestamp", by_timestamp[::-1]),
+            ("path", by_path),
+            ("-path", by_path[::-1]),
+        ]:
+            pages = self.get_pages(f"sort={sort}&limit=2")
+            self.assertEqual([len(page) for page in pages[:-1]], [2] * (len(pages)-1))
+            listed = [f["hash"] for page in pages for f in page]
+            self.assertEqual(listed, expected, sort)
+
+        # In a folder, with a tag
+        pages = self.get_pages(f"folder=&tag={self.tag_black.id}&sort=path&limit=1")
+        self.assertEqual([[f["name"] for f in page] for page in pages],
+                         [["black_square1.jpg"], ["black_square1.jpg"]])
+
+        response = self.client.get(self.url + "?sort=size")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(self.url + "?cursor=nonsense")
+        self.assertEqual(response.status_code, 400)
+
+    def test_file_list_queries(self):
+        files = models.File.objects.bulk_create(
+            models.File(hash=f"{i:0128x}", name=f"file{i}.jpg", mimetype="image/jpeg")
+            for i in range(50)
+        )
+        models.FileTag.objects.bulk_create(
+            models.FileTag(file=file, tag=tag)
+            for file in files for tag in (self.tag_white, self.tag_black)
+        )
+
+        # One query for the files and one for all of their tags
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.data), 53)
+        listed = {f["hash"]: f for f in response.data}
+        self.assertEqual(listed[files[0].hash], {
+            "hash": files[0].hash,
+            "name": "file0.jpg",
+            "is_image": True,
+            "timestamp": None,
+            "tags": [self.tag_white.id, self.tag_black.id],
+        })
+
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url + "?columns=1")
+        columns = response.data
+        self.assertEqual(list(columns), ["hash", "name", "is_image", "timestamp", "tags"])
+        self.assertEqual(
+            [dict(zip(columns, row)) for row in zip(*columns.values())],
+            list(listed.values()),
+        )
+
     @unittest.skip("Test not implemented")
     def test_file_list_filter_dir_and_tag(self):
         # List files by both tag and folder
@@ -74,3 +223,139 @@ class TestScan(TestCase):
     @unittest.skip("Test not implemented")
     def test_file_detail(self):
         raise NotImplementedError
+
+class TestFileRaw(TestCase):
+
+    def setUp(self):
+        testdata.basic_data()
+        with open(testdata.make_path("big.bin"), "wb") as f:
+            f.write(bytes(range(256)) * 1000)
+        scan.scan_all()
+        self.client = Client()
+
+    def tearDown(self):
+        testdata.clean()
+
+    def get(self, path, **kwargs):
+        file = models.FilePath.objects.get(path=path).file
+        return self.client.get(reverse("file-raw", args=[file.hash]), **kwargs)
+
+    def test_raw(self):
+        response = self.get("big.bin")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Length"], "256000")
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(b"".join(response.streaming_content), bytes(range(256)) * 1000)
+
+        response = self.get("white_square.jpg")
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+
+    def test_range(self):
+        response = self.get("big.bin", HTTP_RANGE="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 10-19/256000")
+        self.assertEqual(response["Content-Length"], "10")
+        self.assertEqual(b"".join(response.streaming_content), bytes(range(10, 20)))
+
+        response = self.get("big.bin", HTTP_RANGE="bytes=-3")
+        self.assertEqual(b"".join(response.streaming_content), bytes([253, 254, 255]))
+        response = self.get("big.bin", HTTP_RANGE="bytes=255990-")
+        self.assertEqual(response["Content-Range"], "bytes 255990-255999/256000")
+
+        response = self.get("big.bin", HTTP_RANGE="bytes=256000-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */256000")
+
+        # Multiple ranges aren't supported, so the whole file is sent
+        response = self.get("big.bin", HTTP_RANGE="bytes=0-1,5-6")
+        self.assertEqual(response.status_code, 200)
+
+    def test_sendfile(self):
+        with self.settings(SENDFILE="x-sendfile"):
+            response = self.get("dir1/black_square3.jpg")
+        self.assertEqual(response["X-Sendfile"], testdata.make_path("black_square1.jpg"))
+        self.assertEqual(response.content, b"")
+
+        with self.settings(SENDFILE="x-accel-redirect", SENDFILE_URL_PREFIX="/base/"):
+            response = self.get("dir1/black_square3.jpg")
+        self.assertEqual(response["X-Accel-Redirect"], "/base/black_square1.jpg")
+
+    def test_caching(self):
+        file = models.FilePath.objects.get(path="big.bin").file
+        response = self.get("big.bin")
+        response.close()
+        self.assertEqual(response["ETag"], f'"{file.hash}"')
+        self.assertIn("immutable", response["Cache-Control"])
+
+        # Not even looked up, so it works after the file is gone
+        os.remove(testdata.make_path("big.bin"))
+        response = self.get("big.bin", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], f'"{file.hash}"')
+        self.assertIn("immutable", response["Cache-Control"])
+
+    def test_missing(self):
+        # Another path with the same content is served instead
+        os.remove(testdata.make_path("black_square1.jpg"))
+        response = self.get("black_square2.jpg")
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+        os.remove(testdata.make_path("white_square.jpg"))
+        response = self.get("white_square.jpg")
+        self.assertEqual(response.status_code, 404)
+
+    def asgi_get(self, path, send, headers=()):
+        async def receive():
+            return {"type": "http.request", "body": b""}
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": reverse("file-raw", args=[
+                models.FilePath.objects.get(path=path).file.hash
+            ]),
+            "query_string": b"",
+            "headers": [(b"host", b"testserver"), *headers],
+        }
+        # Like the test client, so the test's transaction isn't closed
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        try:
+            async_to_sync(application)(scope, receive, send)
+        finally:
+            request_started.connect(close_old_connections)
+            request_finished.connect(close_old_connections)
+
+    def test_asgi(self):
+        messages = []
+        async def send(message):
+            messages.append(message)
+        self.asgi_get("big.bin", send, [(b"range", b"bytes=1000-")])
+
+        start, *body, end = messages
+        self.assertEqual(start["status"], 206)
+        self.assertIn((b"Content-Range", b"bytes 1000-255999/256000"), start["headers"])
+        # Read in more than one chunk
+        self.assertGreater(len(body), 1)
+        self.assertEqual(b"".join(message["body"] for message in body),
+                         (bytes(range(256)) * 1000)[1000:])
+        self.assertEqual(end, {"type": "http.response.body"})
+
+    def test_asgi_disconnect(self):
+        messages = []
+        async def send(message):
+            if message["type"] == "http.response.body":
+                raise OSError("Client disconnected")
+            messages.append(message)
+        finished = mock.Mock()
+        request_finished.connect(finished)
+        try:
+            with self.assertRaises(OSError):
+                self.asgi_get("big.bin", send)
+        finally:
+            request_finished.disconnect(finished)
+
+        # The response was closed, so the file was too
+        self.assertEqual(len(messages), 1)
+        finished.assert_called_once()
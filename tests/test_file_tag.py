@@ -1,7 +1,9 @@
-from django.test import TestCase, Client
+from unittest import mock
+
+from django.test import TestCase, TransactionTestCase, Client
 from django.urls import reverse
 
-from vgloss import models
+from vgloss import models, tag_index
 
 class TestFileTag(TestCase):
 
@@ -53,3 +55,45 @@ class TestFileTag(TestCase):
         }], content_type="application/json")
         self.assertEqual(response.status_code, 204)
         self.assertEqual(models.FileTag.objects.count(), 2)
+
+
+class TestTagIndex(TransactionTestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.tag1 = models.Tag.objects.create(name="tag1")
+        self.tag2 = models.Tag.objects.create(name="tag2")
+        for hash in ["hash1", "hash2"]:
+            models.File.objects.create(hash=hash, name=hash, mimetype="image/png")
+        models.FileTag.objects.create(file_id="hash1", tag_id=self.tag1.id)
+        tag_index.index.clear()
+
+    def tearDown(self):
+        tag_index.index.clear()
+
+    def update(self, add=(), remove=()):
+        response = self.client.post(reverse("api-action"), [{
+            "type": "FileTagUpdate",
+            "data": {
+                "fileTagsToAdd": [{"file": f, "tag": t} for f, t in add],
+                "fileTagsToRemove": [{"file": f, "tag": t} for f, t in remove],
+            },
+        }], content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+    def test_incremental(self):
+        tag1, tag2 = self.tag1.id, self.tag2.id
+        self.assertEqual(tag_index.index.match(f"{tag1}"), ({"hash1"}, False))
+
+        # Changes are applied without building the index again
+        with mock.patch.object(tag_index.index, "_build") as build:
+            self.update(add=[("hash2", tag2), ("hash2", tag1)])
+            self.assertEqual(tag_index.index.match(f"{tag1}&{tag2}"),
+                             ({"hash2"}, False))
+            self.update(remove=[("hash1", tag1)])
+            self.assertEqual(tag_index.index.match(f"!{tag1}"), ({"hash2"}, True))
+        build.assert_not_called()
+
+        # Changes it isn't told about, like from another process, are noticed
+        models.FileTag.objects.filter(file_id="hash2", tag_id=tag2).delete()
+        self.assertEqual(tag_index.index.match(f"{tag2}"), (set(), False))
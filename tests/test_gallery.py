@@ -1,8 +1,29 @@
-from django.test import TestCase, Client
+import os
+import re
+import gzip
+import json
+import shutil
+import tempfile
+from unittest import mock
 
-from vgloss import models, scan
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, SimpleTestCase, Client, override_settings
+
+from vgloss import models, scan, assets
 from tests import testdata
 
+def get_metadata(response):
+    """Return the metadata embedded in the single page."""
+    content = response.content
+    if response.get("Content-Encoding") == "gzip":
+        content = gzip.decompress(content)
+    match = re.search(
+        r'<script id="gallery-metadata" type="application/json">(.*?)</script>',
+        content.decode(),
+    )
+    return json.loads(match.group(1))
+
 class TestGallery(TestCase):
 
     def setUp(self):
@@ -18,7 +39,7 @@ class TestGallery(TestCase):
         """Page should include initial metadata."""
         response = self.client.get("/")
         self.assertEqual(response.status_code, 200)
-        self.assertDictEqual(response.context["metadata"], {
+        self.assertDictEqual(get_metadata(response), {
             "folders": ["dir1"],
             "tags": [],
         })
@@ -27,9 +48,132 @@ class TestGallery(TestCase):
 
         response = self.client.get("/")
         self.assertEqual(response.status_code, 200)
-        self.assertDictEqual(response.context["metadata"], {
+        self.assertDictEqual(get_metadata(response), {
             "folders": ["dir1"],
             "tags": [
                 {"id": tag1.id, "name": "tag1", "parent": None},
             ],
         })
+
+        # Folders with no files in them are listed too
+        os.mkdir(testdata.make_path("empty"))
+        scan.scan_all()
+        response = self.client.get("/")
+        self.assertEqual(get_metadata(response)["folders"], ["dir1", "empty"])
+
+class TestDistFile(SimpleTestCase):
+
+    def setUp(self):
+        self.dist_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dist_dir)
+        for name, value in [("DIST_DIR", self.dist_dir),
+                            ("BUILD_CHECK_INTERVAL", 0)]:
+            patcher = mock.patch(f"vgloss.assets.{name}", value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.build()
+        self.client = Client()
+
+    def build(self, app_js="hashed();"):
+        """Replace the dist directory, like building the app does."""
+        shutil.rmtree(self.dist_dir)
+        os.makedirs(os.path.join(self.dist_dir, "js"))
+        self.write("js/app.1a2b3c4d.js", app_js)
+        self.write("js/plain.js", "plain();")
+        self.write("js/big.js", "big();\n" * 1000)
+
+    def write(self, path, content):
+        with open(os.path.join(self.dist_dir, path), "w") as f:
+            f.write(content)
+
+    def test_caching(self):
+        response = self.client.get("/js/app.1a2b3c4d.js")
+        self.assertEqual(response.content, b"hashed();")
+        self.assertIn("immutable", response["Cache-Control"])
+
+        response = self.client.get("/js/plain.js")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+        self.assertIn("Last-Modified", response)
+        response = self.client.get("/js/plain.js",
+                                   HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+        # A new build is loaded, with a new ETag
+        response = self.client.get("/js/app.1a2b3c4d.js")
+        self.build(app_js="rebuilt();")
+        response = self.client.get("/js/app.1a2b3c4d.js",
+                                   HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"rebuilt();")
+
+        response = self.client.get("/js/missing.js")
+        self.assertEqual(response.status_code, 404)
+
+    def test_loading_build(self):
+        response = self.client.get("/js/app.1a2b3c4d.js")
+        self.assertEqual(response.content, b"hashed();")
+
+        # Requests while the new build loads get the old one
+        self.build(app_js="rebuilt();")
+        with assets._loading_lock:
+            response = self.client.get("/js/app.1a2b3c4d.js")
+        self.assertEqual(response.content, b"hashed();")
+        response = self.client.get("/js/app.1a2b3c4d.js")
+        self.assertEqual(response.content, b"rebuilt();")
+
+    def test_compression(self):
+        response = self.client.get("/js/big.js")
+        self.assertNotIn("Content-Encoding", response)
+        self.assertEqual(response["Content-Length"], str(7000))
+        self.assertIn("Accept-Encoding", response["Vary"])
+        identity_etag = response["ETag"]
+
+        response = self.client.get("/js/big.js", HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Content-Length"], str(len(response.content)))
+        self.assertEqual(gzip.decompress(response.content), b"big();\n" * 1000)
+        self.assertNotEqual(response["ETag"], identity_etag)
+
+        if assets.brotli is not None:
+            response = self.client.get("/js/big.js",
+                                       HTTP_ACCEPT_ENCODING="gzip, deflate, br")
+            self.assertEqual(response["Content-Encoding"], "br")
+            self.assertEqual(assets.brotli.decompress(response.content),
+                             b"big();\n" * 1000)
+        response = self.client.get("/js/big.js",
+                                   HTTP_ACCEPT_ENCODING="gzip;q=0, br;q=0")
+        self.assertNotIn("Content-Encoding", response)
+
+        # Not worth compressing
+        response = self.client.get("/js/plain.js", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertNotIn("Content-Encoding", response)
+
+    def test_page_without_metadata(self):
+        template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, template_dir)
+        os.mkdir(os.path.join(template_dir, "vgloss"))
+        with open(os.path.join(template_dir, "vgloss", "vue-single-page.html"), "w") as f:
+            f.write("<html></html>")
+        templates = [dict(settings.TEMPLATES[0], DIRS=[template_dir])]
+        with override_settings(TEMPLATES=templates):
+            with self.assertRaises(ImproperlyConfigured):
+                assets.get_build()
+
+    def test_single_page(self):
+        template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, template_dir)
+        os.mkdir(os.path.join(template_dir, "vgloss"))
+        shutil.copy(os.path.join(settings.VGLOSS_CODE_DIR, "..", "public",
+                                 "vue-single-page.html"),
+                    os.path.join(template_dir, "vgloss", "vue-single-page.html"))
+        templates = [dict(settings.TEMPLATES[0], DIRS=[template_dir])]
+
+        metadata = {"folders": ["<script>"] * 100, "tags": []}
+        with override_settings(TEMPLATES=templates), \
+             mock.patch("vgloss.views.initial_pageload_data", return_value=metadata):
+            response = self.client.get("/some/page")
+            self.assertEqual(get_metadata(response), metadata)
+            self.assertEqual(response["Cache-Control"], "no-cache")
+            response = self.client.get("/", HTTP_ACCEPT_ENCODING="gzip")
+            self.assertEqual(response["Content-Encoding"], "gzip")
+            self.assertEqual(get_metadata(response), metadata)
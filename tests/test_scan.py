@@ -1,9 +1,14 @@
+import os
+import shutil
+import hashlib
 import unittest
 from unittest import mock
 
 from django.test import TestCase
 
-from vgloss import models, scan
+import magic
+
+from vgloss import models, scan, exiftool, stats
 from tests import testdata
 
 class TestScan(TestCase):
@@ -75,6 +80,317 @@ class TestScan(TestCase):
             {scan_version + 1}
         )
 
+    def test_rescan_changes(self):
+        old_hash = models.FilePath.objects.get(path="white_square.jpg").file_id
+
+        # Overwrite one file, delete another and create a new one
+        shutil.copy(testdata.make_path("black_square1.jpg"),
+                    testdata.make_path("white_square.jpg"))
+        stat = os.stat(testdata.make_path("white_square.jpg"))
+        os.utime(testdata.make_path("white_square.jpg"),
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        os.remove(testdata.make_path("black_square2.jpg"))
+        with open(testdata.make_path("dir1/new.txt"), "w") as f:
+            f.write("new")
+        scan.scan_all(jobs=4)
+
+        black_square1 = models.FilePath.objects.get(path="black_square1.jpg")
+        white_square = models.FilePath.objects.get(path="white_square.jpg")
+        self.assertEqual(white_square.file_id, black_square1.file_id)
+        self.assertFalse(models.File.objects.filter(hash=old_hash).exists())
+        self.assertFalse(models.FilePath.objects.filter(path="black_square2.jpg").exists())
+        self.assertTrue(models.FilePath.objects.filter(path="dir1/new.txt").exists())
+
+    def test_moved_files(self):
+        white_square = models.FilePath.objects.get(path="white_square.jpg")
+        os.mkdir(testdata.make_path("dir2"))
+        os.rename(testdata.make_path("white_square.jpg"),
+                  testdata.make_path("dir2/white_square_moved.jpg"))
+        os.rename(testdata.make_path("dir1"), testdata.make_path("dir3"))
+
+        with mock.patch("vgloss.scan._ingest_file") as hash_mock:
+            scan.scan_all()
+        hash_mock.assert_not_called()
+
+        self.assertFalse(models.FilePath.objects.filter(path="white_square.jpg").exists())
+        self.assertFalse(models.FilePath.objects.filter(path="dir1/black_square3.jpg").exists())
+        moved = models.FilePath.objects.get(path="dir2/white_square_moved.jpg")
+        self.assertEqual(moved.folder, "dir2")
+        self.assertEqual(moved.filename, "white_square_moved.jpg")
+        self.assertEqual(moved.file_id, white_square.file_id)
+        self.assertEqual(moved.st_ino, white_square.st_ino)
+        self.assertEqual(
+            models.FilePath.objects.get(path="dir3/black_square3.jpg").file_id,
+            models.FilePath.objects.get(path="black_square1.jpg").file_id,
+        )
+
+    def test_scan_paths(self):
+        white_square = models.FilePath.objects.get(path="white_square.jpg")
+        os.mkdir(testdata.make_path("dir2"))
+        os.rename(testdata.make_path("white_square.jpg"),
+                  testdata.make_path("dir2/white_square.jpg"))
+        os.remove(testdata.make_path("black_square2.jpg"))
+        with open(testdata.make_path("new.txt"), "w") as f:
+            f.write("new")
+
+        hashes = scan.scan_paths([
+            "white_square.jpg", "dir2/", "black_square2.jpg", "new.txt",
+        ])
+
+        moved = models.FilePath.objects.get(path="dir2/white_square.jpg")
+        self.assertEqual(moved.file_id, white_square.file_id)
+        self.assertFalse(models.FilePath.objects.filter(path="white_square.jpg").exists())
+        self.assertFalse(models.FilePath.objects.filter(path="black_square2.jpg").exists())
+        new = models.FilePath.objects.get(path="new.txt")
+        self.assertEqual(new.file.mimetype, "text/plain")
+        self.assertIn(new.file_id, hashes)
+
+        # Paths outside of those given are left alone
+        os.remove(testdata.make_path("not_image.txt"))
+        shutil.rmtree(testdata.make_path("dir1"))
+        scan.scan_paths(["dir1"])
+        self.assertFalse(models.FilePath.objects.filter(path__startswith="dir1/").exists())
+        self.assertTrue(models.FilePath.objects.filter(path="not_image.txt").exists())
+        self.assertTrue(models.File.objects.filter(
+            hash=models.FilePath.objects.get(path="black_square1.jpg").file_id
+        ).exists())
+
+    def get_folders(self):
+        return {folder.path: (folder.parent_id, folder.file_count)
+                for folder in models.Folder.objects.all()}
+
+    def test_folders(self):
+        self.assertEqual(self.get_folders(), {
+            "": (None, 4),
+            "dir1": ("", 1),
+        })
+
+        # Parents without files of their own are created too
+        os.makedirs(testdata.make_path("a/b"))
+        os.rename(testdata.make_path("dir1/black_square3.jpg"),
+                  testdata.make_path("a/b/black_square3.jpg"))
+        shutil.copy(testdata.make_path("white_square.jpg"),
+                    testdata.make_path("a/b/white_square.jpg"))
+        scan.scan_all()
+        self.assertEqual(self.get_folders(), {
+            "": (None, 4),
+            "a": ("", 0),
+            "a/b": ("a", 2),
+            "dir1": ("", 0),
+        })
+
+        # Folders removed from the disk are removed, along with empty parents
+        shutil.rmtree(testdata.make_path("a"))
+        os.remove(testdata.make_path("not_image.txt"))
+        scan.scan_paths(["a", "not_image.txt"])
+        self.assertEqual(self.get_folders(), {"": (None, 3), "dir1": ("", 0)})
+        os.rmdir(testdata.make_path("dir1"))
+        scan.scan_all()
+        self.assertEqual(self.get_folders(), {"": (None, 3)})
+
+    def test_empty_folders(self):
+        # Folders with no files in them are listed too
+        os.makedirs(testdata.make_path("empty/sub"))
+        scan.scan_all()
+        self.assertEqual(self.get_folders(), {
+            "": (None, 4),
+            "dir1": ("", 1),
+            "empty": ("", 0),
+            "empty/sub": ("empty", 0),
+        })
+        os.mkdir(testdata.make_path("dir1/new"))
+        scan.scan_paths(["dir1/new"])
+        self.assertIn("dir1/new", self.get_folders())
+
+        # Ones removed from the disk with no files in them
+        shutil.rmtree(testdata.make_path("empty"))
+        os.rmdir(testdata.make_path("dir1/new"))
+        scan.scan_paths(["empty", "dir1/new"])
+        self.assertEqual(self.get_folders(), {
+            "": (None, 4),
+            "dir1": ("", 1),
+        })
+
+    def test_folder_count_drift(self):
+        # A count that's wrong is corrected, rather than going negative
+        models.Folder.objects.filter(path="dir1").update(file_count=0)
+        models.Folder.objects.filter(path="").update(file_count=100)
+        os.remove(testdata.make_path("dir1/black_square3.jpg"))
+        os.remove(testdata.make_path("not_image.txt"))
+        scan.scan_all()
+        self.assertEqual(self.get_folders(), {
+            "": (None, 3),
+            "dir1": ("", 0),
+        })
+
+    def test_moved_files_paged(self):
+        white_square = models.FilePath.objects.get(path="white_square.jpg")
+        black_square3 = models.FilePath.objects.get(path="dir1/black_square3.jpg")
+        # Moved to a path sorted before and after the old one
+        os.rename(testdata.make_path("white_square.jpg"),
+                  testdata.make_path("a_white.jpg"))
+        os.mkdir(testdata.make_path("z"))
+        os.rename(testdata.make_path("dir1/black_square3.jpg"),
+                  testdata.make_path("z/black_square3.jpg"))
+        with open(testdata.make_path("dir1/new.txt"), "w") as f:
+            f.write("new")
+
+        with mock.patch("vgloss.scan.DB_PAGE_SIZE", 2), \
+                mock.patch("vgloss.scan.SCAN_BATCH_SIZE", 2), \
+                mock.patch("vgloss.scan._ingest_file",
+                           wraps=scan._ingest_file) as ingest_mock:
+            scan.scan_all()
+        ingest_mock.assert_called_once_with(testdata.make_path("dir1/new.txt"))
+
+        self.assertSetEqual(
+            set(models.FilePath.objects.values_list("path", "file_id")),
+            {
+                ("a_white.jpg", white_square.file_id),
+                ("black_square1.jpg", black_square3.file_id),
+                ("black_square2.jpg", black_square3.file_id),
+                ("dir1/new.txt", hashlib.sha512(b"new").hexdigest()),
+                ("not_image.txt", models.FilePath.objects.get(path="not_image.txt").file_id),
+                ("z/black_square3.jpg", black_square3.file_id),
+            }
+        )
+
+    def test_hardlinks(self):
+        os.link(testdata.make_path("white_square.jpg"),
+                testdata.make_path("dir1/white_link1.jpg"))
+        os.mkdir(testdata.make_path("dir2"))
+        with open(testdata.make_path("dir2/new.txt"), "w") as f:
+            f.write("new")
+        os.link(testdata.make_path("dir2/new.txt"),
+                testdata.make_path("dir2/new_link.txt"))
+
+        with mock.patch("vgloss.scan._ingest_file",
+                        wraps=scan._ingest_file) as hash_mock:
+            scan.scan_all()
+        hash_mock.assert_called_once()
+
+        self.assertEqual(
+            models.FilePath.objects.get(path="dir1/white_link1.jpg").file_id,
+            models.FilePath.objects.get(path="white_square.jpg").file_id,
+        )
+        self.assertEqual(
+            models.FilePath.objects.get(path="dir2/new.txt").file_id,
+            models.FilePath.objects.get(path="dir2/new_link.txt").file_id,
+        )
+
+    def test_resume(self):
+        models.FilePath.objects.all().delete()
+        models.File.objects.all().delete()
+
+        # Interrupt scan after the first batch is committed
+        save_paths = scan._save_paths
+        calls = []
+        def interrupted_save_paths(batch):
+            calls.append(batch)
+            if len(calls) > 1:
+                raise KeyboardInterrupt()
+            return save_paths(batch)
+        with mock.patch("vgloss.scan.SCAN_BATCH_SIZE", 2), \
+                mock.patch("vgloss.scan._save_paths", interrupted_save_paths):
+            with self.assertRaises(KeyboardInterrupt):
+                scan.scan_all()
+        self.assertSetEqual(
+            set(models.FilePath.objects.values_list("path", flat=True)),
+            {"black_square1.jpg", "black_square2.jpg"},
+        )
+        self.assertEqual(
+            models.ScanCheckpoint.objects.get().resume_path,
+            "black_square2.jpg",
+        )
+        self.assertEqual(models.File.objects.get().scan_version, scan.SCAN_VERSION)
+
+        # Resumed scan only reads files after the checkpoint
+        with mock.patch("vgloss.scan._ingest_file",
+                        wraps=scan._ingest_file) as ingest_mock:
+            scan.scan_all()
+        self.assertSetEqual(
+            set(call[0][0] for call in ingest_mock.call_args_list),
+            {testdata.make_path("dir1/black_square3.jpg"),
+             testdata.make_path("not_image.txt"),
+             testdata.make_path("white_square.jpg")},
+        )
+        self.assertFalse(models.ScanCheckpoint.objects.exists())
+        self.assertEqual(models.FilePath.objects.count(), 5)
+        self.assertSetEqual(
+            set(models.File.objects.values_list("scan_version", flat=True)),
+            {scan.SCAN_VERSION}
+        )
+
+    def test_ingest_file(self):
+        path = testdata.make_path("big.bin")
+        data = os.urandom(scan.HASH_CHUNK_SIZE * 2 + 7)
+        with open(path, "wb") as f:
+            f.write(data)
+        self.assertEqual(
+            scan._ingest_file(path),
+            (hashlib.sha512(data).hexdigest(), magic.from_file(path, mime=True))
+        )
+
+        # Mimetype should match what libmagic detects reading the file itself
+        for path in ["white_square.jpg", "not_image.txt", "empty"]:
+            path = testdata.make_path(path)
+            open(path, "a").close()
+            self.assertEqual(
+                scan._ingest_file(path)[1],
+                magic.from_file(path, mime=True),
+            )
+
+    def test_stats(self):
+        with open(testdata.make_path("dir1/new.txt"), "w") as f:
+            f.write("new")
+        with stats.record() as recorder:
+            scan.scan_all()
+        report = recorder.report()
+
+        phases = report["phases"]
+        self.assertEqual(phases["walk"]["files"], 6)
+        self.assertEqual(phases["hash"]["files"], 1)
+        self.assertEqual(phases["hash"]["bytes"], 3)
+        self.assertEqual(phases["exiftool"]["files"], 0)
+        # Queries are counted in the phase that made them. Writing includes
+        # the savepoints around each batch.
+        self.assertEqual({name: p["queries"] for name, p in phases.items()}, {
+            "other": 1, "scan": 3, "db_read": 3, "walk": 0, "hash": 0,
+            "mimetype": 0, "db_write": 13, "exiftool": 0, "cleanup": 5,
+        })
+        self.assertEqual(report["queries"], 25)
+        self.assertGreaterEqual(report["seconds"], phases["scan"]["seconds"])
+
+        # Nothing is recorded outside of record()
+        scan.scan_all()
+        self.assertEqual(recorder.report()["phases"]["walk"]["files"], 6)
+
+    def test_stats_unchanged(self):
+        # Rescanning an unchanged tree reads one page of FilePaths and
+        # doesn't save any paths or files
+        with stats.record() as recorder, self.assertNumQueries(13):
+            scan.scan_all()
+        phases = recorder.report()["phases"]
+        self.assertEqual({name: p["queries"] for name, p in phases.items()}, {
+            "other": 1, "scan": 2, "db_read": 2, "walk": 0, "db_write": 3,
+            "cleanup": 5,
+        })
+
+    def test_exiftool_pool(self):
+        abspaths = [
+            testdata.make_path(path)
+            for path in ["white_square.jpg", "dir1/black_square3.jpg",
+                         "does_not_exist.jpg", "white_square.jpg"]
+        ]
+        with exiftool.ExifToolPool(size=2, batch_size=1) as pool:
+            results = pool.extract_metadata(abspaths)
+        self.assertEqual(len(results), 4)
+        self.assertDictEqual(results[0], scan.extract_metadata(abspaths[0]))
+        self.assertDictEqual(results[1], scan.extract_metadata(abspaths[1]))
+        self.assertIsNone(results[2])
+        self.assertDictEqual(results[3], results[0])
+        self.assertNotIn("SourceFile", results[0])
+        self.assertNotIn("FileName", results[0])
+
     @unittest.skip("Test not implemented")
     def test_extract_timestamp(self):
         # From exif
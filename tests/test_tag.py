@@ -228,3 +228,46 @@ class TestTagUpdateAction(TestCase):
             set(models.Tag.objects.values_list("id", flat=True)),
             {tag4.id}
         )
+
+    def get_ancestors(self):
+        return set(models.TagAncestor.objects.values_list(
+            "ancestor__name", "tag__name", "depth"
+        ))
+
+    def test_ancestors(self):
+        tag1 = models.Tag.objects.create(name="tag1")
+        tag2 = models.Tag.objects.create(name="tag2", parent=tag1)
+        tag3 = models.Tag.objects.create(name="tag3", parent=tag2)
+        self.assertSetEqual(self.get_ancestors(), {
+            ("tag1", "tag1", 0), ("tag2", "tag2", 0), ("tag3", "tag3", 0),
+            ("tag1", "tag2", 1), ("tag2", "tag3", 1), ("tag1", "tag3", 2),
+        })
+
+        # Swap 1 and 2, which is only a valid tree once both are saved
+        self.action_request(
+            actions.TagUpdate(tags=[
+                {"id": tag1.id, "name": "tag1", "parent": tag2.id},
+                {"id": tag2.id, "name": "tag2", "parent": None},
+                {"id": tag3.id, "name": "tag3", "parent": tag2.id},
+                {"id": "temp", "name": "tag4", "parent": tag1.id},
+                {"name": "tag5", "parent": "temp"},
+            ])
+        )
+        self.assertSetEqual(self.get_ancestors(), {
+            ("tag1", "tag1", 0), ("tag2", "tag2", 0), ("tag3", "tag3", 0),
+            ("tag4", "tag4", 0), ("tag5", "tag5", 0),
+            ("tag2", "tag1", 1), ("tag2", "tag3", 1),
+            ("tag1", "tag4", 1), ("tag2", "tag4", 2),
+            ("tag4", "tag5", 1), ("tag1", "tag5", 2), ("tag2", "tag5", 3),
+        })
+
+        # Deleting 1 deletes 4 and 5 under it
+        self.action_request(
+            actions.TagUpdate(tags=[
+                {"id": tag2.id, "name": "tag2"},
+                {"id": tag3.id, "name": "tag3"},
+            ])
+        )
+        self.assertSetEqual(self.get_ancestors(), {
+            ("tag2", "tag2", 0), ("tag3", "tag3", 0), ("tag2", "tag3", 1),
+        })
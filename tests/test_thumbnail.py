@@ -0,0 +1,627 @@
+import io
+import os
+import json
+import queue
+import struct
+import shutil
+import tempfile
+import unittest
+import threading
+import subprocess
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections
+from django.test import (
+    SimpleTestCase, TestCase, TransactionTestCase, Client, override_settings
+)
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import reverse
+
+from PIL import Image
+
+from vgloss import (
+    models, scan, thumbnail, thumbnail_backends, thumbnail_store, preview
+)
+from vgloss.asgi import application
+from tests import testdata
+
+def read_bundle(content):
+    """Return `{hash: (content_type, bytes)}` and `{hash: error}` from a
+    `FileThumbnails` response."""
+    index_length = struct.unpack(">I", content[:4])[0]
+    index = json.loads(content[4:4+index_length])
+    data = content[4+index_length:]
+    thumbs, errors = {}, {}
+    for entry in index:
+        if "error" in entry:
+            errors[entry["hash"]] = entry["error"]
+        else:
+            start = entry["offset"]
+            thumbs[entry["hash"]] = (entry["type"], data[start:start+entry["length"]])
+    return thumbs, errors
+
+def make_jpeg_with_preview(path):
+    """Write a green 1500x1000 JPEG with a smaller, blue preview after its
+    end, which decoders ignore, and return the metadata exiftool would give
+    it."""
+    Image.new("RGB", (1500, 1000), (0, 255, 0)).save(path)
+    preview_data = io.BytesIO()
+    Image.new("RGB", (600, 400), (0, 0, 255)).save(preview_data, "JPEG")
+    preview_data = preview_data.getvalue()
+    start = os.path.getsize(path)
+    with open(path, "ab") as f:
+        f.write(preview_data)
+    return {"ImageWidth": 1500, "ImageHeight": 1000,
+            "PreviewImageStart": start,
+            "PreviewImageLength": len(preview_data)}
+
+def fake_generate_thumbnail(abspath, out_paths, metadata=None):
+    for path in out_paths.values():
+        with open(path, "w") as f:
+            f.write(abspath)
+    return sorted(set(size for size, format in out_paths))
+
+class TestThumbnail(TestCase):
+
+    def setUp(self):
+        testdata.basic_data()
+        scan.scan_all()
+        # Don't depend on vipsthumbnail being installed
+        patcher = mock.patch("vgloss.thumbnail.generate_thumbnail",
+                             side_effect=fake_generate_thumbnail)
+        self.generate_thumbnail = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        testdata.clean()
+
+    def test_generate_all_thumbnails(self):
+        thumbnail.generate_all_thumbnails(jobs=4)
+        # One thumbnail for each image with distinct content
+        self.assertEqual(self.generate_thumbnail.call_count, 2)
+        for file in models.File.objects.all():
+            if file.is_image:
+                self.assertEqual(file.thumbnail_version, thumbnail.THUMBNAIL_VERSION)
+                self.assertIn(file.get_thumbnail_key(), thumbnail.get_store())
+                self.assertEqual(file.thumbnails["formats"], ["jpeg", "webp"])
+            else:
+                self.assertIsNone(file.thumbnail_version)
+
+        # Up to date thumbnails aren't regenerated, missing ones are
+        self.generate_thumbnail.reset_mock()
+        white_square = models.FilePath.objects.get(path="white_square.jpg").file
+        thumbnail.get_store().delete(white_square.get_thumbnail_key())
+        thumbnail.generate_all_thumbnails()
+        self.generate_thumbnail.assert_called_once()
+        abspath, out_paths, metadata = self.generate_thumbnail.call_args[0]
+        self.assertEqual(abspath, testdata.make_path("white_square.jpg"))
+        self.assertEqual(os.path.basename(out_paths[(250, "webp")]),
+                         white_square.get_thumbnail_key(250, "webp"))
+        self.assertEqual(metadata, white_square.metadata)
+
+        # Changing the sizes regenerates everything
+        self.generate_thumbnail.reset_mock()
+        with self.settings(THUMBNAIL_SIZES=[250, 500]):
+            thumbnail.generate_all_thumbnails()
+        self.assertEqual(self.generate_thumbnail.call_count, 2)
+
+    def test_failure(self):
+        self.generate_thumbnail.side_effect = subprocess.CalledProcessError(1, "vipsthumbnail")
+        with mock.patch("sys.stderr"):
+            thumbnail.generate_all_thumbnails()
+        self.assertFalse(models.File.objects.filter(thumbnail_version__isnull=False).exists())
+
+@override_settings(THUMBNAIL_BACKEND="pillow")
+class TestThumbnailView(TestCase):
+
+    def setUp(self):
+        testdata.basic_data()
+        Image.new("RGB", (1000, 800), (0, 0, 255)).save(testdata.make_path("big.jpg"))
+        scan.scan_all()
+        thumbnail.generate_all_thumbnails()
+        self.client = Client()
+
+    def tearDown(self):
+        testdata.clean()
+
+    def get(self, path, **kwargs):
+        file = models.FilePath.objects.get(path=path).file
+        return self.client.get(reverse("file-thumb", args=[file.hash]), **kwargs)
+
+    def get_size(self, response):
+        with Image.open(io.BytesIO(response.content)) as image:
+            return image.size
+
+    def test_sizes(self):
+        self.assertEqual(
+            models.FilePath.objects.get(path="big.jpg").file.thumbnails["sizes"],
+            [250, 500],
+        )
+        response = self.get("big.jpg")
+        self.assertEqual(self.get_size(response), (250, 200))
+        response = self.get("big.jpg", data={"size": 300})
+        self.assertEqual(self.get_size(response), (500, 400))
+        # Largest available if none are big enough
+        response = self.get("big.jpg", data={"size": 2000})
+        self.assertEqual(self.get_size(response), (500, 400))
+
+        # Images smaller than the smallest size only have that
+        response = self.get("white_square.jpg", data={"size": 2000})
+        self.assertEqual(self.get_size(response), (100, 100))
+
+    def test_format(self):
+        response = self.get("big.jpg")
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertIn("Accept", response["Vary"])
+        response = self.get("big.jpg", HTTP_ACCEPT="image/avif,image/webp,*/*")
+        self.assertEqual(response["Content-Type"], "image/webp")
+        with Image.open(io.BytesIO(response.content)) as image:
+            self.assertEqual(image.format, "WEBP")
+
+    def test_caching(self):
+        response = self.get("big.jpg", data={"size": 300})
+        self.assertIn("immutable", response["Cache-Control"])
+        etag = response["ETag"]
+        with mock.patch("vgloss.thumbnail_store.PackStore.get") as get:
+            response = self.get("big.jpg", data={"size": 300},
+                                HTTP_IF_NONE_MATCH=etag)
+            get.assert_not_called()
+        self.assertEqual(response.status_code, 304)
+        self.assertIn("Accept", response["Vary"])
+
+        # Different thumbnail, different ETag
+        response = self.get("big.jpg", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+        # Not the size asked for, which could be generated later
+        response = self.get("big.jpg", data={"size": 1000})
+        self.assertEqual(self.get_size(response), (500, 400))
+        self.assertNotIn("immutable", response["Cache-Control"])
+        self.assertIn("no-cache", response["Cache-Control"])
+        response = self.get("big.jpg", data={"size": 1000},
+                            HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertIn("no-cache", response["Cache-Control"])
+
+    def test_bundle(self):
+        big, white, not_image = (
+            models.FilePath.objects.get(path=path).file
+            for path in ("big.jpg", "white_square.jpg", "not_image.txt")
+        )
+        hashes = [white.hash, "nonexistent", big.hash, not_image.hash]
+        params = {"hashes": ",".join(hashes), "size": 300, "accept": "image/webp"}
+        response = self.client.get(reverse("file-thumbs"), params)
+        self.assertEqual(response.status_code, 200)
+        thumbs, errors = read_bundle(response.content)
+        self.assertEqual(list(thumbs), [white.hash, big.hash])
+        self.assertEqual(errors, {"nonexistent": 404, not_image.hash: 404})
+        content_type, data = thumbs[big.hash]
+        self.assertEqual(content_type, "image/webp")
+        with Image.open(io.BytesIO(data)) as image:
+            self.assertEqual(image.size, (500, 400))
+        # Same as requesting it alone
+        response = self.get("big.jpg", data={"size": 300}, HTTP_ACCEPT="image/webp")
+        self.assertEqual(response.content, data)
+
+        response = self.client.get(reverse("file-thumbs"))
+        self.assertEqual(response.status_code, 400)
+
+    def test_bundle_caching(self):
+        big = models.FilePath.objects.get(path="big.jpg").file
+        params = {"hashes": big.hash, "size": 300}
+        response = self.client.get(reverse("file-thumbs"), params)
+        self.assertIn("no-cache", response["Cache-Control"])
+        etag = response["ETag"]
+        with mock.patch("vgloss.thumbnail_store.PackStore.get") as get:
+            response = self.client.get(reverse("file-thumbs"), params,
+                                       HTTP_IF_NONE_MATCH=etag)
+            get.assert_not_called()
+        self.assertEqual(response.status_code, 304)
+
+        # Different thumbnails, different ETag
+        response = self.client.get(reverse("file-thumbs"), {"hashes": big.hash},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+        # Bundles can't be posted, which would need a CSRF token
+        response = self.client.post(reverse("file-thumbs"), params)
+        self.assertEqual(response.status_code, 405)
+
+    def test_asgi(self):
+        file = models.FilePath.objects.get(path="big.jpg").file
+        messages = []
+        async def receive():
+            return {"type": "http.request", "body": b""}
+        async def send(message):
+            messages.append(message)
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": reverse("file-thumb", args=[file.hash]),
+            "query_string": b"",
+            "headers": [(b"host", b"testserver")],
+        }
+        # Like the test client, so the test's transaction isn't closed
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        try:
+            async_to_sync(application)(scope, receive, send)
+        finally:
+            request_started.connect(close_old_connections)
+            request_finished.connect(close_old_connections)
+
+        start, body, end = messages
+        self.assertEqual(start["status"], 200)
+        # Sent straight from the pack file, without copying it
+        self.assertIsInstance(body["body"], memoryview)
+        self.assertEqual(body["body"], self.get("big.jpg").content)
+        self.assertEqual(end, {"type": "http.response.body"})
+
+    def test_not_image(self):
+        response = self.get("not_image.txt")
+        self.assertEqual(response.status_code, 404)
+
+# Thumbnails are saved from worker threads, which can't see the data of a test
+# run in a transaction.
+@override_settings(THUMBNAIL_BACKEND="pillow")
+class TestOnDemand(TransactionTestCase):
+
+    def setUp(self):
+        testdata.basic_data()
+        scan.scan_all()
+        self.scheduler = thumbnail.ThumbnailScheduler()
+        self.addCleanup(self.scheduler.stop)
+
+    def tearDown(self):
+        testdata.clean()
+
+    def get_file(self, path):
+        return models.FilePath.objects.get(path=path).file
+
+    def test_view(self):
+        file = self.get_file("white_square.jpg")
+        self.assertTrue(thumbnail.needs_thumbnails(file))
+        with mock.patch("vgloss.thumbnail.scheduler", self.scheduler):
+            response = Client().get(reverse("file-thumb", args=[file.hash]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+
+        file.refresh_from_db()
+        self.assertEqual(file.thumbnail_version, thumbnail.THUMBNAIL_VERSION)
+        self.assertFalse(thumbnail.needs_thumbnails(file))
+        self.assertFalse(thumbnail.needs_thumbnails(self.get_file("not_image.txt")))
+
+    def test_bundle(self):
+        files = [self.get_file(path) for path in ("white_square.jpg", "black_square1.jpg")]
+        # Everything generating them needs is loaded with the files
+        with mock.patch("vgloss.thumbnail.scheduler", self.scheduler), \
+                mock.patch.object(models.File, "refresh_from_db") as deferred_load:
+            response = Client().get(
+                reverse("file-thumbs"),
+                {"hashes": ",".join(file.hash for file in files)},
+            )
+        thumbs, errors = read_bundle(response.content)
+        self.assertEqual(list(thumbs), [file.hash for file in files])
+        self.assertEqual(errors, {})
+        deferred_load.assert_not_called()
+
+    def test_bigger_than_preview(self):
+        metadata = make_jpeg_with_preview(testdata.make_path("preview.jpg"))
+        scan.scan_all()
+        file = self.get_file("preview.jpg")
+        file.metadata = dict(file.metadata, **metadata)
+        file.save()
+        url = reverse("file-thumb", args=[file.hash])
+
+        with mock.patch("vgloss.thumbnail.scheduler", self.scheduler):
+            # Only what the preview is big enough for is made at first
+            response = Client().get(url, {"size": 300})
+            file.refresh_from_db()
+            self.assertEqual(file.thumbnails["sizes"], [250, 500])
+            self.assertEqual(file.thumbnails["pending_sizes"], [1280])
+            self.assertFalse(thumbnail.needs_bigger_thumbnails(file, 300))
+
+            # Then the rest from the whole image, once they're requested
+            self.assertTrue(thumbnail.needs_bigger_thumbnails(file, 1000))
+            response = Client().get(url, {"size": 1000})
+        with Image.open(io.BytesIO(response.content)) as image:
+            self.assertEqual(image.size[0], 1280)
+            self.assertGreater(image.getpixel((10, 10))[1], 200)
+        file.refresh_from_db()
+        self.assertEqual(file.thumbnails["sizes"], [250, 500, 1280])
+        self.assertEqual(file.thumbnails["pending_sizes"], [])
+        self.assertFalse(thumbnail.needs_thumbnails(file))
+        self.assertFalse(thumbnail.needs_bigger_thumbnails(file, 1000))
+
+    def test_deduplicate(self):
+        release = threading.Event()
+        def slow_generate_thumbnail(*args):
+            release.wait(10)
+            return fake_generate_thumbnail(*args)
+
+        file = self.get_file("white_square.jpg")
+        with mock.patch("vgloss.thumbnail.generate_thumbnail",
+                        side_effect=slow_generate_thumbnail) as generate:
+            self.scheduler.start(jobs=4)
+            futures = [self.scheduler.submit(file) for _ in range(2)]
+            futures.append(self.scheduler.submit(file, thumbnail.BACKLOG))
+            release.set()
+            results = [future.result(10) for future in futures]
+        generate.assert_called_once()
+        self.assertEqual(results[0]["formats"], ["jpeg", "webp"])
+        self.assertEqual(results, [results[0]] * 3)
+
+    def test_priority(self):
+        with mock.patch("vgloss.thumbnail.generate_thumbnail",
+                        side_effect=fake_generate_thumbnail) as generate:
+            # Queued before the workers start, so nothing is taken off the
+            # queue until everything is on it
+            futures = [
+                self.scheduler.submit(self.get_file(path), thumbnail.BACKLOG)
+                for path in ("black_square1.jpg", "white_square.jpg")
+            ]
+            futures.append(self.scheduler.submit(
+                self.get_file("white_square.jpg"), thumbnail.ON_DEMAND
+            ))
+            self.scheduler.start(jobs=1)
+            for future in futures:
+                future.result(10)
+        self.assertEqual(
+            [call[0][0] for call in generate.call_args_list],
+            [testdata.make_path("white_square.jpg"),
+             testdata.make_path("black_square1.jpg")],
+        )
+
+    def test_queue_full(self):
+        scheduler = thumbnail.ThumbnailScheduler(max_queued=1)
+        scheduler.submit(self.get_file("white_square.jpg"))
+        with self.assertRaises(queue.Full):
+            scheduler.submit(self.get_file("black_square1.jpg"))
+
+class TestThumbnailBackends(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        # Wide image, which displays as tall due to its EXIF orientation
+        self.in_path = os.path.join(self.tmpdir, "in.jpg")
+        image = Image.new("RGB", (1000, 500), (255, 0, 0))
+        exif = image.getexif()
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise
+        image.save(self.in_path, exif=exif)
+
+    def check_backend(self, name):
+        out_paths = {
+            (size, format): os.path.join(self.tmpdir, f"{name}_{size}.{format}")
+            for size in (250, 500, 1280)
+            for format in ("jpeg", "webp")
+        }
+        sizes = thumbnail_backends.BACKENDS[name](self.in_path, out_paths)
+        # Image isn't big enough for 1280
+        self.assertEqual(sizes, [250, 500])
+        self.assertFalse(os.path.exists(out_paths[(1280, "jpeg")]))
+
+        for size in sizes:
+            for format in ("jpeg", "webp"):
+                with Image.open(out_paths[(size, format)]) as image:
+                    self.assertEqual(image.format, format.upper())
+                    self.assertEqual(image.size, (size//2, size))
+                    self.assertEqual(image.mode, "RGB")
+                    self.assertNotIn("exif", image.info)
+                    r, g, b = image.getpixel((size//4, size//2))
+                    self.assertGreater(r, 200)
+                    self.assertLess(g, 50)
+        with Image.open(out_paths[(250, "jpeg")]) as image:
+            self.assertTrue(image.info.get("progressive"))
+
+    def test_pillow(self):
+        self.check_backend("pillow")
+
+    @unittest.skipUnless(thumbnail_backends.detect_backend() == "pyvips",
+                         "pyvips not installed")
+    def test_pyvips(self):
+        self.check_backend("pyvips")
+
+    @unittest.skipUnless(shutil.which("vipsthumbnail"),
+                         "vipsthumbnail not installed")
+    def test_vipsthumbnail(self):
+        self.check_backend("vipsthumbnail")
+
+    def test_unknown_backend(self):
+        with self.settings(THUMBNAIL_BACKEND="nonexistent"):
+            with self.assertRaises(ImproperlyConfigured):
+                thumbnail.get_backend()
+
+
+class TestPackStore(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.store = thumbnail_store.PackStore(self.root)
+
+    def key(self, i, size=250, ext="jpg"):
+        return f"{i:0128x}_{size}.{ext}"
+
+    def put(self, key, data, store=None):
+        path = os.path.join(self.root, "staged")
+        with open(path, "wb") as f:
+            f.write(data)
+        (store or self.store).put(key, path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_put_get(self):
+        self.assertIsNone(self.store.get(self.key(1)))
+        self.put(self.key(1), b"one")
+        self.put(self.key(1, 500), b"one big")
+        self.put(self.key(1, ext="webp"), b"one webp")
+        self.put(self.key(2), b"two")
+        self.assertEqual(bytes(self.store.get(self.key(1))), b"one")
+        self.assertEqual(bytes(self.store.get(self.key(1, 500))), b"one big")
+        self.assertEqual(bytes(self.store.get(self.key(1, ext="webp"))), b"one webp")
+        self.assertIn(self.key(2), self.store)
+        self.assertIn(self.key(2), self.store.keys())
+        self.assertNotIn(self.key(3), self.store.keys())
+
+        self.put(self.key(2), b"two again")
+        self.assertEqual(bytes(self.store.get(self.key(2))), b"two again")
+        self.store.delete(self.key(2))
+        self.assertNotIn(self.key(2), self.store)
+        self.assertIsNone(self.store.get(self.key(2)))
+
+        # Another process sees the same
+        other = thumbnail_store.PackStore(self.root)
+        self.assertEqual(bytes(other.get(self.key(1))), b"one")
+        self.assertNotIn(self.key(2), other)
+        self.put(self.key(3), b"three", store=other)
+        self.assertEqual(bytes(self.store.get(self.key(3))), b"three")
+
+    def test_merge_and_packs(self):
+        with mock.patch("vgloss.thumbnail_store.JOURNAL_MERGE_MIN", 10), \
+             mock.patch("vgloss.thumbnail_store.PACK_SIZE", 100):
+            for i in range(50):
+                self.put(self.key(i), b"%d" % i * 10)
+            self.store.delete(self.key(7))
+        self.assertGreater(self.store._index_count, 0)
+        self.assertLess(len(self.store._journal_records), 11)
+        self.assertGreater(len(self.store._pack_numbers()), 1)
+        other = thumbnail_store.PackStore(self.root)
+        for store in (self.store, other):
+            for i in range(50):
+                if i == 7:
+                    self.assertNotIn(self.key(i), store)
+                else:
+                    self.assertEqual(bytes(store.get(self.key(i))), b"%d" % i * 10)
+
+    def test_loose_and_compact(self):
+        # Thumbnails stored loose before switching to packs are still found
+        with open(os.path.join(self.root, self.key(1)), "wb") as f:
+            f.write(b"loose one")
+        with open(os.path.join(self.root, self.key(2)), "wb") as f:
+            f.write(b"loose two")
+        self.assertEqual(self.store.get(self.key(1)), b"loose one")
+        self.assertIn(self.key(1), self.store.keys())
+        self.put(self.key(3), b"three")
+        self.put(self.key(4), b"four")
+        with open(os.path.join(self.root, self.key(3)), "wb") as f:
+            f.write(b"loose three")
+        old_packs = self.store._pack_numbers()
+
+        self.store.compact(live={self.key(1), self.key(3)})
+        self.assertEqual(bytes(self.store.get(self.key(1))), b"loose one")
+        self.assertEqual(bytes(self.store.get(self.key(3))), b"three")
+        self.assertNotIn(self.key(2), self.store)
+        self.assertNotIn(self.key(4), self.store)
+        self.assertFalse(os.path.exists(os.path.join(self.root, self.key(1))))
+        self.assertFalse(os.path.exists(os.path.join(self.root, self.key(2))))
+        self.assertFalse(os.path.exists(os.path.join(self.root, self.key(3))))
+        self.assertTrue(set(old_packs).isdisjoint(self.store._pack_numbers()))
+
+    def test_compact_everything(self):
+        self.put(self.key(1), b"one")
+        old_packs = self.store._pack_numbers()
+        # Another process, with the pack mapped
+        other = thumbnail_store.PackStore(self.root)
+        self.assertEqual(bytes(other.get(self.key(1))), b"one")
+        self.store.compact(live=set())
+        self.assertEqual(self.store._pack_numbers(), [])
+
+        # A new pack doesn't reuse the old one's number, which the other
+        # process would read it from
+        self.put(self.key(2), b"two")
+        self.assertTrue(self.store._pack_numbers())
+        self.assertTrue(set(old_packs).isdisjoint(self.store._pack_numbers()))
+        self.assertEqual(bytes(other.get(self.key(2))), b"two")
+        self.assertIsNone(other.get(self.key(1)))
+
+class TestPreview(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.out_paths = {
+            (size, "jpeg"): os.path.join(self.tmpdir, f"out_{size}.jpg")
+            for size in (250, 500, 1280)
+        }
+
+    def make_raw(self, preview_size):
+        """Write a fake RAW file with an embedded JPEG preview whose left half
+        is red and right half is blue."""
+        image = Image.new("RGB", preview_size, (0, 0, 255))
+        image.paste((255, 0, 0), (0, 0, preview_size[0]//2, preview_size[1]))
+        jpeg = io.BytesIO()
+        image.save(jpeg, "JPEG")
+        jpeg = jpeg.getvalue()
+
+        path = os.path.join(self.tmpdir, "image.cr2")
+        header = b"II*\x00" + bytes(1000)
+        with open(path, "wb") as f:
+            f.write(header + jpeg + bytes(1000))
+        metadata = {
+            "ImageWidth": 6000,
+            "ImageHeight": 4000,
+            "Orientation": "Rotate 90 CW",
+            "PreviewImageStart": len(header),
+            "PreviewImageLength": len(jpeg),
+        }
+        return path, metadata
+
+    def test_preview(self):
+        path, metadata = self.make_raw((600, 400))
+        sizes = preview.thumbnails_from_preview(path, metadata, self.out_paths)
+        # Preview isn't big enough for 1280
+        self.assertEqual(sizes, [250, 500])
+        with Image.open(self.out_paths[(250, "jpeg")]) as image:
+            width, height = image.size
+            self.assertEqual(height, 250)
+            self.assertAlmostEqual(width, 167, delta=1)
+            # Rotated, so the left half of the preview is at the top
+            self.assertGreater(image.getpixel((83, 20))[0], 200)
+            self.assertGreater(image.getpixel((83, 230))[2], 200)
+
+    def test_bigger_than_preview(self):
+        path = os.path.join(self.tmpdir, "image.jpg")
+        metadata = make_jpeg_with_preview(path)
+        # Sizes the preview is too small for are left for later
+        sizes = thumbnail.generate_thumbnail(path, self.out_paths, metadata)
+        self.assertEqual(sizes, [250, 500])
+        with Image.open(self.out_paths[(250, "jpeg")]) as image:
+            self.assertGreater(image.getpixel((10, 10))[2], 200)
+        self.assertFalse(os.path.exists(self.out_paths[(1280, "jpeg")]))
+
+    @override_settings(THUMBNAIL_BACKEND="pillow")
+    def test_bigger_than_raw_preview(self):
+        # Only the preview of a RAW file can be read, so the sizes it's too
+        # small for are given up on
+        path, metadata = self.make_raw((600, 400))
+        file = models.File(hash="0"*128)
+        file.thumbnails = {"sizes": [250, 500], "formats": ["jpeg"],
+                           "requested_sizes": [250, 500, 1280],
+                           "pending_sizes": [1280]}
+        with self.settings(THUMBNAIL_DIR=self.tmpdir), mock.patch("sys.stderr"):
+            thumbnails = thumbnail._generate_bigger_thumbnails((file, path, 0))
+        self.assertEqual(thumbnails["sizes"], [250, 500])
+        self.assertEqual(thumbnails["pending_sizes"], [])
+
+    def test_unusable_preview(self):
+        # Too small
+        path, metadata = self.make_raw((160, 120))
+        self.assertIsNone(preview.thumbnails_from_preview(path, metadata, self.out_paths))
+
+        # Different aspect ratio than the image
+        path, metadata = self.make_raw((640, 360))
+        self.assertIsNone(preview.thumbnails_from_preview(path, metadata, self.out_paths))
+
+        # Offset doesn't point at a JPEG
+        path, metadata = self.make_raw((600, 400))
+        metadata["PreviewImageStart"] += 1
+        self.assertIsNone(preview.thumbnails_from_preview(path, metadata, self.out_paths))
+
+        self.assertIsNone(preview.thumbnails_from_preview(path, None, self.out_paths))
+        for out_path in self.out_paths.values():
+            self.assertFalse(os.path.exists(out_path))
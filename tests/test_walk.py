@@ -0,0 +1,64 @@
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+
+from vgloss.walk import walk
+
+class TestWalk(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        for path in ["a.txt", "a/b.txt", "a/c/d.txt", "a0.txt", "b/e.txt",
+                     "excluded/f.txt", "a/excluded/g.txt"]:
+            abspath = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(abspath), exist_ok=True)
+            with open(abspath, "w") as f:
+                f.write(path)
+        os.symlink(os.path.join(self.root, "a"), os.path.join(self.root, "link_dir"))
+        os.symlink(os.path.join(self.root, "a.txt"), os.path.join(self.root, "link.txt"))
+        os.symlink(os.path.join(self.root, "missing"), os.path.join(self.root, "broken"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_walk(self):
+        exclude = [os.path.join(self.root, "excluded")]
+        results = list(walk(self.root, exclude, jobs=4))
+        relpaths = [relpath for relpath, abspath, stat in results]
+        self.assertListEqual(relpaths, [
+            "a.txt", "a/b.txt", "a/c/d.txt", "a/excluded/g.txt", "a0.txt",
+            "b/e.txt", "link.txt",
+        ])
+        self.assertListEqual(relpaths, sorted(relpaths))
+        for relpath, abspath, stat in results:
+            self.assertEqual(abspath, os.path.join(self.root, relpath))
+            self.assertEqual(stat.st_ino, os.stat(abspath).st_ino)
+
+    def test_walk_start(self):
+        for start, expected in [
+            ("a/c", ["a/c/d.txt", "a/excluded/g.txt", "a0.txt", "b/e.txt", "link.txt"]),
+            ("a/c/d.txt", ["a/c/d.txt", "a/excluded/g.txt", "a0.txt", "b/e.txt", "link.txt"]),
+            ("a/d", ["a/excluded/g.txt", "a0.txt", "b/e.txt", "link.txt"]),
+            ("a0", ["a0.txt", "b/e.txt", "link.txt"]),
+            ("z", []),
+        ]:
+            relpaths = [
+                relpath
+                for relpath, abspath, stat in walk(self.root, start=start)
+            ]
+            self.assertListEqual(
+                [p for p in relpaths if not p.startswith("excluded/")],
+                expected,
+            )
+
+    def test_walk_dirs(self):
+        exclude = [os.path.join(self.root, "excluded")]
+        results = list(walk(self.root, exclude, dirs=True))
+        self.assertListEqual([(relpath, stat is None) for relpath, abspath, stat in results], [
+            ("a.txt", False), ("a", True), ("a/b.txt", False), ("a/c", True),
+            ("a/c/d.txt", False), ("a/excluded", True), ("a/excluded/g.txt", False),
+            ("a0.txt", False), ("b", True), ("b/e.txt", False), ("link.txt", False),
+        ])
+        self.assertEqual(results[1][1], os.path.join(self.root, "a"))
@@ -0,0 +1,79 @@
+import os
+import shutil
+from unittest import mock
+
+from django.db import OperationalError
+from django.test import TestCase
+
+from vgloss import models, thumbnail
+from vgloss.watch import Watcher
+from tests import testdata
+from tests.test_thumbnail import fake_generate_thumbnail
+
+class TestWatch(TestCase):
+
+    def setUp(self):
+        testdata.basic_data()
+        # Thumbnail generation is tested separately
+        patcher = mock.patch("vgloss.thumbnail.generate_thumbnail",
+                             side_effect=fake_generate_thumbnail)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.watcher = Watcher()
+        self.watcher.reconcile()
+        self.watcher.add_watches("")
+
+    def tearDown(self):
+        self.watcher.inotify.close()
+        testdata.clean()
+
+    def process_events(self):
+        self.watcher.read_events(timeout=1)
+        while self.watcher.pending and not self.watcher.is_pending_ready():
+            self.watcher.read_events(self.watcher.get_timeout())
+        with mock.patch("sys.stderr"):
+            self.watcher.process_pending()
+
+    def test_watch(self):
+        os.mkdir(testdata.make_path("dir2"))
+        shutil.copy(testdata.make_path("white_square.jpg"),
+                    testdata.make_path("dir2/white_square.jpg"))
+        os.remove(testdata.make_path("black_square2.jpg"))
+        self.process_events()
+
+        new = models.FilePath.objects.get(path="dir2/white_square.jpg")
+        self.assertEqual(new.file.thumbnail_version, thumbnail.THUMBNAIL_VERSION)
+        self.assertFalse(models.FilePath.objects.filter(path="black_square2.jpg").exists())
+
+        # New folder is watched too
+        os.rename(testdata.make_path("dir1/black_square3.jpg"),
+                  testdata.make_path("dir2/black_square3.jpg"))
+        self.process_events()
+        self.assertTrue(models.FilePath.objects.filter(path="dir2/black_square3.jpg").exists())
+        self.assertFalse(models.FilePath.objects.filter(path="dir1/black_square3.jpg").exists())
+
+    def test_debounce(self):
+        with open(testdata.make_path("new.txt"), "w") as f:
+            f.write("new")
+        self.watcher.read_events(timeout=1)
+        self.assertEqual(self.watcher.pending, {"new.txt"})
+        self.assertLessEqual(self.watcher.get_timeout(), self.watcher.debounce)
+
+    def test_retry(self):
+        shutil.copy(testdata.make_path("white_square.jpg"),
+                    testdata.make_path("new.jpg"))
+        with mock.patch("vgloss.scan.scan_paths",
+                        side_effect=OperationalError("database is locked")):
+            with self.assertRaises(OperationalError):
+                self.process_events()
+        # Kept to be tried again, but not straight away
+        self.assertEqual(self.watcher.pending, {"new.jpg"})
+        self.assertFalse(self.watcher.is_pending_ready())
+        self.assertGreater(self.watcher.get_timeout(), self.watcher.debounce)
+
+        self.watcher.retry_time = 0
+        self.assertTrue(self.watcher.is_pending_ready())
+        with mock.patch("sys.stderr"):
+            self.watcher.process_pending()
+        self.assertEqual(self.watcher.pending, set())
+        self.assertTrue(models.FilePath.objects.filter(path="new.jpg").exists())
@@ -5,6 +5,8 @@ from django.conf import settings
 
 from PIL import Image
 
+from vgloss import tag_index, thumbnail
+
 def make_path(path):
     return os.path.join(settings.BASE_DIR, path)
 
@@ -15,6 +17,9 @@ def clean():
             shutil.rmtree(path)
         else:
             os.remove(path)
+    # Thumbnail stores keep what they've read in memory
+    thumbnail._get_store.cache_clear()
+    tag_index.index.clear()
 
 def basic_data():
     clean()
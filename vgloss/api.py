@@ -1,6 +1,11 @@
+import json
+import base64
+import sqlite3
 from typing import List
 
+from django.db.models import Exists, F, OuterRef, Q
 from django.db.transaction import atomic
+from django.utils.dateparse import parse_datetime
 
 from rest_framework import generics, status
 from rest_framework.views import APIView
@@ -8,7 +13,7 @@ from rest_framework.response import Response
 from rest_framework.generics import GenericAPIView
 import rest_framework.serializers
 
-from . import models, serializers
+from . import models, serializers, tag_index
 
 
 class Action(GenericAPIView):
@@ -36,38 +41,184 @@ class Action(GenericAPIView):
         return Response(ret)
 
 
+# Orders FileListApi can list files in, and the field each sorts by. Ties
+# are broken by hash, so every file has its own place in the order.
+FILE_SORTS = {
+    "name": "name",
+    "timestamp": "timestamp",
+    # Lists a file once for each of its paths
+    "path": "paths__path",
+}
+
+# Files listed per page unless the `limit` parameter says otherwise
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 5000
+
+# Most files matching a tag expression that are passed to the database to
+# filter by. SQLite allows 32766 parameters since 3.32, and 999 before.
+MAX_TAG_MATCH_PARAMS = 30000 if sqlite3.sqlite_version_info >= (3, 32) else 900
+# Files read at a time when there are more matches than that
+TAG_MATCH_SCAN_SIZE = 2000
+
+def encode_cursor(value, hash):
+    if hasattr(value, "isoformat"):
+        value = value.isoformat()
+    data = json.dumps([value, hash]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+def decode_cursor(cursor, sort):
+    """Return `(value, hash)` of the last file listed before the cursor."""
+    try:
+        value, hash = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if sort == "timestamp" and value is not None:
+            value = parse_datetime(value)
+            if value is None:
+                raise ValueError("Invalid timestamp")
+        if not isinstance(hash, str):
+            raise ValueError("Invalid hash")
+    except (ValueError, TypeError) as e:
+        raise rest_framework.serializers.ValidationError(
+            {"cursor": "Invalid cursor"}
+        ) from e
+    return value, hash
+
+def after_cursor(field, value, hash, descending):
+    """Condition for files after the one with `value` for `field`, and `hash`.
+
+    NULLs come first in ascending order and last in descending order, as
+    SQLite sorts them.
+    """
+    if descending:
+        if value is None:
+            return Q(**{f"{field}__isnull": True, "hash__lt": hash})
+        return (Q(**{f"{field}__lt": value}) |
+                Q(**{field: value, "hash__lt": hash}) |
+                Q(**{f"{field}__isnull": True}))
+    if value is None:
+        return (Q(**{f"{field}__isnull": True, "hash__gt": hash}) |
+                Q(**{f"{field}__isnull": False}))
+    return Q(**{f"{field}__gt": value}) | Q(**{field: value, "hash__gt": hash})
+
+
 class FileListApi(APIView):
+    """List files, a page at a time.
 
-    def get(self, request, *args, **kwargs):
-        qs = models.File.objects.all()
+    `sort` is "name", "timestamp" or "path", or descending with a "-" prefix,
+    and `limit` is the most files in a page. With `columns=1` the page is
+    a list of values for each field, rather than an object for each file (see
+    `serializers.serialize_file_list()`). If there are more, the Link
+    header has the URL of the next page, which continues from a cursor after
+    the last file listed. Each page is a range scan of an index, so it's as
+    quick to get as the first, and files being added or removed meanwhile
+    don't cause any to be skipped or repeated.
 
-        # Filter by folder
-        folder = self.request.GET.get("folder")
-        if folder is not None:
-            folder = folder.strip("/")
-            paths = models.FilePath.objects.filter(folder=folder)
-            qs = qs.filter(paths__in=paths).distinct()
+    `folder` lists only files in that folder, and `tag` only files matching a
+    tag expression like "1&(2|!3)", which is evaluated by `tag_index`.
+    """
+
+    def get(self, request, *args, **kwargs):
+        qs = models.File.objects.only("hash", "name", "mimetype", "timestamp")
 
-        # Filter by tag
-        tag_str = request.GET.get("tag", "")
+        sort = request.GET.get("sort", "name")
+        descending = sort.startswith("-")
+        sort = sort.lstrip("-")
+        if sort not in FILE_SORTS:
+            raise rest_framework.serializers.ValidationError(
+                {"sort": f"Sort should be one of: {', '.join(FILE_SORTS)}"}
+            )
+        field = FILE_SORTS[sort]
         try:
-            tag_include = [
-                int(t)
-                for t in tag_str.split(",")
-                if t
-            ]
+            limit = int(request.GET.get("limit", DEFAULT_PAGE_SIZE))
         except ValueError as e:
             raise rest_framework.serializers.ValidationError(
-                {"tags": "Tag IDs should be integers"}
+                {"limit": "Limit should be an integer"}
             ) from e
-        if tag_include:
-            qs = qs.filter(tags__in=tag_include)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
 
-        file_serializer = serializers.FileSerializer(qs, many=True)
-        return Response(file_serializer.data)
+        # Conditions on paths have to be in one filter() to apply to the same
+        # path, which is also the one sorted by.
+        path_filter = Q()
+        if sort == "path":
+            path_filter &= Q(paths__isnull=False)
+
+        # Filter by folder
+        folder = self.request.GET.get("folder")
+        if folder is not None:
+            folder = folder.strip("/")
+            if sort == "path":
+                path_filter &= Q(paths__folder=folder)
+            else:
+                qs = qs.filter(Exists(models.FilePath.objects.filter(
+                    file=OuterRef("pk"), folder=folder
+                )))
+
+        # Filter by tag expression
+        matches = None
+        tag_expression = request.GET.get("tag", "")
+        if tag_expression:
+            try:
+                hashes, negated = tag_index.index.match(tag_expression)
+            except tag_index.TagExpressionError as e:
+                raise rest_framework.serializers.ValidationError(
+                    {"tag": str(e)}
+                ) from e
+            if len(hashes) <= MAX_TAG_MATCH_PARAMS:
+                qs = qs.exclude(hash__in=hashes) if negated else qs.filter(hash__in=hashes)
+            else:
+                # Too many to pass to the database, so files are checked here
+                # as they're read, in order, until a page is full.
+                matches = lambda hash: (hash in hashes) != negated
+
+        order = ["-sort_value", "-hash"] if descending else ["sort_value", "hash"]
+        def files_after(cursor):
+            conditions = path_filter
+            if cursor is not None:
+                conditions &= after_cursor(field, *cursor, descending)
+            return qs.filter(conditions).annotate(sort_value=F(field)).order_by(*order)
+
+        cursor = request.GET.get("cursor")
+        if cursor:
+            cursor = decode_cursor(cursor, sort)
+        else:
+            cursor = None
+        # One more than a page, to tell whether there's another
+        if matches is None:
+            page = list(files_after(cursor)[:limit+1])
+        else:
+            page = []
+            while len(page) <= limit:
+                chunk = list(files_after(cursor)[:TAG_MATCH_SCAN_SIZE])
+                page.extend(file for file in chunk if matches(file.hash))
+                if len(chunk) < TAG_MATCH_SCAN_SIZE:
+                    break
+                cursor = (chunk[-1].sort_value, chunk[-1].hash)
+        more = len(page) > limit
+        page = page[:limit]
+
+        columns = request.GET.get("columns", "") not in ("", "0", "false")
+        response = Response(serializers.serialize_file_list(page, columns))
+        if more:
+            params = request.GET.copy()
+            last = page[-1]
+            params["cursor"] = encode_cursor(last.sort_value, last.hash)
+            response["Link"] = f'<{request.path}?{params.urlencode()}>; rel="next"'
+        return response
 
 
 class FileDetailApi(generics.RetrieveAPIView):
     queryset = models.File.objects.all()
     serializer_class = serializers.FileDetailSerializer
     lookup_field = "hash"
+
+
+class FolderListApi(generics.ListAPIView):
+    """List folders with files in them, or in their subfolders, and how many
+    files are directly in each. Only subfolders of `parent` if given."""
+    serializer_class = serializers.FolderSerializer
+
+    def get_queryset(self):
+        qs = models.Folder.objects.order_by("path")
+        parent = self.request.GET.get("parent")
+        if parent is not None:
+            qs = qs.filter(parent=parent.strip("/"))
+        return qs
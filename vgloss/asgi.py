@@ -8,9 +8,101 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 """
 
 import os
+import asyncio
 
-from django.core.asgi import get_asgi_application
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers import asgi
+
+from vgloss.responses import BufferResponse
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'vgloss.settings')
 
-application = get_asgi_application()
+
+def warm_up():
+    from vgloss import assets, tag_index
+    assets.get_build()
+    tag_index.index.refresh()
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    """Django's ASGI handler, except streaming responses, like original
+    files, are read a chunk at a time in a thread pool.
+
+    Django reads them on the event loop, which stalls every other request
+    while it waits on the disk. Here the loop carries on, and no thread is
+    held while a slow client is sent what was read.
+
+    The parts of a `BufferResponse`, like thumbnails mapped from a pack file,
+    are sent as they are, without copying them into bytes first.
+    """
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        return await super().__call__(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """Load what's kept in memory when a worker starts, rather than on its
+        first request."""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await sync_to_async(warm_up, thread_sensitive=True)()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def send_response(self, response, send):
+        if not response.streaming and not isinstance(response, BufferResponse):
+            return await super().send_response(response, send)
+
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode("ascii")
+            if isinstance(value, str):
+                value = value.encode("latin1")
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append(
+                (b"Set-Cookie", cookie.output(header="").encode("ascii").strip())
+            )
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": headers,
+        })
+
+        # Closed even if sending fails, like when the client has gone, so the
+        # file is closed and request_finished is sent. The exception stops
+        # the loop, rather than reading the rest of the file for nobody.
+        try:
+            async for part in self.response_parts(response):
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": True,
+                    })
+            await send({"type": "http.response.body"})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+    async def response_parts(self, response):
+        if not response.streaming:
+            for part in response.parts:
+                yield part
+            return
+        loop = asyncio.get_event_loop()
+        parts = iter(response)
+        while True:
+            part = await loop.run_in_executor(None, next, parts, None)
+            if part is None:
+                return
+            yield part
+
+
+django.setup(set_prefix=False)
+application = ASGIHandler()
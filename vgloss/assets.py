@@ -0,0 +1,237 @@
+"""Serving the built Javascript app from memory.
+
+Everything in the dist directory is read once, along with gzip and brotli
+compressed copies of whatever is worth compressing, so requests for assets are
+answered with bytes that are ready to send. The single page that loads the app
+is rendered once too, leaving only the gallery metadata to fill in for each
+request. All of it is loaded again when the app is rebuilt.
+"""
+import os
+import re
+import gzip
+import time
+import hashlib
+import mimetypes
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template
+from django.utils.cache import patch_vary_headers
+from django.utils.html import json_script
+
+from .responses import cache_headers, conditional_response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = os.path.join(settings.VGLOSS_CODE_DIR, "dist")
+SINGLE_PAGE_TEMPLATE = "vgloss/vue-single-page.html"
+
+# Built assets with a content hash in their name, like "js/app.1a2b3c4d.js",
+# never change, so they can be cached forever.
+HASHED_ASSET_RE = re.compile(r"\.[0-9a-f]{8,}\.\w+$")
+
+# Content types worth compressing, besides text/*
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/manifest+json",
+    "image/svg+xml",
+    "image/x-icon",
+}
+# Smaller responses aren't compressed, as it hardly saves anything
+MIN_COMPRESS_SIZE = 1024
+
+# Seconds between checks for a rebuild of the app
+BUILD_CHECK_INTERVAL = 1.0
+
+_METADATA_PLACEHOLDER = "vgloss-metadata-placeholder"
+
+
+def compress(content):
+    """Return `{encoding: content}` with `content` compressed in each encoding
+    that makes it smaller, and uncompressed as "identity"."""
+    variants = {"identity": content}
+    if len(content) < MIN_COMPRESS_SIZE:
+        return variants
+    compressed = {"gzip": gzip.compress(content, 9, mtime=0)}
+    if brotli is not None:
+        compressed["br"] = brotli.compress(content, quality=11)
+    for encoding, data in compressed.items():
+        if len(data) < len(content):
+            variants[encoding] = data
+    return variants
+
+def parse_accept_encoding(header):
+    """Return `{coding: q}` from an Accept-Encoding header."""
+    accepted = {}
+    for part in header.split(","):
+        coding, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                pass
+        accepted[coding.strip().lower()] = q
+    return accepted
+
+def choose_encoding(variants, accept_encoding):
+    """Return the smallest of `variants` allowed by the Accept-Encoding
+    header."""
+    accepted = parse_accept_encoding(accept_encoding)
+    for encoding in sorted(variants, key=lambda e: len(variants[e])):
+        if encoding == "identity" or accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return "identity"
+
+def _is_compressible(content_type):
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+class Asset:
+    """A file from the dist directory, ready to serve."""
+
+    def __init__(self, path, content, mtime):
+        self.mtime = mtime
+        self.content_type, encoding = mimetypes.guess_type(path)
+        self.content_type = self.content_type or "application/octet-stream"
+        if encoding or not _is_compressible(self.content_type):
+            # Already compressed, like "app.js.gz"
+            self.variants = {encoding or "identity": content}
+        else:
+            self.variants = compress(content)
+        self.etag = hashlib.sha1(content).hexdigest()
+        self.immutable = bool(HASHED_ASSET_RE.search(path))
+
+    def response(self, request):
+        last_modified = self.mtime
+        encoding = choose_encoding(
+            self.variants, request.META.get("HTTP_ACCEPT_ENCODING", "")
+        )
+        # Each encoding is a different representation, with its own ETag
+        etag = self.etag if encoding == "identity" else f"{self.etag}-{encoding}"
+        not_modified = conditional_response(request, etag, last_modified, self.immutable)
+        if not_modified:
+            patch_vary_headers(not_modified, ["Accept-Encoding"])
+            return not_modified
+
+        content = self.variants[encoding]
+        response = HttpResponse(content, content_type=self.content_type)
+        response["Content-Length"] = str(len(content))
+        if encoding != "identity":
+            response["Content-Encoding"] = encoding
+        patch_vary_headers(response, ["Accept-Encoding"])
+        return cache_headers(response, etag, last_modified, self.immutable)
+
+
+class Build:
+    """All the files of one build of the app."""
+
+    def __init__(self, dist_dir, version):
+        self.version = version
+        self.assets = {}
+        for dirpath, dirnames, filenames in os.walk(dist_dir):
+            for filename in filenames:
+                abspath = os.path.join(dirpath, filename)
+                relpath = os.path.relpath(abspath, dist_dir).replace(os.sep, "/")
+                with open(abspath, "rb") as f:
+                    mtime = int(os.fstat(f.fileno()).st_mtime)
+                    self.assets[relpath] = Asset(relpath, f.read(), mtime)
+        try:
+            self._page = self._render_page()
+        except TemplateDoesNotExist:
+            # Assets can still be served. Requests for the page raise this.
+            self._page = None
+
+    def _render_page(self):
+        page = get_template(SINGLE_PAGE_TEMPLATE).render(
+            {"metadata": _METADATA_PLACEHOLDER}
+        )
+        placeholder = json_script(_METADATA_PLACEHOLDER, "gallery-metadata")
+        parts = page.split(placeholder, 1)
+        if len(parts) != 2:
+            raise ImproperlyConfigured(
+                f"{SINGLE_PAGE_TEMPLATE} doesn't include the gallery metadata"
+            )
+        return parts
+
+    def page_parts(self):
+        """Return the single page, rendered and split around where the
+        metadata goes."""
+        if self._page is None:
+            self._page = self._render_page()
+        return self._page
+
+    def page_response(self, request, metadata):
+        """Respond with the single page, including `metadata` for the app."""
+        parts = self.page_parts()
+        content = json_script(metadata, "gallery-metadata").join(parts).encode()
+        accepted = parse_accept_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        # Different for each request, so it's compressed quickly each time
+        gzipped = len(content) >= MIN_COMPRESS_SIZE and \
+            accepted.get("gzip", accepted.get("*", 0)) > 0
+        if gzipped:
+            content = gzip.compress(content, 6)
+        response = HttpResponse(content, content_type="text/html; charset=utf-8")
+        response["Content-Length"] = str(len(content))
+        if gzipped:
+            response["Content-Encoding"] = "gzip"
+        patch_vary_headers(response, ["Accept-Encoding"])
+        response["Cache-Control"] = "no-cache"
+        return response
+
+
+_build = None
+_build_checked = 0
+# Guards swapping in a new build
+_lock = threading.Lock()
+# Held while a build is loaded
+_loading_lock = threading.Lock()
+
+def _build_version(dist_dir):
+    """Something which changes whenever the app is rebuilt: the build tool
+    replaces the dist directory, and rewrites the page template."""
+    version = [dist_dir]
+    for path in (dist_dir, os.path.join(settings.VGLOSS_CODE_DIR, "templates",
+                                        SINGLE_PAGE_TEMPLATE)):
+        try:
+            st = os.stat(path)
+            version.append((st.st_ino, st.st_mtime_ns))
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+def get_build():
+    """Return the current `Build`, loading it if it's new.
+
+    Loading compresses every asset, which takes seconds, so the server loads
+    the build when it starts. When the app is rebuilt, the request that
+    notices loads the new build, while others are served the old one.
+    """
+    global _build, _build_checked
+    now = time.monotonic()
+    build = _build
+    if build is not None and build.version[0] == DIST_DIR and \
+            now - _build_checked < BUILD_CHECK_INTERVAL:
+        return build
+    # Without a build there's nothing to serve meanwhile, so wait for it
+    if not _loading_lock.acquire(blocking=build is None):
+        return build
+    try:
+        version = _build_version(DIST_DIR)
+        build = _build
+        if build is None or build.version != version:
+            build = Build(DIST_DIR, version)
+        with _lock:
+            _build = build
+            _build_checked = now
+        return build
+    finally:
+        _loading_lock.release()
@@ -0,0 +1,174 @@
+import os
+import json
+import queue
+import threading
+import itertools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import default_jobs
+
+IGNORED_TAGS = """
+    ExifToolVersion FileName Directory FileSize FileModifyDate
+    FileAccessDate FileInodeChangeDate FilePermissions FileType
+    FileTypeExtension MIMEType
+""".split()
+
+# Number of files sent to an exiftool process in a single request.
+BATCH_SIZE = 32
+
+def get_args():
+    """Arguments given to exiftool for every request."""
+    ignore_tag_args = itertools.chain.from_iterable(
+        zip(itertools.repeat("-x"), IGNORED_TAGS)
+    )
+    return ["-j"] + list(ignore_tag_args)  # JSON format
+
+def filter_metadata(data):
+    """Clean up the data exiftool returns for a single file."""
+    data.pop("SourceFile", None)
+
+    # Remove metadata with binary values
+    binary_keys = []
+    for key, value in data.items():
+        if isinstance(value, str) and value.startswith("(Binary data"):
+            binary_keys.append(key)
+    for key in binary_keys:
+        data.pop(key)
+
+    return data
+
+
+class ExifToolProcess:
+    """A long-running exiftool process which accepts requests over stdin.
+
+    This avoids the startup cost of exiftool, which is significant compared to
+    the time it takes to read the metadata of a single image.
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            ["exiftool", "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def execute(self, args):
+        """Run exiftool with the given args and return its stdout."""
+        stdin = self.process.stdin
+        for arg in args:
+            stdin.write(os.fsencode(arg) + b"\n")
+        stdin.write(b"-execute\n")
+        stdin.flush()
+
+        output = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise RuntimeError("exiftool process exited unexpectedly")
+            if line.rstrip(b"\r\n") == b"{ready}":
+                break
+            output.append(line)
+        return b"".join(output)
+
+    def extract_metadata(self, abspaths):
+        """Return a list of metadata dicts, one for each path in `abspaths`.
+
+        The entry is None for paths exiftool didn't return data for, for
+        example if the file couldn't be read.
+        """
+        output = self.execute(get_args() + list(abspaths))
+        by_path = {}
+        if output.strip():
+            for data in json.loads(output):
+                by_path[data.get("SourceFile")] = data
+        results = []
+        for abspath in abspaths:
+            data = by_path.get(abspath)
+            results.append(None if data is None else filter_metadata(data))
+        return results
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write(b"-stay_open\nFalse\n")
+                self.process.stdin.flush()
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.process.wait()
+        self.process.stdout.close()
+
+
+class ExifToolPool:
+    """A pool of `ExifToolProcess`es, started lazily as they are needed."""
+
+    def __init__(self, size=None, batch_size=BATCH_SIZE):
+        self.size = size or default_jobs()
+        self.batch_size = batch_size
+        self._processes = []
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle.empty() and len(self._processes) < self.size:
+                process = ExifToolProcess()
+                self._processes.append(process)
+                return process
+        return self._idle.get()
+
+    def _release(self, process):
+        self._idle.put(process)
+
+    def _discard(self, process):
+        with self._lock:
+            self._processes.remove(process)
+        process.close()
+
+    def _extract_batch(self, abspaths):
+        # exiftool strips whitespace from each line of the argument file, so
+        # paths with a newline or surrounding whitespace can't be given there.
+        # Callers fall back to running exiftool directly for those.
+        batch = [p for p in abspaths if "\n" not in p and p == p.strip()]
+        results = {}
+        if batch:
+            process = self._acquire()
+            try:
+                results = dict(zip(batch, process.extract_metadata(batch)))
+            except Exception:
+                self._discard(process)
+                raise
+            self._release(process)
+        return [results.get(abspath) for abspath in abspaths]
+
+    def extract_metadata(self, abspaths):
+        """Return a list of metadata dicts, one for each path in `abspaths`.
+
+        Paths are split into batches which are handled by the processes in
+        the pool concurrently. The entry is None for paths exiftool didn't
+        return data for.
+        """
+        abspaths = list(abspaths)
+        batches = [
+            abspaths[i:i+self.batch_size]
+            for i in range(0, len(abspaths), self.batch_size)
+        ]
+        with ThreadPoolExecutor(self.size) as executor:
+            return list(itertools.chain.from_iterable(
+                executor.map(self._extract_batch, batches)
+            ))
+
+    def close(self):
+        with self._lock:
+            processes = self._processes
+            self._processes = []
+        for process in processes:
+            process.close()
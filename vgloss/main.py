@@ -1,11 +1,16 @@
 import os
 import sys
+import json
+import signal
 import argparse
 
 from django import setup
 from django.conf import settings
 from django.core.management import call_command
 
+# Seconds workers have to finish their requests when stopping or reloading
+GRACEFUL_TIMEOUT = 30
+
 
 def query_yes_no(question, default="yes"):
     """Ask a yes/no question via input() and return True/False answer.
@@ -35,6 +40,21 @@ def query_yes_no(question, default="yes"):
                              "(or 'y' or 'n').\n")
 
 
+def parse_bind(address):
+    """Parse a --bind address into uvicorn's arguments."""
+    if address.startswith("unix:"):
+        return {"uds": address[len("unix:"):]}
+    host, _, port = address.rpartition(":")
+    if not port.isdigit():
+        raise argparse.ArgumentTypeError(
+            f"Expected HOST:PORT or unix:PATH, not {address!r}"
+        )
+    return {"host": host.strip("[]") or "127.0.0.1", "port": int(port)}
+
+def get_pid_path():
+    return os.path.join(settings.DATA_DIR, "serve.pid")
+
+
 def main():
     parser = argparse.ArgumentParser("Manage vgloss gallery")
     subparsers = parser.add_subparsers(title="command",
@@ -50,9 +70,46 @@ def main():
                           help="Run webserver for gallery")
     serve_cmd.add_argument('--port', type=int, default="8000",
                            help='Port to listen on')
+    serve_cmd.add_argument("--bind", type=parse_bind, metavar="ADDRESS",
+                           help="Address to listen on, as HOST:PORT or "
+                                "unix:PATH (default: 127.0.0.1 on --port)")
+    serve_cmd.add_argument("--workers", "-w", type=int, default=2,
+                           help="Number of server processes (default: 2)")
+    serve_cmd.add_argument("--dev", action="store_true",
+                           help="Run Django's development server instead, "
+                                "which restarts when the code changes")
+
+    subparsers.add_parser("reload",
+                          help="Gracefully restart the workers of a running "
+                               "server, one at a time, so they pick up a "
+                               "new version of vgloss.")
 
-    subparsers.add_parser("scan",
+    scan_cmd = subparsers.add_parser("scan",
                           help="Detect new images and process them.")
+    scan_cmd.add_argument("--profile", metavar="FILE",
+                          help="Write timings and counters for each phase "
+                               "of the scan to FILE as JSON")
+    scan_cmd.add_argument("--cprofile", metavar="FILE",
+                          help="Profile the main thread with cProfile and "
+                               "write the stats to FILE")
+
+    watch_cmd = subparsers.add_parser("watch",
+                          help="Continuously detect changes and process them.")
+    watch_cmd.add_argument("--reconcile-interval", type=int,
+                           default=60*60,
+                           help="Seconds between full scans, which catch any "
+                                "changes that were missed (0 to disable)")
+
+    subparsers.add_parser("compact",
+                          help="Move thumbnails into pack files and reclaim "
+                               "space from ones which were deleted.")
+
+    # Commands which perform a scan
+    for cmd in (init_cmd, serve_cmd, scan_cmd, watch_cmd):
+        cmd.add_argument("--jobs", "-j", type=int, default=None,
+                         help="Number of files to process in parallel while "
+                              "scanning and generating thumbnails (default: "
+                              "number of CPUs)")
 
     args = parser.parse_args()
     if not args.command:
@@ -73,7 +130,10 @@ def main():
     return dict(
         init=command_init,
         serve=command_serve,
+        reload=command_reload,
         scan=command_scan,
+        watch=command_watch,
+        compact=command_compact,
     )[args.command](args)
 
 def command_init(args):
@@ -91,11 +151,106 @@ def command_init(args):
     command_scan(args)
 
 def command_serve(args):
-    command_scan(args)
+    if args.dev:
+        return serve_dev(args)
+    try:
+        import uvicorn
+    except ImportError:
+        print('Serving needs uvicorn ("pip install uvicorn"), or use --dev',
+              file=sys.stderr)
+        return -1
+    from vgloss import models
+    from vgloss.scan import scan_all
+    from vgloss.thumbnail import scheduler
+
+    # Workers generate thumbnails on demand, each with their own scheduler,
+    # while this process works through the backlog.
+    scan_all(jobs=args.jobs)
+    scheduler.start(jobs=args.jobs)
+    scheduler.queue_backlog(models.File.objects.all())
+
+    # With more than one worker, uvicorn runs them from this process, which
+    # restarts them one at a time on SIGHUP. A single worker runs here, and
+    # can't be restarted that way, which reload says rather than killing it.
+    pid_path = get_pid_path()
+    with open(pid_path, "w") as f:
+        json.dump({"pid": os.getpid(), "workers": args.workers}, f)
+    try:
+        uvicorn.run(
+            "vgloss.asgi:application",
+            workers=args.workers,
+            lifespan="on",
+            timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+            **(args.bind or {"host": "127.0.0.1", "port": args.port}),
+        )
+    finally:
+        os.remove(pid_path)
+
+def command_reload(args):
+    try:
+        with open(get_pid_path()) as f:
+            server = json.load(f)
+        if server["workers"] < 2:
+            print("The server for this gallery runs a single worker, which "
+                  "can't be reloaded. Restart it, or serve with --workers 2 "
+                  "or more.", file=sys.stderr)
+            return -1
+        os.kill(server["pid"], signal.SIGHUP)
+    except (FileNotFoundError, ProcessLookupError):
+        print("No server is running for this gallery", file=sys.stderr)
+        return -1
+
+def serve_dev(args):
+    from vgloss import assets, models, tag_index
+    from vgloss.scan import scan_all
+    from vgloss.thumbnail import scheduler
+
+    # The autoreloader runs this again in a child process, which serves
+    # requests. Scan once in the parent, and generate thumbnails in the child,
+    # where they can be generated on demand as they're requested. The app and
+    # tag index are loaded up front too, rather than on the first request.
+    if os.environ.get("RUN_MAIN") != "true":
+        scan_all(jobs=args.jobs)
+    else:
+        assets.get_build()
+        tag_index.index.refresh()
+        scheduler.start(jobs=args.jobs)
+        scheduler.queue_backlog(models.File.objects.all())
     return call_command("runserver", verbosity=1, addrport=str(args.port))
 
 def command_scan(args):
+    from vgloss import stats
     from vgloss.scan import scan_all
     from vgloss.thumbnail import generate_all_thumbnails
-    scan_all()
-    generate_all_thumbnails()
+
+    profile_path = getattr(args, "profile", None)
+    cprofile_path = getattr(args, "cprofile", None)
+    if cprofile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with stats.record(progress=sys.stderr.isatty()) as recorder:
+            scan_all(jobs=args.jobs)
+            generate_all_thumbnails(jobs=args.jobs)
+    finally:
+        if cprofile_path:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+
+    if profile_path:
+        with open(profile_path, "w") as f:
+            json.dump(recorder.report(), f, indent=2)
+
+def command_watch(args):
+    from vgloss.watch import Watcher
+    watcher = Watcher(jobs=args.jobs,
+                      reconcile_interval=args.reconcile_interval)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+def command_compact(args):
+    from vgloss.thumbnail import compact_thumbnails
+    compact_thumbnails()
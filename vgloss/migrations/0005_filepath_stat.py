@@ -0,0 +1,32 @@
+# Generated by Django 3.1.1 on 2026-10-18 12:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vgloss', '0004_tag_parent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filepath',
+            name='st_dev',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='filepath',
+            name='st_ino',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='filepath',
+            name='st_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='filepath',
+            index=models.Index(fields=['st_dev', 'st_ino'], name='vgloss_file_st_dev_d083fc_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vgloss', '0005_filepath_stat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resume_path', models.TextField()),
+            ],
+        ),
+    ]
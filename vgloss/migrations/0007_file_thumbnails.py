@@ -0,0 +1,18 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vgloss', '0006_scancheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='thumbnails_json',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
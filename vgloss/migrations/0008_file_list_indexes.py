@@ -0,0 +1,29 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vgloss', '0007_file_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['name', 'hash'], name='vgloss_file_name_e3687d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['timestamp', 'hash'], name='vgloss_file_timesta_d00cfe_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='filepath',
+            index=models.Index(fields=['folder', 'path'], name='vgloss_file_folder_137c38_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='filepath',
+            index=models.Index(fields=['file', 'folder'], name='vgloss_file_file_ha_208675_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def link_tag_ancestors(apps, schema_editor):
+    Tag = apps.get_model("vgloss", "Tag")
+    TagAncestor = apps.get_model("vgloss", "TagAncestor")
+    parents = dict(Tag.objects.values_list("id", "parent_id"))
+    links = []
+    for tag in parents:
+        ancestor, depth, seen = tag, 0, set()
+        while ancestor is not None and ancestor not in seen:
+            seen.add(ancestor)
+            links.append(TagAncestor(ancestor_id=ancestor, tag_id=tag, depth=depth))
+            ancestor, depth = parents.get(ancestor), depth + 1
+    TagAncestor.objects.bulk_create(links)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vgloss', '0008_file_list_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagAncestor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='vgloss.tag')),
+                ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='vgloss.tag')),
+            ],
+            options={
+                'unique_together': {('ancestor', 'tag')},
+            },
+        ),
+        migrations.RunPython(link_tag_ancestors, migrations.RunPython.noop),
+    ]
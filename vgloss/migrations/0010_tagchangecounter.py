@@ -0,0 +1,37 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:52
+
+from django.db import migrations, models
+
+
+def count_changes(table):
+    """Triggers counting every change to `table` in TagChangeCounter."""
+    create, drop = [], []
+    for event in ("insert", "update", "delete"):
+        name = f"{table}_{event}_count"
+        create.append(f"""
+            CREATE TRIGGER {name} AFTER {event.upper()} ON {table}
+            BEGIN
+                INSERT OR IGNORE INTO vgloss_tagchangecounter (id, count) VALUES (1, 0);
+                UPDATE vgloss_tagchangecounter SET count = count + 1 WHERE id = 1;
+            END
+        """)
+        drop.append(f"DROP TRIGGER {name}")
+    return migrations.RunSQL(create, drop)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vgloss', '0009_tagancestor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagChangeCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        count_changes("vgloss_filetag"),
+        count_changes("vgloss_tagancestor"),
+    ]
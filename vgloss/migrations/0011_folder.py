@@ -0,0 +1,38 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:57
+
+import os
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_folders(apps, schema_editor):
+    Folder = apps.get_model("vgloss", "Folder")
+    FilePath = apps.get_model("vgloss", "FilePath")
+    counts = dict(FilePath.objects.values_list("folder").annotate(models.Count("path")))
+    folders = {}
+    for path in counts:
+        while path is not None and path not in folders:
+            parent = None if path == "" else os.path.dirname(path)
+            folders[path] = Folder(path=path, parent_id=parent,
+                                   file_count=counts.get(path, 0))
+            path = parent
+    Folder.objects.bulk_create(folders[path] for path in sorted(folders))
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vgloss', '0010_tagchangecounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Folder',
+            fields=[
+                ('path', models.TextField(primary_key=True, serialize=False)),
+                ('file_count', models.PositiveIntegerField(default=0)),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='subfolders', to='vgloss.folder')),
+            ],
+        ),
+        migrations.RunPython(create_folders, migrations.RunPython.noop),
+    ]
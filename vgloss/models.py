@@ -2,8 +2,13 @@ import os
 import json
 
 from django.db import models
+from django.db.models import Count, Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.transaction import atomic
 from django.conf import settings
 
+from .thumbnail_backends import FORMATS
+
 class File(models.Model):
     hash = models.TextField(primary_key=True) # SHA-512
     name = models.TextField()
@@ -13,12 +18,21 @@ class File(models.Model):
     # Track code versions so if code changes we can trigger an update.
     scan_version = models.PositiveIntegerField(blank=True, null=True, db_index=True)
     thumbnail_version = models.PositiveIntegerField(blank=True, null=True)
+    # Which thumbnails were generated. See `thumbnails`.
+    thumbnails_json = models.TextField(blank=True, null=True)
 
     # Scanned Data
     SCAN_FIELDS = ("timestamp", "metadata_json")
     metadata_json = models.TextField(blank=True, null=True)
     timestamp = models.DateTimeField(blank=True, null=True, db_index=True)
 
+    class Meta:
+        # For listing files a page at a time, see `api.FileListApi`
+        indexes = [
+            models.Index(fields=["name", "hash"]),
+            models.Index(fields=["timestamp", "hash"]),
+        ]
+
     @property
     def is_image(self):
         return self.mimetype.startswith("image/")
@@ -31,12 +45,31 @@ class File(models.Model):
     def metadata(self, data):
         self.metadata_json = json.dumps(data)
 
-    def get_thumbnail_path(self, _absent_ok=False):
-        path = os.path.join(settings.THUMBNAIL_DIR, self.hash+".jpg")
-        if _absent_ok or os.path.exists(path):
-            return path
-        else:
-            return None
+    @property
+    def thumbnails(self):
+        """Dict with the "sizes" and "formats" of generated thumbnails.
+
+        Every size exists in every format. "requested_sizes" are the sizes
+        that were asked for; some are skipped if the image is smaller.
+        "pending_sizes" are those skipped because the embedded preview they
+        were made from is smaller, which are made from the whole image once
+        they're requested.
+        """
+        if not self.thumbnails_json:
+            return {"sizes": [], "formats": [], "requested_sizes": [],
+                    "pending_sizes": []}
+        return json.loads(self.thumbnails_json)
+
+    @thumbnails.setter
+    def thumbnails(self, data):
+        self.thumbnails_json = json.dumps(data)
+
+    def get_thumbnail_key(self, size=None, format="jpeg"):
+        """Key of a thumbnail in the thumbnail store. The smallest size if
+        `size` isn't given."""
+        size = size or min(settings.THUMBNAIL_SIZES)
+        extension = FORMATS[format][0]
+        return f"{self.hash}_{size}.{extension}"
 
     @property
     def paths(self):
@@ -52,6 +85,18 @@ class FilePath(models.Model):
     filename = models.TextField(db_index=True)  # Redundanct with path, used for querying
     file = models.ForeignKey("File", db_column="file_hash", related_name="paths", on_delete=models.PROTECT)
     st_mtime_ns = models.BigIntegerField()
+    # Used to recognize moved files and hardlinks without re-hashing them.
+    st_size = models.BigIntegerField(blank=True, null=True)
+    st_dev = models.BigIntegerField(blank=True, null=True)
+    st_ino = models.BigIntegerField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["st_dev", "st_ino"]),
+            # For listing files a page at a time, see `api.FileListApi`
+            models.Index(fields=["folder", "path"]),
+            models.Index(fields=["file", "folder"]),
+        ]
 
     @property
     def abspath(self):
@@ -59,6 +104,87 @@ class FilePath(models.Model):
         assert path.startswith(settings.BASE_DIR)
         return path
 
+class Folder(models.Model):
+    """A folder in `BASE_DIR`, whether or not it has files in it.
+
+    Kept up to date with the disk and `FilePath.folder` by the scanner,
+    through `update_folders()`, so the folder tree is read from the database
+    rather than the disk. The root folder is "", and is the only one with no
+    parent.
+    """
+    path = models.TextField(primary_key=True)
+    parent = models.ForeignKey("Folder", null=True, blank=True,
+                               related_name="subfolders", on_delete=models.CASCADE)
+    # FilePaths directly in this folder
+    file_count = models.PositiveIntegerField(default=0)
+
+def get_parent_folder(path):
+    return None if path == "" else os.path.dirname(path)
+
+def update_folders(changed=(), found=(), exists=None):
+    """Bring Folders up to date after a batch of scanning.
+
+    `changed` are folders whose FilePaths were added to or removed. Their file
+    counts are recomputed from FilePath, rather than adjusted, so a count that
+    has drifted is corrected instead of going negative. `found` are folders
+    seen on disk.
+
+    Folders and their parents are created as needed. Changed folders left
+    with no files or subfolders are deleted, along with parents in the same
+    state, unless `exists(path)` says they're still on disk. The root is never
+    deleted.
+    """
+    changed = set(changed)
+    found = set(found)
+    if not changed and not found:
+        return
+    with atomic():
+        with_files = set(FilePath.objects.filter(folder__in=changed)
+                         .values_list("folder", flat=True).distinct())
+
+        # Create new folders and their parents, which may be new too
+        needed = set()
+        for path in found | with_files:
+            while path is not None and path not in needed:
+                needed.add(path)
+                path = get_parent_folder(path)
+        existing = set(Folder.objects.filter(path__in=needed)
+                       .values_list("path", flat=True))
+        Folder.objects.bulk_create(
+            Folder(path=path, parent_id=get_parent_folder(path))
+            for path in sorted(needed - existing)
+        )
+
+        if changed:
+            file_count = FilePath.objects.filter(
+                folder=OuterRef("path")
+            ).order_by().values("folder").annotate(count=Count("*"))
+            Folder.objects.filter(path__in=changed).update(
+                file_count=Coalesce(Subquery(file_count.values("count")), 0)
+            )
+
+        # Remove empty folders, deepest first so their parents can be removed
+        # after them.
+        candidates = changed - with_files - found
+        while candidates:
+            path = max(candidates, key=lambda path: (path.count("/"), path))
+            candidates.remove(path)
+            if path == "" or (exists is not None and exists(path)):
+                continue
+            deleted, _ = Folder.objects.filter(path=path, file_count=0).exclude(
+                Exists(Folder.objects.filter(parent=OuterRef("pk")))
+            ).delete()
+            if deleted:
+                candidates.add(get_parent_folder(path))
+
+class ScanCheckpoint(models.Model):
+    """Progress of a scan which hasn't finished.
+
+    Paths sorted before `resume_path` have already been scanned, so an
+    interrupted scan can be resumed from there. At most one row exists.
+    """
+    resume_path = models.TextField()
+
 class Tag(models.Model):
     name = models.TextField(db_index=True)
     parent = models.ForeignKey("Tag", null=True, blank=True, on_delete=models.CASCADE)
@@ -67,6 +193,82 @@ class Tag(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # A new tag is linked to its ancestors here, so it can be queried
+        # right away. Moving tags is handled by `update_tag_ancestors()`.
+        adding = self._state.adding
+        with atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                ancestors = TagAncestor.objects.filter(tag_id=self.parent_id) \
+                    .values_list("ancestor_id", "depth") if self.parent_id else []
+                TagAncestor.objects.bulk_create(
+                    [TagAncestor(ancestor_id=self.id, tag_id=self.id, depth=0)] +
+                    [TagAncestor(ancestor_id=ancestor_id, tag_id=self.id, depth=depth+1)
+                     for ancestor_id, depth in ancestors]
+                )
+
+class TagAncestor(models.Model):
+    """Closure table of the tag tree.
+
+    There's a row for every ancestor of every tag, including the tag itself
+    at depth 0, so everything under a tag is found with one indexed lookup.
+    Kept up to date by `Tag.save()` and `update_tag_ancestors()`.
+    """
+    ancestor = models.ForeignKey("Tag", related_name="descendant_links", on_delete=models.CASCADE)
+    tag = models.ForeignKey("Tag", related_name="ancestor_links", on_delete=models.CASCADE)
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = [("ancestor", "tag")]
+
+def get_tag_ancestors(parents):
+    """Return `{(ancestor, tag): depth}` for the tree described by `parents`,
+    a dict of each tag ID to its parent's ID or None."""
+    links = {}
+    for tag in parents:
+        ancestor, depth = tag, 0
+        # Stops at a cycle, as well as the root
+        while ancestor is not None and (ancestor, tag) not in links:
+            links[ancestor, tag] = depth
+            ancestor, depth = parents.get(ancestor), depth + 1
+    return links
+
+def update_tag_ancestors():
+    """Bring `TagAncestor` up to date with the parents of all tags, writing
+    only the rows which changed.
+
+    Call in the same transaction as moving tags. Tags are few, so it's cheap
+    to compare them all, and it doesn't matter what order they were moved in.
+    """
+    with atomic():
+        parents = dict(Tag.objects.values_list("id", "parent_id"))
+        expected = get_tag_ancestors(parents)
+        existing = {
+            (ancestor, tag): (id, depth)
+            for id, ancestor, tag, depth in TagAncestor.objects.values_list(
+                "id", "ancestor_id", "tag_id", "depth"
+            )
+        }
+        stale = [id for link, (id, depth) in existing.items()
+                 if expected.get(link) != depth]
+        TagAncestor.objects.filter(id__in=stale).delete()
+        TagAncestor.objects.bulk_create(
+            TagAncestor(ancestor_id=ancestor, tag_id=tag, depth=depth)
+            for (ancestor, tag), depth in expected.items()
+            if existing.get((ancestor, tag), (None, None))[1] != depth
+        )
+
+class TagChangeCounter(models.Model):
+    """Number of times FileTags and TagAncestors have been created, changed
+    or deleted.
+
+    Triggers in the database count every change, however it's made, so
+    `tag_index` can cheaply tell whether another process made any. At most one
+    row exists.
+    """
+    count = models.PositiveIntegerField(default=0)
+
 class FileTag(models.Model):
     file = models.ForeignKey("File", db_column="file_hash", on_delete=models.CASCADE)
     tag = models.ForeignKey("Tag", on_delete=models.CASCADE)
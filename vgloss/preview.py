@@ -0,0 +1,120 @@
+"""Thumbnails from the previews embedded in camera images.
+
+Camera RAW files, and some JPEGs, contain a JPEG preview which is already
+bigger than a thumbnail. Shrinking that is much cheaper than decoding the full
+image, and for RAW files, which libvips mostly can't decode, it's the only way
+to get a thumbnail at all.
+
+Previews are found using the offsets exiftool reports in the metadata we
+already store for each file.
+"""
+import io
+
+from PIL import Image
+
+from .thumbnail_backends import pillow_thumbnails
+
+# Metadata tags giving `(offset, length)` of embedded JPEGs, most preferred
+# first. Usually only the first one present is big enough.
+PREVIEW_TAGS = [
+    ("JpgFromRawStart", "JpgFromRawLength"),
+    ("PreviewImageStart", "PreviewImageLength"),
+    ("OtherImageStart", "OtherImageLength"),
+    ("MPImageStart", "MPImageLength"),
+    ("ThumbnailOffset", "ThumbnailLength"),
+]
+
+# Exiftool's names for EXIF orientation values, since we don't give it -n
+ORIENTATIONS = {
+    "Horizontal (normal)": 1,
+    "Mirror horizontal": 2,
+    "Rotate 180": 3,
+    "Mirror vertical": 4,
+    "Mirror horizontal and rotate 270 CW": 5,
+    "Rotate 90 CW": 6,
+    "Mirror horizontal and rotate 90 CW": 7,
+    "Rotate 270 CW": 8,
+}
+
+# A preview whose aspect ratio differs from the image by more than this is
+# cropped or letterboxed, so it isn't used.
+ASPECT_TOLERANCE = 0.02
+
+def get_orientation(metadata):
+    orientation = metadata.get("Orientation")
+    if isinstance(orientation, str):
+        return ORIENTATIONS.get(orientation, 1)
+    if isinstance(orientation, int):
+        return orientation
+    return 1
+
+def _read_preview(f, start, length):
+    if not isinstance(start, int) or not isinstance(length, int):
+        return None
+    if start <= 0 or length <= 0:
+        return None
+    f.seek(start)
+    data = f.read(length)
+    if len(data) != length or not data.startswith(b"\xff\xd8"):
+        # Offset isn't absolute, or otherwise not what we expected
+        return None
+    return data
+
+def get_image_size(metadata):
+    """Return `(width, height)` of the image from its exiftool `metadata`, or
+    None if it isn't known."""
+    width = metadata.get("ImageWidth")
+    height = metadata.get("ImageHeight")
+    if isinstance(width, int) and isinstance(height, int) and \
+            width > 0 and height > 0:
+        return width, height
+    return None
+
+def _matches_image(preview, metadata, size):
+    """Is the opened `preview` usable as the source of a `size` thumbnail?"""
+    width, height = preview.size
+    if max(width, height) < size:
+        return False
+    image_size = get_image_size(metadata)
+    if image_size is not None:
+        # Previews are stored unrotated, like the image itself
+        aspect = width / height
+        image_aspect = image_size[0] / image_size[1]
+        if abs(aspect - image_aspect) > ASPECT_TOLERANCE * image_aspect:
+            return False
+    return True
+
+def thumbnails_from_preview(abspath, metadata, out_paths):
+    """Write thumbnails of the image at `abspath` using an embedded preview.
+
+    Like a thumbnail backend, but `metadata` is the file's exiftool metadata.
+    Sizes bigger than the preview are skipped, for the caller to make from the
+    full image. Returns None, without writing anything, if there's no preview
+    big enough for the smallest size.
+    """
+    if not metadata:
+        return None
+    size = min(size for size, format in out_paths)
+    with open(abspath, "rb") as f:
+        for start_tag, length_tag in PREVIEW_TAGS:
+            data = _read_preview(
+                f, metadata.get(start_tag), metadata.get(length_tag)
+            )
+            if data is None:
+                continue
+            try:
+                preview = Image.open(io.BytesIO(data))
+            except OSError:
+                continue
+            with preview:
+                if not _matches_image(preview, metadata, size):
+                    continue
+                try:
+                    # The preview's own EXIF, if any, doesn't reliably
+                    # describe it, so the orientation of the image is used.
+                    return pillow_thumbnails(preview, out_paths,
+                                             orientation=get_orientation(metadata))
+                except OSError:
+                    # Truncated or corrupt preview
+                    continue
+    return None
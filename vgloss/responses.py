@@ -0,0 +1,161 @@
+"""Responses for serving files without reading them into memory, and HTTP
+caching of them."""
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+from django.http.response import HttpResponseBase
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+# Bytes read at a time when streaming part of a file
+CHUNK_SIZE = 64 * 1024
+
+# Seconds that responses which never change are cached for
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, size):
+    """Return `(start, end)` of the byte range requested by a Range `header`
+    in a file of `size` bytes, with `end` exclusive.
+
+    Returns None if the whole file should be sent, which is the case when
+    there's no header or it isn't one we understand, such as a request for
+    more than one range. Raises ValueError if the range is past the end of
+    the file.
+    """
+    match = _RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size
+    start = int(first)
+    end = min(int(last) + 1, size) if last else size
+    if start >= size or start >= end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+def _read_range(f, start, end):
+    try:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+def _sendfile_response(abspath, content_type):
+    response = HttpResponse(content_type=content_type)
+    if settings.SENDFILE == "x-sendfile":
+        response["X-Sendfile"] = abspath
+    else:
+        relpath = os.path.relpath(abspath, settings.BASE_DIR)
+        response["X-Accel-Redirect"] = settings.SENDFILE_URL_PREFIX + quote(relpath)
+    return response
+
+def file_response(request, abspath, content_type):
+    """Respond with the file at `abspath`, streamed a chunk at a time.
+
+    Single byte ranges are supported, so media can be seeked in. If the
+    SENDFILE setting is set, the web server in front of vgloss is told to send
+    the file instead, and handles ranges itself. Raises FileNotFoundError if
+    there's no such file.
+    """
+    if settings.SENDFILE:
+        if not os.path.isfile(abspath):
+            raise FileNotFoundError(abspath)
+        return _sendfile_response(abspath, content_type)
+
+    f = open(abspath, "rb")
+    size = os.fstat(f.fileno()).st_size
+    try:
+        byte_range = parse_range(request.META.get("HTTP_RANGE"), size)
+    except ValueError:
+        f.close()
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    if byte_range is None:
+        # Uses wsgi.file_wrapper where the server provides it
+        response = FileResponse(f, content_type=content_type)
+        response.block_size = CHUNK_SIZE
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            _read_range(f, start, end), status=206, content_type=content_type
+        )
+        response["Content-Range"] = f"bytes {start}-{end-1}/{size}"
+        response["Content-Length"] = str(end - start)
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+class BufferResponse(HttpResponseBase):
+    """A response made of `parts` which are memoryviews, or other buffers,
+    like thumbnails mapped from a pack file.
+
+    `HttpResponse` would copy them into bytes. `vgloss.asgi` sends the parts
+    as they are, and they're only copied if the content is asked for, like
+    under WSGI.
+    """
+    streaming = False
+
+    def __init__(self, parts, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.parts = [memoryview(part) for part in parts]
+        self["Content-Length"] = str(sum(part.nbytes for part in self.parts))
+
+    @property
+    def content(self):
+        return b"".join(self.parts)
+
+    def __iter__(self):
+        return iter([self.content])
+
+    def getvalue(self):
+        return self.content
+
+def cache_headers(response, etag, last_modified=None, immutable=False):
+    """Set the `etag` and `last_modified` timestamp of `response`, and let it
+    be cached.
+
+    If `immutable`, what's at this URL never changes, so it's cached for good
+    without being checked again. Otherwise clients check it's still current
+    each time they use it, which is cheap thanks to `conditional_response()`.
+    """
+    response["ETag"] = quote_etag(etag)
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    if immutable:
+        patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE,
+                            immutable=True)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
+
+def conditional_response(request, etag, last_modified=None, immutable=False):
+    """Return a 304 Not Modified response if the client's cached copy is
+    current, going by its If-None-Match and If-Modified-Since headers.
+    Otherwise return None, and the actual response should be made.
+
+    Call this before reading anything, so that isn't needed for a 304.
+    """
+    response = get_conditional_response(
+        request, etag=quote_etag(etag), last_modified=last_modified
+    )
+    if response is not None:
+        cache_headers(response, etag, last_modified, immutable)
+    return response
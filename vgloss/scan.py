@@ -1,168 +1,646 @@
 import os
 import json
 import hashlib
+import threading
 import itertools
 import subprocess
+import collections
+from stat import S_ISDIR
 
 from django.conf import settings
+from django.db.models import Q
+from django.db.transaction import atomic
 
 import magic
 
-from . import models
+from . import models, exiftool, stats
+from .utils import imap_bounded, batched
+from .walk import walk
 
 SCAN_VERSION = 0
 
-def _list_paths(root):
-    for cwd, dirs, paths in os.walk(root):
-        if cwd.startswith(settings.DATA_DIR):
-            continue
-        for path in paths:
-            abspath = os.path.join(cwd, path)
-            yield os.path.relpath(abspath, root), abspath
+# Number of paths or files handled per database transaction.
+SCAN_BATCH_SIZE = 500
 
-def _get_file_hash(abspath):
+# Number of FilePath rows read from the database at a time while scanning.
+DB_PAGE_SIZE = 1000
+
+# Hashing reads files in large chunks so throughput is bound by the disk rather
+# than by per-read overhead.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_thread_local = threading.local()
+
+def _get_magic():
+    """Return a libmagic handle, reused for every file within a thread."""
+    handle = getattr(_thread_local, "magic", None)
+    if handle is None:
+        handle = _thread_local.magic = magic.Magic(mime=True)
+    return handle
+
+def _get_mimetype(abspath):
+    with stats.phase("mimetype"):
+        return _get_magic().from_file(abspath)
+
+def _ingest_file(abspath):
+    """Read the file once, returning `(hash, mimetype)`.
+
+    The mimetype is detected from the first chunk read, so libmagic doesn't
+    need to open the file again.
+    """
     assert os.path.isabs(abspath)
     h = hashlib.sha512()
-    with open(abspath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            h.update(chunk)
-    return h.hexdigest()
-
-def _get_stale_paths():
-    # Collect all FilePaths from database.
-    # Query for all FilePaths up front and index them in a dictionary key'd by
-    # path. This allows us to know what's already in the database by making a
-    # single database call, which will be much faster than making a database
-    # call for every path we see.
-    file_paths = {}
-    for file_path in models.FilePath.objects.all().iterator():
-        file_paths[file_path.path] = file_path
-
-    # Inspect each file in the directory
-    for path, abspath in _list_paths(settings.BASE_DIR):
-        try:
-            stat = os.stat(abspath)
-        except FileNotFoundError:
-            # Race condition if file gets deleted. Act like we never saw it in
-            # the first place.
-            continue
-
-        if path in file_paths:
-            # File is already in database. Has it changed?
-            file_path = file_paths.pop(path)
-            if stat.st_mtime_ns > file_path.st_mtime_ns:
-                file_path.st_mtime_ns = stat.st_mtime_ns
-                file_path.hash = _get_file_hash(abspath)
-                yield file_path, "updated"
-        else:
-            # File wasn't in database. Yield unsaved object
-            yield models.FilePath(
-                path=path,
-                folder=os.path.dirname(path),
-                filename=os.path.basename(path),
-                file_id=_get_file_hash(abspath),
-                st_mtime_ns=stat.st_mtime_ns,
-            ), "created"
-            continue
-
-    # Paths in database we didn't see were deleted
-    for file_path in file_paths.values():
-        yield file_path, "deleted"
-
-def scan_all():
-
-    # Gather FilePaths we need to create or update
+    header = None
+    size = 0
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with stats.phase("hash"), open(abspath, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if header is None:
+                header = bytes(view[:n])
+            if not n:
+                break
+            h.update(view[:n])
+            size += n
+    stats.count("hash", files=1, nbytes=size)
+
+    if header:
+        with stats.phase("mimetype"):
+            mimetype = _get_magic().from_buffer(header)
+    else:
+        mimetype = "inode/x-empty"  # Same as libmagic gives for empty files
+    return h.hexdigest(), mimetype
+
+def _to_int64(n):
+    # Inode and device numbers are unsigned, but database integers are signed
+    return n - 2**64 if n >= 2**63 else n
+
+def _set_stat_fields(file_path, stat):
+    file_path.st_mtime_ns = stat.st_mtime_ns
+    file_path.st_size = stat.st_size
+    file_path.st_dev = _to_int64(stat.st_dev)
+    file_path.st_ino = _to_int64(stat.st_ino)
+
+def _same_content(file_path, stat):
+    """Can we assume `file_path`'s hash is still valid for a file with `stat`?"""
+    return (
+        file_path.st_mtime_ns == stat.st_mtime_ns and
+        file_path.st_size == stat.st_size
+    )
+
+# Columns of FilePath rows read while comparing the database to the disk.
+DbRow = collections.namedtuple("DbRow", [
+    "path", "file_id", "st_mtime_ns", "st_size", "st_dev", "st_ino",
+])
+
+def _iter_db_rows(start=""):
+    """Yield a `DbRow` for each FilePath with path >= `start`, in path order.
+
+    Rows are read a page at a time using the last path seen as a cursor, so
+    only one page is in memory at once and the query isn't disturbed by
+    batches being committed while we iterate.
+    """
+    qs = models.FilePath.objects.order_by("path").values_list(*DbRow._fields)
+    page = qs.filter(path__gte=start)[:DB_PAGE_SIZE]
+    while page:
+        for row in page:
+            yield DbRow._make(row)
+        page = qs.filter(path__gt=row[0])[:DB_PAGE_SIZE]
+
+def _get_subtree_rows(subtree):
+    """Return DbRows for `subtree` and, if it's a folder, everything in it."""
+    qs = models.FilePath.objects.values_list(*DbRow._fields)
+    return [
+        DbRow._make(row)
+        for row in itertools.chain(
+            qs.filter(path=subtree),
+            # Paths starting with "<subtree>/", since "0" sorts after "/"
+            qs.filter(path__gte=subtree+"/", path__lt=subtree+"0"),
+        )
+    ]
+
+def _walk_subtree(subtree, jobs=None):
+    """Like `walk()`, but only for `subtree`, which may be a folder or file."""
+    abspath = os.path.join(settings.BASE_DIR, subtree)
+    try:
+        stat = os.stat(abspath)
+    except OSError:
+        return
+    if not S_ISDIR(stat.st_mode):
+        yield subtree, abspath, stat
+    elif _is_folder(abspath):
+        yield subtree, abspath, None
+        for relpath, abspath, stat in walk(abspath, [settings.DATA_DIR], jobs,
+                                           dirs=True):
+            yield subtree+"/"+relpath, abspath, stat
+
+def _is_folder(abspath):
+    """Is `abspath` a folder that the scan would walk?"""
+    return (
+        os.path.isdir(abspath) and
+        not os.path.islink(abspath) and
+        abspath != settings.DATA_DIR
+    )
+
+def _folder_exists(path):
+    return _is_folder(os.path.join(settings.BASE_DIR, path))
+
+def _get_inode_rows(inode):
+    """Return DbRows for paths in the database with the given inode."""
+    st_dev, st_ino = inode
+    return [
+        DbRow._make(row)
+        for row in models.FilePath.objects.filter(
+            st_dev=st_dev, st_ino=st_ino
+        ).values_list(*DbRow._fields)
+    ]
+
+def _hash_stale_path(stale):
+    file_path, abspath, action, source, resume_path = stale
+    if source is not None or action == "deleted":
+        # Hash is copied from source, no need to read the file
+        return None
+    try:
+        return _ingest_file(abspath)
+    except FileNotFoundError:
+        return None
+
+class StalePaths:
+    """Iterates over `(file_path, action)` for each path that differs from the
+    database.
+
+    `action` is one of "created", "updated", "moved" or "deleted". Moved
+    FilePaths have their new path set and an extra `old_path` attribute.
+    Hashing of created and updated files is done in a pool of `jobs` threads.
+
+    The walk of the disk and the FilePath table are both read in path order
+    and merge-joined, so memory use doesn't grow with the size of the gallery.
+    While iterating, `resume_path` is a path such that everything sorted
+    before it has already been produced. If the caller has committed
+    everything produced so far, a later scan can pick up from there by passing
+    it as `resume_from`.
+
+    If `subtrees` is given, only those paths relative to `BASE_DIR`, and
+    everything in them if they're folders, are compared. This is for checking
+    a few paths which are known to have changed. Paths in the subtrees are
+    held in memory to sort them.
+
+    `mimetypes` maps the hash of each file read to its mimetype, for files
+    produced since the caller last cleared it. `folders` is the set of folders
+    walked since the caller last cleared it.
+    """
+
+    def __init__(self, jobs=None, resume_from=None, subtrees=None):
+        self.jobs = jobs
+        self.resume_from = resume_from
+        self.resume_path = resume_from or ""
+        self.subtrees = subtrees
+        self.mimetypes = {}
+        self.folders = set()
+
+    def _walk(self):
+        if self.subtrees is None:
+            return stats.timed_iter("walk", self._skip_folders(walk(
+                settings.BASE_DIR, [settings.DATA_DIR], self.jobs,
+                self.resume_from, dirs=True
+            )))
+        # Subtrees may overlap, so remove duplicate paths
+        entries = {
+            entry[0]: entry
+            for subtree in self.subtrees
+            for entry in stats.timed_iter("walk", self._skip_folders(
+                _walk_subtree(subtree, self.jobs)
+            ))
+        }
+        return iter(entries[path] for path in sorted(entries))
+
+    def _skip_folders(self, entries):
+        """Yield files from walk `entries`, adding folders to `self.folders`."""
+        for entry in entries:
+            if entry[2] is None:
+                self.folders.add(entry[0])
+            else:
+                yield entry
+
+    def _db_rows(self):
+        if self.subtrees is None:
+            return stats.timed_iter("db_read", _iter_db_rows(self.resume_from or ""))
+        with stats.phase("db_read"):
+            return iter(sorted(set(itertools.chain.from_iterable(
+                _get_subtree_rows(subtree) for subtree in self.subtrees
+            ))))
+
+    def __iter__(self):
+        hashed = imap_bounded(_hash_stale_path, self._get_unhashed(), self.jobs)
+        for (file_path, abspath, action, source, resume_path), ingested in hashed:
+            self.resume_path = resume_path
+            if action == "deleted":
+                yield file_path, action
+                continue
+
+            if source is not None:
+                file_hash = source.file_id
+            elif ingested is not None:
+                file_hash, mimetype = ingested
+                self.mimetypes[file_hash] = mimetype
+            else:
+                file_hash = None
+            if file_hash is None:
+                # Race condition if file gets deleted before we hash it. Act
+                # like we never saw it in the first place.
+                if action == "updated":
+                    yield file_path, "deleted"
+                continue
+            file_path.file_id = file_hash
+            yield file_path, action
+
+    def _get_unhashed(self):
+        """Yield `(file_path, abspath, action, source, resume_path)` for stale
+        paths.
+
+        The returned FilePath objects don't have a file hash set yet. If
+        `source` is not None, it is a FilePath or DbRow which is known to have
+        the same content, so its hash can be copied instead of reading the
+        file.
+        """
+        db_rows = self._db_rows()
+        db_row = next(db_rows, None)
+        # Moved files are recognized by inode. Skip looking them up if the
+        # database has no inodes, like on the first scan.
+        check_inodes = models.FilePath.objects.filter(st_ino__isnull=False).exists()
+
+        # FilePaths we've yielded with more than one link, indexed by inode,
+        # so hardlinks found in this scan are only read once.
+        seen_inodes = {}
+        # Rows deleted in this scan, indexed by inode, in case the file shows
+        # up at a later path.
+        deleted_inodes = {}
+        # New paths which have the same inode as a path in the database that
+        # we haven't reached yet, key'd by that path. Whether these are moves
+        # or new hardlinks isn't known until we get there. Insertion order is
+        # the order of the new paths.
+        move_candidates = {}
+
+        def get_resume_path(position):
+            # Everything before `position` has been handled, except for held
+            # move candidates.
+            for file_path, abspath, old_row in move_candidates.values():
+                return min(position, file_path.path)
+            return position
+
+        def find_source(inode, stat, position):
+            """Return `(source, old_row)` for a changed file.
+
+            `old_row` is a row later than `position` with the same inode. The
+            file might have been moved from there.
+            """
+            if stat.st_nlink > 1 and inode in seen_inodes:
+                return seen_inodes[inode], None
+            row = deleted_inodes.get(inode)
+            if row is not None and _same_content(row, stat):
+                return row, None
+            if check_inodes:
+                rows = [r for r in _get_inode_rows(inode) if _same_content(r, stat)]
+                for row in rows:
+                    if row.path < position:
+                        return row, None
+                if rows:
+                    return rows[0], rows[0]
+            return None, None
+
+        def passed(row):
+            """Handle a database row which wasn't seen on disk."""
+            candidate = move_candidates.pop(row.path, None)
+            if candidate is not None:
+                file_path, abspath, old_row = candidate
+                file_path.old_path = row.path
+                yield (file_path, abspath, "moved", old_row,
+                       get_resume_path(row.path))
+            else:
+                if row.st_ino is not None:
+                    deleted_inodes[(row.st_dev, row.st_ino)] = row
+                file_path = models.FilePath(path=row.path, file_id=row.file_id)
+                yield file_path, None, "deleted", None, get_resume_path(row.path)
+
+        # Merge-join paths on disk with paths in the database
+        for path, abspath, stat in self._walk():
+            while db_row is not None and db_row.path < path:
+                yield from passed(db_row)
+                db_row = next(db_rows, None)
+            inode = (_to_int64(stat.st_dev), _to_int64(stat.st_ino))
+
+            if db_row is not None and db_row.path == path:
+                row = db_row
+                db_row = next(db_rows, None)
+
+                # A path waiting to see if it was moved from here is a new
+                # hardlink instead.
+                candidate = move_candidates.pop(path, None)
+                if candidate is not None:
+                    file_path, candidate_abspath, old_row = candidate
+                    yield (file_path, candidate_abspath, "created", old_row,
+                           get_resume_path(path))
+
+                # File is already in database. Has it changed?
+                file_path = models.FilePath(
+                    path=row.path,
+                    file_id=row.file_id,
+                    st_mtime_ns=row.st_mtime_ns,
+                    st_size=row.st_size,
+                    st_dev=row.st_dev,
+                    st_ino=row.st_ino,
+                )
+                if (row.st_mtime_ns == stat.st_mtime_ns and
+                        row.st_size in (None, stat.st_size)):
+                    if (row.st_dev, row.st_ino) != inode:
+                        # Content unchanged, but inode changed or was never
+                        # recorded. Update without re-hashing.
+                        _set_stat_fields(file_path, stat)
+                        yield (file_path, abspath, "updated", row,
+                               get_resume_path(path))
+                    continue
+                source, old_row = find_source(inode, stat, path)
+                _set_stat_fields(file_path, stat)
+                if stat.st_nlink > 1:
+                    seen_inodes.setdefault(inode, file_path)
+                yield (file_path, abspath, "updated", source,
+                       get_resume_path(path))
+            else:
+                # File wasn't in database. Yield unsaved object
+                file_path = models.FilePath(
+                    path=path,
+                    folder=os.path.dirname(path),
+                    filename=os.path.basename(path),
+                )
+                _set_stat_fields(file_path, stat)
+                source, old_row = find_source(inode, stat, path)
+                if old_row is not None and old_row.path not in move_candidates:
+                    move_candidates[old_row.path] = (file_path, abspath, old_row)
+                    continue
+                if stat.st_nlink > 1:
+                    seen_inodes.setdefault(inode, file_path)
+                yield (file_path, abspath, "created", source,
+                       get_resume_path(path))
+
+        # Paths in database after the last path on disk were deleted
+        while db_row is not None:
+            yield from passed(db_row)
+            db_row = next(db_rows, None)
+
+        # Shouldn't happen, since candidates' old paths are all in the
+        # database, but in case the database changed under us.
+        for file_path, abspath, old_row in list(move_candidates.values()):
+            yield file_path, abspath, "created", old_row, self.resume_path
+
+def _save_paths(stale_paths):
+    """Save a batch of `(file_path, action)` changes to the database.
+
+    Returns `(referenced_hashes, released_hashes, changed_folders)`: the
+    hashes of files referenced by the created and updated paths, the hashes of
+    files previously referenced by updated and deleted paths, and the folders
+    which paths were added to or removed from.
+    """
     to_create = []
     to_update = []
+    to_move = []
     to_delete = []
     referenced_hashes = set()
-    for file_path, action in _get_stale_paths():
+    changed_folders = set()
+    for file_path, action in stale_paths:
         if action == "created":
             referenced_hashes.add(file_path.file_id)
             to_create.append(file_path)
+            changed_folders.add(file_path.folder)
         elif action == "updated":
             referenced_hashes.add(file_path.file_id)
             to_update.append(file_path)
+        elif action == "moved":
+            to_move.append(file_path)
+            changed_folders.add(os.path.dirname(file_path.old_path))
+            changed_folders.add(file_path.folder)
         elif action == "deleted":
             to_delete.append(file_path.path)
+            changed_folders.add(os.path.dirname(file_path.path))
+
+    released_hashes = set(models.FilePath.objects.filter(
+        path__in=[file_path.path for file_path in to_update] + to_delete
+    ).values_list("file_id", flat=True))
 
     # Ensure all referenced File objects exist
     existing_hashes = models.File.objects.filter(
         hash__in=referenced_hashes
     ).values_list("hash", flat=True)
-    referenced_hashes.difference_update(existing_hashes)
     models.File.objects.bulk_create(
-        [models.File(hash=hash) for hash in referenced_hashes]
+        [
+            models.File(hash=hash)
+            for hash in referenced_hashes.difference(existing_hashes)
+        ],
+        batch_size=SCAN_BATCH_SIZE,
     )
-    del existing_hashes
-    del referenced_hashes
 
     # FilePath Create, Update, Delete
     if to_create:
-        models.FilePath.objects.bulk_create(to_create)
+        models.FilePath.objects.bulk_create(to_create, batch_size=SCAN_BATCH_SIZE)
     if to_update:
-        models.FilePath.objects.bulk_update(to_update, ["file", "st_mtime_ns"])
+        models.FilePath.objects.bulk_update(to_update, [
+            "file", "st_mtime_ns", "st_size", "st_dev", "st_ino",
+        ], batch_size=SCAN_BATCH_SIZE)
+    for file_path in to_move:
+        # Path is the primary key, so it must be changed with an update query
+        models.FilePath.objects.filter(path=file_path.old_path).update(
+            path=file_path.path,
+            folder=file_path.folder,
+            filename=file_path.filename,
+            st_mtime_ns=file_path.st_mtime_ns,
+            st_size=file_path.st_size,
+            st_dev=file_path.st_dev,
+            st_ino=file_path.st_ino,
+        )
     if to_delete:
         models.FilePath.objects.filter(path__in=to_delete).delete()
-    del to_create
-    del to_update
-    del to_delete
-
-    # Remove Files with no FilePath
-    #TODO: At some point we could keep these around in case the images get put
-    #      back. This would preserve tags, comments, etc. pointing to them. We
-    #      might have to hide them in the UI though, or maybe put a warning in
-    #      front of them?
-    models.File.objects.filter(paths__isnull=True).delete()
-
-    # Scan outdated files
-    outdated_files =list(
-        models.File.objects.exclude(scan_version__gte=SCAN_VERSION)
-    )
-    for file_obj in outdated_files:
-        filepath_obj = file_obj.paths.first()
-        scan_file(filepath_obj.abspath, file_obj)
-    models.File.objects.bulk_update(outdated_files, models.File.SCAN_FIELDS)
 
-def scan_file(abspath, file_obj):
+    return referenced_hashes, released_hashes, changed_folders
+
+def _scan_files(file_objs, exiftool_pool, mimetypes=None):
+    """Scan and save a batch of File objects.
+
+    Metadata is extracted in batches by a pool of long-running exiftool
+    processes, since starting exiftool for each file is slow. Files whose hash
+    is in `mimetypes` were read while hashing, so their mimetype is already
+    known.
+    """
+    # Get one path for each file in a single query
+    abspaths = {}
+    with stats.phase("db_read"):
+        for file_path in models.FilePath.objects.filter(
+                file__in=[file_obj.hash for file_obj in file_objs]):
+            abspaths.setdefault(file_path.file_id, file_path.abspath)
+    file_objs = [file_obj for file_obj in file_objs if file_obj.hash in abspaths]
+
+    for file_obj in file_objs:
+        file_obj.mimetype = (mimetypes or {}).get(file_obj.hash)
+        if not file_obj.mimetype:
+            file_obj.mimetype = _get_mimetype(abspaths[file_obj.hash])
+
+    image_abspaths = [
+        abspaths[file_obj.hash]
+        for file_obj in file_objs
+        if file_obj.is_image
+    ]
+    with stats.phase("exiftool"):
+        metadatas = dict(zip(
+            image_abspaths,
+            exiftool_pool.extract_metadata(image_abspaths)
+        ))
+    stats.count("exiftool", files=len(image_abspaths))
+    for file_obj in file_objs:
+        abspath = abspaths[file_obj.hash]
+        scan_file(abspath, file_obj, file_obj.mimetype, metadatas.get(abspath))
+
+    with stats.phase("db_write"):
+        models.File.objects.bulk_update(
+            file_objs,
+            ("name", "mimetype", "scan_version") + models.File.SCAN_FIELDS,
+            batch_size=SCAN_BATCH_SIZE,
+        )
+
+def _scan_stale_paths(stale_paths, exiftool_pool, checkpoint=None):
+    """Save changes from a `StalePaths`, scanning new files as we go.
+
+    Changes are committed in batches, along with the folders walked so far.
+    Returns the hashes of files referenced by created or updated paths, and
+    the hashes of files that might not be referenced anymore.
+    """
+    referenced_hashes = set()
+    released_hashes = set()
+    for batch in batched(stale_paths, SCAN_BATCH_SIZE):
+        # Time spent committing is counted as writing
+        with stats.phase("db_write"), atomic():
+            referenced, released, changed_folders = _save_paths(batch)
+            models.update_folders(changed_folders, stale_paths.folders,
+                                  _folder_exists)
+            _scan_files(
+                list(models.File.objects.filter(hash__in=referenced).exclude(
+                    scan_version__gte=SCAN_VERSION
+                )),
+                exiftool_pool,
+                stale_paths.mimetypes,
+            )
+            if checkpoint is not None:
+                checkpoint.resume_path = stale_paths.resume_path
+                checkpoint.save()
+        stale_paths.mimetypes.clear()
+        stale_paths.folders.clear()
+        referenced_hashes.update(referenced)
+        released_hashes.update(released)
+
+    # Folders walked after the last changed path
+    if stale_paths.folders:
+        with stats.phase("db_write"):
+            models.update_folders(found=stale_paths.folders)
+        stale_paths.folders.clear()
+    return referenced_hashes, released_hashes
+
+def scan_all(jobs=None):
+    """Bring the database up to date with the files in `BASE_DIR`.
+
+    Changes are committed in batches. If a scan is interrupted, the next scan
+    resumes from a checkpoint instead of starting over.
+    """
+    checkpoint = models.ScanCheckpoint.objects.first()
+    if checkpoint is None:
+        checkpoint = models.ScanCheckpoint(resume_path="")
+
+    with stats.phase("scan"), exiftool.ExifToolPool(jobs) as exiftool_pool:
+
+        # Find changed paths, hashing and scanning new files as we go.
+        stale_paths = StalePaths(jobs, checkpoint.resume_path or None)
+        _scan_stale_paths(stale_paths, exiftool_pool, checkpoint)
+
+        with stats.phase("cleanup"), atomic():
+            models.ScanCheckpoint.objects.all().delete()
+
+            # Remove Files with no FilePath
+            #TODO: At some point we could keep these around in case the images
+            #      get put back. This would preserve tags, comments, etc.
+            #      pointing to them. We might have to hide them in the UI
+            #      though, or maybe put a warning in front of them?
+            models.File.objects.filter(paths__isnull=True).delete()
+
+            # Remove empty folders which are gone from the disk
+            models.update_folders(
+                models.Folder.objects.filter(file_count=0)
+                .values_list("path", flat=True),
+                exists=_folder_exists,
+            )
+
+        # Scan remaining outdated files, such as when SCAN_VERSION changes
+        last_hash = ""
+        while True:
+            file_objs = list(models.File.objects.filter(
+                hash__gt=last_hash,
+            ).exclude(
+                scan_version__gte=SCAN_VERSION,
+            ).order_by("hash")[:SCAN_BATCH_SIZE])
+            if not file_objs:
+                break
+            with stats.phase("db_write"), atomic():
+                _scan_files(file_objs, exiftool_pool)
+            last_hash = file_objs[-1].hash
+
+def scan_paths(paths, jobs=None):
+    """Bring the database up to date for only the given paths.
+
+    `paths` are relative to `BASE_DIR`. Folders are scanned recursively.
+    Returns the hashes of files which were created or changed.
+    """
+    paths = [os.path.normpath(path).strip("/") for path in paths]
+    paths = [path for path in paths if path and path != "."]
+    with stats.phase("scan"), exiftool.ExifToolPool(jobs) as exiftool_pool:
+        stale_paths = StalePaths(jobs, subtrees=paths)
+        referenced, released = _scan_stale_paths(stale_paths, exiftool_pool)
+        with stats.phase("cleanup"):
+            for hashes in batched(released, SCAN_BATCH_SIZE):
+                models.File.objects.filter(
+                    hash__in=hashes,
+                    paths__isnull=True,
+                ).delete()
+
+            # Remove empty folders in the subtrees which are gone from the
+            # disk. Others are removed as their last files are.
+            for path in paths:
+                models.update_folders(
+                    models.Folder.objects.filter(
+                        Q(path=path) | Q(path__gte=path+"/", path__lt=path+"0"),
+                        file_count=0,
+                    ).values_list("path", flat=True),
+                    exists=_folder_exists,
+                )
+    return referenced
+
+def scan_file(abspath, file_obj, mimetype=None, metadata=None):
     """Extract data from file at abspath and store it in File file_obj.
 
-    Caller is responsible for actually saving the object.
+    `mimetype` and `metadata`, if given, are used instead of reading them from
+    the file. Caller is responsible for actually saving the object.
     """
     if not file_obj.name:
         file_obj.name = os.path.basename(abspath)
-    file_obj.mimetype = magic.from_file(abspath, mime=True)
+    file_obj.mimetype = mimetype or _get_mimetype(abspath)
     if file_obj.is_image:
-        file_obj.metadata = extract_metadata(abspath)
+        if metadata is None:
+            metadata = extract_metadata(abspath)
+        file_obj.metadata = metadata
 
     # Extract time
     #TODO
 
     file_obj.scan_version = SCAN_VERSION
-    file_obj.save()
 
 def extract_metadata(abspath):
-    ignored_tags = """
-        ExifToolVersion FileName Directory FileSize FileModifyDate
-        FileAccessDate FileInodeChangeDate FilePermissions FileType
-        FileTypeExtension MIMEType
-    """.split()
-    ignore_tag_args = itertools.chain.from_iterable(
-        zip(itertools.repeat("-x"), ignored_tags)
-    )
-    output = subprocess.check_output([
-        "exiftool", abspath,
-        "-j", # JSON format
-    ] + list(ignore_tag_args))
+    with stats.phase("exiftool"):
+        output = subprocess.check_output(["exiftool", abspath] + exiftool.get_args())
+    stats.count("exiftool", files=1)
     data = json.loads(output)[0]
-    data.pop("SourceFile")
-
-    # Remove metadata with binary values
-    binary_keys = []
-    for key, value in data.items():
-        if isinstance(value, str) and value.startswith("(Binary data"):
-            binary_keys.append(key)
-    for key in binary_keys:
-        data.pop(key)
-
-    return data
+    return exiftool.filter_metadata(data)
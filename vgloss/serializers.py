@@ -1,10 +1,15 @@
 from copy import deepcopy
+from collections import defaultdict
 
 from django.db.transaction import atomic
 from rest_framework import serializers
 from rest_framework.exceptions import NotFound
 
-from vgloss import models, actions
+from vgloss import models, actions, tag_index
+from vgloss.utils import batched
+
+# Files whose tags are read in one query. Older SQLite allows 999 parameters.
+TAG_QUERY_BATCH_SIZE = 900
 
 
 class ActionSerializer(serializers.Serializer):
@@ -19,15 +24,41 @@ class ActionSerializer(serializers.Serializer):
             raise serializers.ValidationError("Invalid action type given") from e
         return cls(**data["data"])
 
-class FileSerializer(serializers.ModelSerializer):
-    tags = serializers.ReadOnlyField(source="tag_ids")
-
-    class Meta:
-        model = models.File
-        fields = [
-            "hash", "name", "is_image", "timestamp", "tags",
-            #"size",
-        ]
+# Fields of each file listed by `api.FileListApi`
+FILE_LIST_FIELDS = ["hash", "name", "is_image", "timestamp", "tags"]
+
+_timestamp_field = serializers.DateTimeField()
+
+def serialize_file_list(files, columns=False):
+    """Serialize a list of Files with `FILE_LIST_FIELDS`.
+
+    This is the hot path of listing files, so rather than a serializer, which
+    would query each file's tags and go through a field object per value, the
+    tags of all files are read at once. Only the fields listed need to have
+    been loaded.
+
+    If `columns`, returns a dict with a list of values for each field, in the
+    same order as `files`, which is much smaller to send than a dict per file.
+    """
+    tags = defaultdict(list)
+    for hashes in batched([file.hash for file in files], TAG_QUERY_BATCH_SIZE):
+        for file_hash, tag_id in models.FileTag.objects.filter(
+                file_id__in=hashes).order_by("id").values_list("file_id", "tag_id"):
+            tags[file_hash].append(tag_id)
+
+    to_timestamp = _timestamp_field.to_representation
+    rows = [
+        (file.hash, file.name, file.is_image,
+         to_timestamp(file.timestamp) if file.timestamp is not None else None,
+         tags.get(file.hash, []))
+        for file in files
+    ]
+    if columns:
+        return {
+            field: [row[i] for row in rows]
+            for i, field in enumerate(FILE_LIST_FIELDS)
+        }
+    return [dict(zip(FILE_LIST_FIELDS, row)) for row in rows]
 
 class FileDetailSerializer(serializers.ModelSerializer):
     class Meta:
@@ -36,6 +67,11 @@ class FileDetailSerializer(serializers.ModelSerializer):
             "mimetype", "metadata", "paths",
         ]
 
+class FolderSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.Folder
+        fields = ["path", "parent", "file_count"]
+
 class TagListSerializer(serializers.ListSerializer):
 
     def to_internal_value(self, data):
@@ -107,11 +143,15 @@ class TagListSerializer(serializers.ListSerializer):
                 unseen_tags = models.Tag.objects.exclude(id__in=saved_tag_ids)
                 unseen_tags.delete()
 
+            # Tags may have moved in the tree
+            models.update_tag_ancestors()
+
     def delete(self):
         with atomic():
             tag_ids = [t.get("id") for t in self.initial_data]
             tags_qs = models.Tag.objects.filter(id__in=tag_ids)
             tags_qs.delete()
+            models.update_tag_ancestors()
 
 class TagSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(required=False)
@@ -123,19 +163,23 @@ class TagSerializer(serializers.ModelSerializer):
 
 class FileTagListSerializer(serializers.ListSerializer):
 
+    def _pairs(self):
+        return [(filetag["file_hash"], filetag["tag_id"])
+                for filetag in self.validated_data]
+
+    @atomic
     def save(self):
-        for filetag in self.validated_data:
-            models.FileTag.objects.get_or_create(
-                file_id=filetag["file_hash"],
-                tag_id=filetag["tag_id"],
-            )
+        version = tag_index.table_version()
+        for file_hash, tag_id in self._pairs():
+            models.FileTag.objects.get_or_create(file_id=file_hash, tag_id=tag_id)
+        tag_index.index.changed(version, added=self._pairs())
 
+    @atomic
     def delete(self):
-        for filetag in self.validated_data:
-            models.FileTag.objects.filter(
-                file_id=filetag["file_hash"],
-                tag_id=filetag["tag_id"],
-            ).delete()
+        version = tag_index.table_version()
+        for file_hash, tag_id in self._pairs():
+            models.FileTag.objects.filter(file_id=file_hash, tag_id=tag_id).delete()
+        tag_index.index.changed(version, removed=self._pairs())
 
 class FileTagSerializer(serializers.ModelSerializer):
     file = serializers.CharField(source="file_hash")
@@ -21,6 +21,27 @@ except KeyError:
 DATA_DIR = os.path.join(BASE_DIR, ".vgloss")
 THUMBNAIL_DIR = os.path.join(DATA_DIR, "thumbnails")
 
+# How thumbnails are generated: "pyvips", "vipsthumbnail" or "pillow". "auto"
+# uses the first of those which is installed. See vgloss/thumbnail_backends.py
+THUMBNAIL_BACKEND = os.environ.get("VGLOSS_THUMBNAIL_BACKEND", "auto")
+
+# Have the web server in front of vgloss send original files, rather than
+# streaming them through Django: "x-sendfile" (Apache, lighttpd) or
+# "x-accel-redirect" (nginx). With nginx, SENDFILE_URL_PREFIX must be an
+# internal location which serves BASE_DIR.
+SENDFILE = os.environ.get("VGLOSS_SENDFILE", "")
+SENDFILE_URL_PREFIX = os.environ.get("VGLOSS_SENDFILE_URL_PREFIX", "/_vgloss_base/")
+
+# How thumbnails are stored: "pack" appends them to a few large files, "loose"
+# keeps each in its own file. See vgloss/thumbnail_store.py
+THUMBNAIL_STORE = os.environ.get("VGLOSS_THUMBNAIL_STORE", "pack")
+
+# Thumbnails are generated to fit in boxes of each of these sizes, in pixels,
+# and saved in each of these formats: "jpeg", "webp" or "avif". The first
+# format is used for clients which don't accept the others.
+THUMBNAIL_SIZES = [250, 500, 1280, 2560]
+THUMBNAIL_FORMATS = ["jpeg", "webp"]
+
 VGLOSS_CODE_DIR = os.path.dirname(__file__)
 
 # Quick-start development settings - unsuitable for production
@@ -0,0 +1,187 @@
+"""Timing and counters for the phases of a scan.
+
+Code marks what it's doing with `phase()` and `count()`. These do nothing
+unless a `record()` block is active, which collects per-phase:
+
+  * seconds: time spent in the phase, excluding time in phases nested inside
+    it. Phases run concurrently in worker threads (such as hashing) are summed
+    across threads, so the total can exceed the wall time.
+  * files and bytes: counted by the code in the phase.
+  * queries: SQL queries run by the main thread while in the phase.
+"""
+import sys
+import time
+import threading
+import collections
+from contextlib import contextmanager
+
+from django.db import connection
+
+# Seconds between updates of the progress line
+PROGRESS_INTERVAL = 0.5
+
+_recorder = None
+
+
+class PhaseStats:
+    __slots__ = ("seconds", "files", "bytes", "queries")
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.files = 0
+        self.bytes = 0
+        self.queries = 0
+
+    def to_dict(self):
+        return {
+            "seconds": round(self.seconds, 6),
+            "files": self.files,
+            "bytes": self.bytes,
+            "queries": self.queries,
+            "files_per_second":
+                round(self.files / self.seconds, 2) if self.seconds else None,
+            "bytes_per_second":
+                round(self.bytes / self.seconds) if self.seconds else None,
+        }
+
+
+class Recorder:
+    """Collects `PhaseStats` for each phase name."""
+
+    def __init__(self):
+        self.phases = collections.defaultdict(PhaseStats)
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _charge(self, name, seconds):
+        with self._lock:
+            self.phases[name].seconds += seconds
+
+    def enter(self, name):
+        stack = self._stack()
+        now = time.perf_counter()
+        if stack:
+            # Pause the enclosing phase
+            self._charge(stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+
+    def exit(self):
+        stack = self._stack()
+        now = time.perf_counter()
+        name, start = stack.pop()
+        self._charge(name, now - start)
+        if stack:
+            stack[-1][1] = now
+
+    def count(self, name, files=0, nbytes=0):
+        with self._lock:
+            phase = self.phases[name]
+            phase.files += files
+            phase.bytes += nbytes
+
+    def _count_query(self, execute, sql, params, many, context):
+        stack = self._stack()
+        name = stack[-1][0] if stack else "other"
+        with self._lock:
+            self.phases[name].queries += 1
+        return execute(sql, params, many, context)
+
+    def elapsed(self):
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    def report(self):
+        """Return the collected stats as a JSON-serializable dict."""
+        with self._lock:
+            phases = {name: p.to_dict() for name, p in self.phases.items()}
+        return {
+            "seconds": round(self.elapsed(), 6),
+            "queries": sum(p["queries"] for p in phases.values()),
+            "phases": phases,
+        }
+
+    def progress_line(self):
+        with self._lock:
+            p = {name: (s.files, s.bytes) for name, s in self.phases.items()}
+            queries = sum(s.queries for s in self.phases.values())
+        elapsed = self.elapsed()
+        hashed, hashed_bytes = p.get("hash", (0, 0))
+        return (
+            f"{elapsed:7.1f}s  "
+            f"walked {p.get('walk', (0,))[0]}  "
+            f"hashed {hashed} ({hashed_bytes / 2**20:.0f} MiB, "
+            f"{hashed_bytes / 2**20 / elapsed if elapsed else 0:.1f} MiB/s)  "
+            f"metadata {p.get('exiftool', (0,))[0]}  "
+            f"thumbnails {p.get('thumbnail', (0,))[0]}  "
+            f"queries {queries}"
+        )
+
+
+@contextmanager
+def phase(name):
+    """Attribute time spent in this block to the phase `name`."""
+    recorder = _recorder
+    if recorder is None:
+        yield
+        return
+    recorder.enter(name)
+    try:
+        yield
+    finally:
+        recorder.exit()
+
+def count(name, files=0, nbytes=0):
+    """Add to the files and bytes counted for phase `name`."""
+    recorder = _recorder
+    if recorder is not None:
+        recorder.count(name, files, nbytes)
+
+def timed_iter(name, iterable):
+    """Yield from `iterable`, timing how long each item takes to produce and
+    counting each as a file of phase `name`."""
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        count(name, files=1)
+        yield item
+
+def _print_progress(recorder, stop, file):
+    # "\033[K" clears anything left over from a longer previous line
+    while not stop.wait(PROGRESS_INTERVAL):
+        print("\r" + recorder.progress_line() + "\033[K", end="", file=file,
+              flush=True)
+    print("\r" + recorder.progress_line() + "\033[K", file=file, flush=True)
+
+@contextmanager
+def record(progress=False, file=sys.stderr):
+    """Collect stats while in this block, yielding the `Recorder`.
+
+    If `progress` is true, a progress line is kept updated on `file`.
+    """
+    global _recorder
+    recorder = _recorder = Recorder()
+    stop = threading.Event()
+    if progress:
+        progress_thread = threading.Thread(
+            target=_print_progress, args=(recorder, stop, file), daemon=True
+        )
+        progress_thread.start()
+    try:
+        with connection.execute_wrapper(recorder._count_query):
+            yield recorder
+    finally:
+        recorder.end_time = time.perf_counter()
+        _recorder = None
+        if progress:
+            stop.set()
+            progress_thread.join()
@@ -0,0 +1,231 @@
+"""Matching files against tag expressions from memory.
+
+Each tag has a bitmap of the files tagged with it: a Python int with the bit
+set for each file's ordinal, a number given to each tagged file as the index
+learns of it. Ints can be any length and their bitwise operations run in C,
+so an expression like "1&2|!3" over hundreds of thousands of files is a few
+bitwise operations taking microseconds, rather than a join over FileTag for
+each tag.
+
+The index is built from the database when it's first used, and changes to
+FileTags are applied to it as they're committed. Other processes serving the
+same gallery change FileTags too, so before each use the index checks the
+count of changes to the FileTag and TagAncestor tables, kept by triggers in
+the database, and is built again if it's changed in ways it doesn't know
+about.
+"""
+import re
+import threading
+from collections import defaultdict
+
+from django.db.transaction import on_commit
+
+from . import models
+
+_TOKEN_RE = re.compile(r"\s*(?:(\d+)|(.))")
+
+
+class TagExpressionError(ValueError):
+    pass
+
+
+def table_version():
+    """Something which changes whenever a FileTag or TagAncestor is created,
+    changed or deleted."""
+    count = models.TagChangeCounter.objects.values_list("count", flat=True).first()
+    return count or 0
+
+def _bitmap(ordinals):
+    data = bytearray(max(ordinals) // 8 + 1)
+    for ordinal in ordinals:
+        data[ordinal >> 3] |= 1 << (ordinal & 7)
+    return int.from_bytes(data, "little")
+
+# A set of files is `(bits, negated)`: the files with those bits, or every
+# file except them if `negated`. That way NOT never needs a bitmap of all
+# files, including ones added since the index was built.
+
+def _and(a, b):
+    (x, x_negated), (y, y_negated) = a, b
+    if x_negated and y_negated:
+        return x | y, True
+    if x_negated:
+        return y & ~x, False
+    if y_negated:
+        return x & ~y, False
+    return x & y, False
+
+def _or(a, b):
+    (x, x_negated), (y, y_negated) = a, b
+    if x_negated and y_negated:
+        return x & y, True
+    if x_negated:
+        return x & ~y, True
+    if y_negated:
+        return y & ~x, True
+    return x | y, False
+
+
+class _Parser:
+    """Evaluates a tag expression, where "!" is NOT, "&" is AND, and "|" is
+    OR, in order of precedence. "," is OR too, and parentheses group."""
+
+    def __init__(self, expression, tag_bits):
+        self.tokens = []
+        for match in _TOKEN_RE.finditer(expression):
+            number, symbol = match.groups()
+            if number is not None:
+                self.tokens.append(int(number))
+            elif not symbol.isspace():
+                self.tokens.append(symbol)
+        self.position = 0
+        self.tag_bits = tag_bits
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        result = self.parse_or()
+        if self.peek() is not None:
+            raise TagExpressionError(f"Unexpected {self.peek()!r} in tag expression")
+        return result
+
+    def parse_or(self):
+        result = self.parse_and()
+        while self.peek() in ("|", ","):
+            self.take()
+            result = _or(result, self.parse_and())
+        return result
+
+    def parse_and(self):
+        result = self.parse_not()
+        while self.peek() == "&":
+            self.take()
+            result = _and(result, self.parse_not())
+        return result
+
+    def parse_not(self):
+        token = self.take()
+        if token == "!":
+            bits, negated = self.parse_not()
+            return bits, not negated
+        if token == "(":
+            result = self.parse_or()
+            if self.take() != ")":
+                raise TagExpressionError("Missing ) in tag expression")
+            return result
+        if isinstance(token, int):
+            return self.tag_bits(token), False
+        if token is None:
+            raise TagExpressionError("Tag expression ended early")
+        raise TagExpressionError(f"Unexpected {token!r} in tag expression")
+
+
+class TagIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._version = None
+        self._ordinals = {}
+        self._hashes = []
+        self._bitmaps = {}
+        self._subtrees = {}
+
+    def refresh(self):
+        """Build the index again if FileTags or tags have changed since it
+        was built, other than by changes it was told about."""
+        version = table_version()
+        with self._lock:
+            if version != self._version:
+                self._build(version)
+
+    def _build(self, version):
+        ordinals = {}
+        tag_ordinals = defaultdict(list)
+        for file_hash, tag_id in models.FileTag.objects.values_list(
+            "file_id", "tag_id"
+        ).iterator():
+            ordinal = ordinals.setdefault(file_hash, len(ordinals))
+            tag_ordinals[tag_id].append(ordinal)
+
+        subtrees = defaultdict(list)
+        for ancestor_id, tag_id in models.TagAncestor.objects.values_list(
+            "ancestor_id", "tag_id"
+        ).iterator():
+            subtrees[ancestor_id].append(tag_id)
+
+        self._version = version
+        self._ordinals = ordinals
+        self._hashes = list(ordinals)
+        self._bitmaps = {tag: _bitmap(o) for tag, o in tag_ordinals.items()}
+        self._subtrees = dict(subtrees)
+
+    def _tag_bits(self, tag_id):
+        bits = 0
+        for tag in self._subtrees.get(tag_id, [tag_id]):
+            bits |= self._bitmaps.get(tag, 0)
+        return bits
+
+    def _hashes_of(self, bits):
+        # Reversed, so each character's index is an ordinal
+        digits = bin(bits)[:1:-1]
+        hashes = set()
+        ordinal = digits.find("1")
+        while ordinal != -1:
+            hashes.add(self._hashes[ordinal])
+            ordinal = digits.find("1", ordinal + 1)
+        return hashes
+
+    def match(self, expression):
+        """Return `(hashes, negated)`, where the files matching tag
+        `expression` are those with `hashes`, or if `negated`, every file
+        except those. A tag matches files with it or any tag under it.
+
+        Raises TagExpressionError if the expression can't be parsed.
+        """
+        self.refresh()
+        with self._lock:
+            bits, negated = _Parser(expression, self._tag_bits).parse()
+            return self._hashes_of(bits), negated
+
+    def changed(self, version_before, added=(), removed=()):
+        """Apply FileTags `added` and `removed` in the current transaction,
+        as `(file hash, tag ID)` pairs, once it's committed.
+
+        `version_before` is `table_version()` from before the changes, in the
+        same transaction. If the index wasn't up to date with it, it's left
+        to be built again instead.
+        """
+        version_after = table_version()
+        added = list(added)
+        removed = list(removed)
+
+        def apply():
+            with self._lock:
+                if self._version != version_before:
+                    return
+                for file_hash, tag_id in added:
+                    ordinal = self._ordinals.get(file_hash)
+                    if ordinal is None:
+                        ordinal = self._ordinals[file_hash] = len(self._hashes)
+                        self._hashes.append(file_hash)
+                    self._bitmaps[tag_id] = self._bitmaps.get(tag_id, 0) | 1 << ordinal
+                for file_hash, tag_id in removed:
+                    ordinal = self._ordinals.get(file_hash)
+                    if ordinal is not None and tag_id in self._bitmaps:
+                        self._bitmaps[tag_id] &= ~(1 << ordinal)
+                self._version = version_after
+        on_commit(apply)
+
+
+index = TagIndex()
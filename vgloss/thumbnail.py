@@ -1,35 +1,458 @@
 import os
-import subprocess
-
-from . import models
-
-THUMBNAIL_VERSION = 0
-
-def generate_all_thumbnails():
-    updated_files = []
-    for file in models.File.objects.iterator():
-        if not file.is_image:
-            continue
-
-        thumbnail_path = file.get_thumbnail_path(_absent_ok=True)
-        if not os.path.exists(thumbnail_path) or file.thumbnail_version is None or file.thumbnail_version < THUMBNAIL_VERSION:
-            generate_thumbnail(file, thumbnail_path)
-            file.thumbnail_version = THUMBNAIL_VERSION
-            updated_files.append(file)
-    models.File.objects.bulk_update(updated_files, ["thumbnail_version"])
-
-def generate_thumbnail(file, out_path):
-    file_path = file.paths.first()
-    if not file_path:
-        # No actual file to back this, so we can't read the thumbnail!
-        return
-
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-
-    subprocess.check_call([
-        "vipsthumbnail", file_path.abspath,
-        "-o", out_path+"[Q=50,optimize_coding,interlace,strip]",
-        "--size", "250",
-        "--rotate",
-        "--eprofile", "/usr/share/color/icc/sRGB.icc",
-    ])
+import sys
+import json
+import queue
+import shutil
+import tempfile
+import itertools
+import functools
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Max, Min
+
+from . import models, stats, thumbnail_backends, thumbnail_store
+from .preview import get_image_size, thumbnails_from_preview
+from .utils import imap_bounded, batched, default_jobs
+
+THUMBNAIL_VERSION = 1
+
+# Number of Files read from the database at a time when looking for thumbnails
+# to generate.
+DB_PAGE_SIZE = 1000
+
+# Number of generated thumbnails whose `thumbnail_version` is saved at once.
+# Progress is kept if thumbnail generation is interrupted.
+THUMBNAIL_BATCH_SIZE = 100
+
+# Priorities of thumbnails generated by `ThumbnailScheduler`, lower first
+ON_DEMAND = 0
+BACKLOG = 1
+_STOP = 2
+
+# Most thumbnails requested on demand which can be waiting at once. Past this,
+# requests fail instead of piling up.
+MAX_QUEUED = 256
+# Most backlog thumbnails queued at once, so on-demand requests never wait
+# behind more than this many.
+MAX_BACKLOG_QUEUED = 16
+
+def generate_all_thumbnails(jobs=None):
+    generate_thumbnails(models.File.objects.all(), jobs)
+
+def _is_stale(file):
+    if file.thumbnail_version is None or file.thumbnail_version < THUMBNAIL_VERSION:
+        return True
+    thumbnails = file.thumbnails
+    return (
+        thumbnails["requested_sizes"] != sorted(settings.THUMBNAIL_SIZES) or
+        thumbnails["formats"] != settings.THUMBNAIL_FORMATS
+    )
+
+def needs_thumbnails(file):
+    """Does `file` need thumbnails generated?
+
+    Like `generate_thumbnails()` checks, but for a single File.
+    """
+    if not file.is_image:
+        return False
+    return _is_stale(file) or file.get_thumbnail_key() not in get_store()
+
+def needs_bigger_thumbnails(file, size):
+    """Would a thumbnail of `file` at least `size` big be made, if its sizes
+    left out because its preview was too small were generated?"""
+    thumbnails = file.thumbnails
+    return bool(
+        size is not None and thumbnails.get("pending_sizes") and
+        max(thumbnails["sizes"]) < size
+    )
+
+def _get_stale_thumbnails(files):
+    """Yield `(file, abspath, size)` for Files in `files` which need
+    thumbnails generated.
+
+    Files are read a page at a time, each page in a single query which also
+    picks one path for each file. Only the fields needed are loaded.
+    """
+    existing = get_store().keys()
+    qs = files.filter(
+        mimetype__startswith="image/",
+    ).order_by("hash").annotate(
+        path=Min("paths__path"),
+        size=Max("paths__st_size"),
+    ).only("hash", "thumbnail_version", "thumbnails_json", "metadata_json")
+
+    last_hash = ""
+    while True:
+        with stats.phase("db_read"):
+            page = list(qs.filter(hash__gt=last_hash)[:DB_PAGE_SIZE])
+        if not page:
+            return
+        for file in page:
+            if file.path is None:
+                # No actual file to back this, so we can't read the thumbnail!
+                continue
+            if _is_stale(file) or file.get_thumbnail_key() not in existing:
+                yield file, os.path.join(settings.BASE_DIR, file.path), file.size
+        last_hash = page[-1].hash
+
+def _store_thumbnails(file, sizes, formats, generate):
+    """Call `generate(out_paths)` to write thumbnails of `file`, like
+    `generate_thumbnail()`, and put the sizes it returns in the store.
+
+    Thumbnails are written to a staging directory, then handed to the store.
+    """
+    store = get_store()
+    staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=settings.THUMBNAIL_DIR)
+    try:
+        out_paths = {
+            (thumb_size, format): os.path.join(
+                staging_dir, file.get_thumbnail_key(thumb_size, format)
+            )
+            for thumb_size in sizes
+            for format in formats
+        }
+        with stats.phase("thumbnail"):
+            written = generate(out_paths)
+        with stats.phase("store"):
+            for thumb_size in written:
+                for format in formats:
+                    store.put(file.get_thumbnail_key(thumb_size, format),
+                              out_paths[(thumb_size, format)])
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    return written
+
+def _pending_sizes(sizes, metadata):
+    """Return the sizes bigger than `sizes` which the image is big enough
+    for, going by its size in `metadata`. If it isn't known there are none,
+    since the image may well be smaller than the next size."""
+    image_size = get_image_size(metadata) if metadata else None
+    if image_size is None:
+        return []
+    return sorted(
+        size for size in settings.THUMBNAIL_SIZES
+        if max(sizes) < size <= max(image_size)
+    )
+
+def _generate_stale_thumbnail(stale):
+    file, abspath, size = stale
+    store = get_store()
+    metadata = json.loads(file.metadata_json) if file.metadata_json else None
+    try:
+        sizes = _store_thumbnails(
+            file, settings.THUMBNAIL_SIZES, settings.THUMBNAIL_FORMATS,
+            lambda out_paths: generate_thumbnail(abspath, out_paths, metadata),
+        )
+    except Exception as e:
+        # Leave thumbnail_version alone so it's retried next time
+        print(f"Could not generate thumbnail for {abspath}: {e}",
+              file=sys.stderr)
+        return None
+    stats.count("thumbnail", files=1, nbytes=size or 0)
+
+    if file.thumbnail_version == 0:
+        # Before version 1 there was one size, named differently
+        store.delete(file.hash+".jpg")
+    # Remove sizes which were generated before, but aren't anymore
+    for old_size in set(file.thumbnails["sizes"]).difference(sizes):
+        for format in thumbnail_backends.FORMATS:
+            store.delete(file.get_thumbnail_key(old_size, format))
+    return {
+        "sizes": sizes,
+        "formats": settings.THUMBNAIL_FORMATS,
+        "requested_sizes": sorted(settings.THUMBNAIL_SIZES),
+        "pending_sizes": _pending_sizes(sizes, metadata),
+    }
+
+def _generate_bigger_thumbnails(stale):
+    """Generate the sizes of a File which its preview was too small for from
+    the whole image, and return its new `File.thumbnails`."""
+    file, abspath, size = stale
+    thumbnails = file.thumbnails
+    try:
+        sizes = _store_thumbnails(
+            file, thumbnails["pending_sizes"], thumbnails["formats"],
+            lambda out_paths: get_backend()(abspath, out_paths),
+        )
+    except Exception as e:
+        # Like RAW files, which only the preview can be read from. Retrying
+        # wouldn't help, so the sizes from the preview are kept.
+        print(f"Only made thumbnails up to {max(thumbnails['sizes'])} for "
+              f"{abspath}: {e}", file=sys.stderr)
+        sizes = []
+    return dict(
+        thumbnails,
+        sizes=sorted(thumbnails["sizes"] + sizes),
+        pending_sizes=[],
+    )
+
+def _save_thumbnails(file, thumbnails):
+    file.thumbnails = thumbnails
+    file.thumbnail_version = THUMBNAIL_VERSION
+
+def generate_thumbnails(files, jobs=None):
+    """Generate missing or outdated thumbnails for a queryset of Files.
+
+    Up to `jobs` files have thumbnails generated at once.
+    """
+    os.makedirs(settings.THUMBNAIL_DIR, exist_ok=True)
+    generated = imap_bounded(
+        _generate_stale_thumbnail, _get_stale_thumbnails(files), jobs
+    )
+    for batch in batched(generated, THUMBNAIL_BATCH_SIZE):
+        updated = []
+        for (file, abspath, size), thumbnails in batch:
+            if thumbnails is not None:
+                _save_thumbnails(file, thumbnails)
+                updated.append(file)
+        with stats.phase("db_write"):
+            models.File.objects.bulk_update(
+                updated, ["thumbnail_version", "thumbnails_json"]
+            )
+
+def get_backend():
+    """Return the thumbnail backend function chosen by settings."""
+    name = settings.THUMBNAIL_BACKEND
+    if name == "auto":
+        name = _detect_backend()
+    try:
+        return thumbnail_backends.BACKENDS[name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            f"Unknown THUMBNAIL_BACKEND {name!r}, expected one of: auto, " +
+            ", ".join(thumbnail_backends.BACKENDS)
+        )
+
+@functools.lru_cache()
+def _detect_backend():
+    return thumbnail_backends.detect_backend()
+
+def get_store():
+    """Return the thumbnail store chosen by settings."""
+    name = settings.THUMBNAIL_STORE
+    if name not in thumbnail_store.STORES:
+        raise ImproperlyConfigured(
+            f"Unknown THUMBNAIL_STORE {name!r}, expected one of: " +
+            ", ".join(thumbnail_store.STORES)
+        )
+    return _get_store(name, settings.THUMBNAIL_DIR)
+
+@functools.lru_cache()
+def _get_store(name, root):
+    # One instance per process, which keeps its memory maps between requests
+    return thumbnail_store.STORES[name](root)
+
+def compact_thumbnails():
+    """Compact the thumbnail store, dropping thumbnails of Files which
+    don't exist anymore or no longer have them."""
+    live = set()
+    files = models.File.objects.filter(thumbnails_json__isnull=False)
+    for file in files.only("hash", "thumbnails_json").iterator():
+        thumbnails = file.thumbnails
+        for size in thumbnails["sizes"]:
+            for format in thumbnails["formats"]:
+                live.add(file.get_thumbnail_key(size, format))
+    get_store().compact(live)
+
+def generate_thumbnail(abspath, out_paths, metadata=None):
+    """Write thumbnails of the image at `abspath` and return the sizes written.
+
+    `out_paths` maps `(size, format)` to the path to write to. If the file's
+    exiftool `metadata` is given and shows a large enough embedded preview,
+    thumbnails are made from that instead of decoding the whole image, and
+    sizes bigger than the preview are skipped. Those are only made from the
+    whole image once they're requested, see `needs_bigger_thumbnails()`.
+    """
+    with stats.phase("preview"):
+        sizes = thumbnails_from_preview(abspath, metadata, out_paths)
+    if sizes is not None:
+        stats.count("preview", files=1)
+        return sizes
+    return get_backend()(abspath, out_paths)
+
+
+class ThumbnailScheduler:
+    """Generates thumbnails in a pool of worker threads, for the web server.
+
+    Thumbnails requested with `generate()` are made on demand, ahead of the
+    backlog queued by `queue_backlog()`, so what the user is looking at shows
+    up first. A File requested more than once is only generated once, with
+    every request waiting on the same result.
+
+    Sizes of a File left out because its preview was too small are generated
+    by a separate request with `bigger`, since it means decoding the whole
+    image.
+    """
+
+    def __init__(self, max_queued=MAX_QUEUED,
+                 max_backlog_queued=MAX_BACKLOG_QUEUED):
+        self._queue = queue.PriorityQueue(max_queued + max_backlog_queued)
+        self._max_queued = max_queued
+        self._backlog_slots = threading.Semaphore(max_backlog_queued)
+        self._futures = {}  # (Hash, bigger) -> Future for each queued File
+        self._lock = threading.Lock()
+        self._counter = itertools.count()  # First in, first out per priority
+        self._threads = []
+
+    def start(self, jobs=None):
+        """Start the worker threads, if they aren't running already."""
+        with self._lock:
+            if self._threads:
+                return
+            os.makedirs(settings.THUMBNAIL_DIR, exist_ok=True)
+            for i in range(jobs or default_jobs()):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """Stop the worker threads once everything queued is done."""
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+        for thread in threads:
+            self._queue.put((_STOP, next(self._counter), None, False))
+        for thread in threads:
+            thread.join()
+
+    def submit(self, file, priority=ON_DEMAND, bigger=False):
+        """Queue thumbnails of `file` to be generated, or if `bigger`, the
+        sizes its preview was too small for.
+
+        Returns a Future for the new `File.thumbnails`, or None if `file` has
+        no path to read it from. Raises `queue.Full` if too many on-demand
+        thumbnails are waiting. Blocks if too much of the backlog is queued.
+        """
+        file_path = file.paths.order_by("path").first()
+        if file_path is None:
+            return None
+        return self._submit(
+            (file, file_path.abspath, file_path.st_size), priority, bigger
+        )
+
+    def _submit(self, stale, priority, bigger=False):
+        file = stale[0]
+        if priority == BACKLOG:
+            self._backlog_slots.acquire()
+        with self._lock:
+            future = self._futures.get((file.hash, bigger))
+            if future is not None and (priority == BACKLOG or future.running()):
+                if priority == BACKLOG:
+                    self._backlog_slots.release()
+                return future
+            if priority == ON_DEMAND and self._queue.qsize() >= self._max_queued:
+                raise queue.Full()
+            if future is None:
+                future = self._futures[(file.hash, bigger)] = Future()
+            # If it's already queued as backlog, it's queued again ahead of
+            # that. Whichever is taken off the queue first is generated.
+            self._queue.put_nowait((priority, next(self._counter), stale, bigger))
+        return future
+
+    async def generate(self, file, timeout=None, bigger=False):
+        """Generate thumbnails of `file` on demand, or if `bigger`, the sizes
+        its preview was too small for, and return `File.thumbnails`, or None
+        if they couldn't be generated.
+
+        Waits on the event loop rather than blocking a thread. Raises
+        `queue.Full` if too many are waiting already, or
+        `asyncio.TimeoutError` after `timeout` seconds.
+        """
+        self.start()
+        future = await sync_to_async(self.submit, thread_sensitive=True)(
+            file, bigger=bigger
+        )
+        if future is None:
+            return None
+        # Shielded, so timing out doesn't cancel it for everyone else waiting
+        return await asyncio.wait_for(
+            asyncio.shield(asyncio.wrap_future(future)), timeout
+        )
+
+    async def generate_many(self, files, timeout=None):
+        """Generate thumbnails of several Files on demand, at once.
+
+        Returns `{hash: File.thumbnails}` for those generated within
+        `timeout` seconds in all. Any that weren't are left out, or are None
+        if they couldn't be generated.
+        """
+        self.start()
+        futures = await sync_to_async(self._submit_many, thread_sensitive=True)(files)
+        if not futures:
+            return {}
+        waiting = {asyncio.wrap_future(future): hash for hash, future in futures.items()}
+        done, _ = await asyncio.wait(waiting, timeout=timeout)
+        return {waiting[future]: future.result() for future in done}
+
+    def _submit_many(self, files):
+        # The first path of each file, in one query
+        file_paths = {}
+        for file_path in models.FilePath.objects.filter(
+            file__in=[file.hash for file in files]
+        ).order_by("path"):
+            file_paths.setdefault(file_path.file_id, file_path)
+
+        futures = {}
+        for file in files:
+            file_path = file_paths.get(file.hash)
+            if file_path is None:
+                continue
+            try:
+                futures[file.hash] = self._submit(
+                    (file, file_path.abspath, file_path.st_size), ON_DEMAND
+                )
+            except queue.Full:
+                break
+        return futures
+
+    def queue_backlog(self, files):
+        """Generate thumbnails of a queryset of Files in the background,
+        whenever nothing is requested on demand."""
+        self.start()
+        def queue_all():
+            for stale in _get_stale_thumbnails(files):
+                self._submit(stale, BACKLOG)
+        threading.Thread(target=queue_all, daemon=True).start()
+
+    def _work(self):
+        while True:
+            priority, _, stale, bigger = self._queue.get()
+            if priority == _STOP:
+                return
+            if priority == BACKLOG:
+                self._backlog_slots.release()
+            file = stale[0]
+            key = (file.hash, bigger)
+            with self._lock:
+                future = self._futures.get(key)
+                if future is None or future.running() or future.done():
+                    # Queued more than once and already taken care of
+                    continue
+                future.set_running_or_notify_cancel()
+
+            try:
+                if bigger:
+                    thumbnails = _generate_bigger_thumbnails(stale)
+                else:
+                    thumbnails = _generate_stale_thumbnail(stale)
+                if thumbnails is not None:
+                    _save_thumbnails(file, thumbnails)
+                    models.File.objects.filter(hash=file.hash).update(
+                        thumbnail_version=file.thumbnail_version,
+                        thumbnails_json=file.thumbnails_json,
+                    )
+            except Exception as e:
+                with self._lock:
+                    del self._futures[key]
+                future.set_exception(e)
+            else:
+                with self._lock:
+                    del self._futures[key]
+                future.set_result(thumbnails)
+
+scheduler = ThumbnailScheduler()
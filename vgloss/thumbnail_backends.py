@@ -0,0 +1,179 @@
+"""Ways of generating thumbnail images.
+
+Each backend is a function `(abspath, out_paths)` which writes thumbnails of
+the image at `abspath`. `out_paths` maps `(size, format)` to the path to write
+that thumbnail to, and the sizes which were written are returned. Sizes bigger
+than the image itself are skipped, except for the smallest, which is always
+written.
+
+Thumbnails fit in a `size`x`size` box, are rotated according to their EXIF
+orientation, converted to sRGB and have all metadata stripped. Backends raise
+an exception if the image can't be read.
+"""
+import io
+import os
+import shutil
+import subprocess
+
+from PIL import Image, ImageCms, ImageOps
+
+# Formats thumbnails can be saved in, with their file extension and MIME type
+FORMATS = {
+    "jpeg": ("jpg", "image/jpeg"),
+    "webp": ("webp", "image/webp"),
+    "avif": ("avif", "image/avif"),
+}
+
+QUALITY = {
+    "jpeg": 50,
+    "webp": 50,
+    "avif": 45,
+}
+
+def get_sizes(width, height, sizes):
+    """Return which of `sizes` to generate for a `width`x`height` image, in
+    decreasing order."""
+    smallest = min(sizes)
+    return sorted(
+        (size for size in sizes if size == smallest or size <= max(width, height)),
+        reverse=True,
+    )
+
+def _group_by_size(out_paths):
+    """Return `{size: {format: path}}` from `out_paths`."""
+    by_size = {}
+    for (size, format), path in out_paths.items():
+        by_size.setdefault(size, {})[format] = path
+    return by_size
+
+def vipsthumbnail(abspath, out_paths):
+    """Run the vipsthumbnail command. Simple, but pays for process startup
+    for every thumbnail."""
+    by_size = _group_by_size(out_paths)
+    try:
+        with Image.open(abspath) as image:
+            sizes = get_sizes(*image.size, by_size)
+    except OSError:
+        # Pillow can't read everything libvips can
+        sizes = [min(by_size)]
+
+    save_options = {
+        "jpeg": f"[Q={QUALITY['jpeg']},optimize_coding,interlace,strip]",
+        "webp": f"[Q={QUALITY['webp']},strip]",
+        "avif": f"[Q={QUALITY['avif']},compression=av1,strip]",
+    }
+    for size in sizes:
+        for format, out_path in by_size[size].items():
+            subprocess.check_call([
+                "vipsthumbnail", abspath,
+                "-o", out_path+save_options[format],
+                "--size", str(size),
+                "--rotate",
+                "--eprofile", "/usr/share/color/icc/sRGB.icc",
+            ], env=dict(os.environ, VIPS_CONCURRENCY="1"))  # We parallelize per image
+    return sorted(sizes)
+
+def pyvips(abspath, out_paths):
+    """Use libvips in-process. Fastest, but needs libvips to be installed."""
+    import pyvips
+    by_size = _group_by_size(out_paths)
+    header = pyvips.Image.new_from_file(abspath)
+    sizes = get_sizes(header.width, header.height, by_size)
+
+    save_options = {
+        "jpeg": dict(Q=QUALITY["jpeg"], optimize_coding=True, interlace=True),
+        "webp": dict(Q=QUALITY["webp"]),
+        "avif": dict(Q=QUALITY["avif"], compression="av1"),
+    }
+    image = None
+    for size in sizes:
+        if image is None:
+            # Decode once, with shrink-on-load, at the largest size needed
+            image = pyvips.Image.thumbnail(
+                abspath, size, height=size, export_profile="srgb"
+            ).copy_memory()
+        else:
+            image = image.thumbnail_image(size, height=size).copy_memory()
+        for format, out_path in by_size[size].items():
+            image.write_to_file(out_path, strip=True, **save_options[format])
+    return sorted(sizes)
+
+def pillow(abspath, out_paths):
+    """Use Pillow, which is always available."""
+    with Image.open(abspath) as image:
+        return pillow_thumbnails(image, out_paths)
+
+def pillow_thumbnails(image, out_paths, orientation=None):
+    """Write thumbnails of the opened Pillow `image`, like a backend.
+
+    `orientation` is an EXIF orientation value to apply. If None, the
+    orientation in the image's own EXIF data is used.
+    """
+    by_size = _group_by_size(out_paths)
+    sizes = get_sizes(*image.size, by_size)
+
+    # Have JPEGs decoded at a reduced scale, which is much faster than
+    # decoding the full image and then shrinking it.
+    image.draft("RGB", (sizes[0], sizes[0]))
+
+    icc_profile = image.info.get("icc_profile")
+    if orientation is None:
+        image = ImageOps.exif_transpose(image)
+    elif orientation in ORIENTATION_TRANSPOSE:
+        image = image.transpose(ORIENTATION_TRANSPOSE[orientation])
+    converted = None
+    if icc_profile:
+        try:
+            converted = ImageCms.profileToProfile(
+                image,
+                ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)),
+                ImageCms.createProfile("sRGB"),
+                outputMode="RGB",
+            )
+        except ImageCms.PyCMSError:
+            # Broken profile, or one that doesn't match the image mode
+            pass
+    image = converted or image.convert("RGB")
+
+    save_options = {
+        "jpeg": dict(quality=QUALITY["jpeg"], optimize=True, progressive=True),
+        "webp": dict(quality=QUALITY["webp"]),
+        "avif": dict(quality=QUALITY["avif"]),
+    }
+    for size in sizes:
+        # Each size is shrunk from the previous, larger one
+        image.thumbnail((size, size), Image.LANCZOS)
+        for format, out_path in by_size[size].items():
+            # Metadata, such as EXIF and ICC profile, is left out unless passed
+            image.save(out_path, format.upper(), **save_options[format])
+    return sorted(sizes)
+
+# Image.transpose() methods which undo each EXIF orientation, like
+# ImageOps.exif_transpose() uses.
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+BACKENDS = {
+    "pyvips": pyvips,
+    "vipsthumbnail": vipsthumbnail,
+    "pillow": pillow,
+}
+
+def detect_backend():
+    """Return the name of the fastest backend available."""
+    try:
+        import pyvips  # noqa: F401
+        return "pyvips"
+    except (ImportError, OSError):
+        # OSError if the module is installed but libvips isn't
+        pass
+    if shutil.which("vipsthumbnail"):
+        return "vipsthumbnail"
+    return "pillow"
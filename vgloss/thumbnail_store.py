@@ -0,0 +1,445 @@
+"""Where generated thumbnails are kept.
+
+Each thumbnail has a key, `<hash>_<size>.<ext>`, which is also its file name
+when it's kept as a file of its own. Stores have the same methods:
+
+  * `get(key)`: the thumbnail's bytes, or None if there isn't one.
+  * `key in store`: whether there is one.
+  * `keys()`: a container of every key, for checking many at once.
+  * `put(key, path)`: store the thumbnail written to `path`, taking it over.
+  * `delete(key)`
+  * `compact(live=None)`: reclaim space, dropping thumbnails whose key isn't
+    in `live`.
+
+`LooseStore` keeps a file per thumbnail. `PackStore` appends them to a few
+large pack files instead, and finds them with a memory-mapped index, so
+serving one doesn't need any system calls. It still reads loose thumbnails,
+so a gallery can switch to it without regenerating anything. `compact()`
+moves them into packs.
+"""
+import os
+import mmap
+import fcntl
+import heapq
+import struct
+import threading
+
+from .thumbnail_backends import FORMATS
+
+# Pack files are started anew once they're this big
+PACK_SIZE = 2**30
+
+# The journal is merged into the index once it has this many records, or an
+# eighth as many as the index if that's more, so merging stays rare when the
+# index is big.
+JOURNAL_MERGE_MIN = 10000
+
+# Index file: a header followed by records sorted by key. The header has a
+# magic number, the number of the journal which goes with the index, the
+# number to give the next pack started, and the number of records.
+_MAGIC = b"VGLPACK2"
+_HEADER = struct.Struct(">8sIII")
+# Record: SHA-512 hash, size and format code make up the key, followed by the
+# pack number, offset and length of the thumbnail. A length of 0 in the
+# journal means the thumbnail was deleted.
+_RECORD = struct.Struct(">64sIB3xIQI")
+_KEY_SIZE = 69
+
+_FORMAT_CODES = {ext: i for i, (ext, content_type) in enumerate(FORMATS.values())}
+_EXTENSIONS = {i: ext for ext, i in _FORMAT_CODES.items()}
+
+
+def _encode_key(key):
+    """Return the binary form of `key` used in the index, or None if it isn't
+    the key of a thumbnail which can be packed."""
+    name, _, ext = key.rpartition(".")
+    hash, _, size = name.rpartition("_")
+    try:
+        binary = bytes.fromhex(hash) + struct.pack(">IB", int(size), _FORMAT_CODES[ext])
+    except (ValueError, KeyError, struct.error):
+        return None
+    return binary if len(binary) == _KEY_SIZE else None
+
+def _decode_key(binary):
+    size, code = struct.unpack_from(">IB", binary, 64)
+    return f"{binary[:64].hex()}_{size}.{_EXTENSIONS[code]}"
+
+
+class LooseStore:
+    """Keeps each thumbnail in its own file in `root`."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def _loose_keys(self):
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return set()
+        return {name for name in names
+                if name.rpartition(".")[2] in _FORMAT_CODES}
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def keys(self):
+        return self._loose_keys()
+
+    def put(self, key, path):
+        os.replace(path, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def compact(self, live=None):
+        if live is None:
+            return
+        for key in self._loose_keys():
+            if key not in live:
+                self.delete(key)
+
+
+class PackStore(LooseStore):
+    """Appends thumbnails to pack files in `root/packs`.
+
+    The index maps each key to a pack, offset and length. It's sorted, so
+    lookups are a binary search of the memory-mapped file. Thumbnails added
+    since the index was written are appended to a journal, which is also read
+    into memory, and merged into the index once it grows big enough.
+
+    Writers in any process take a lock on the directory. Readers notice
+    changes made by other processes when they look for a key that they don't
+    have.
+    """
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.pack_dir = os.path.join(root, "packs")
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._index_stat = None
+        self._index = None
+        self._index_count = 0
+        self._journal_number = 0
+        self._next_pack = 1
+        self._journal = None
+        self._journal_pos = 0
+        self._journal_records = {}
+        self._packs = {}  # Pack number -> mmap
+        self._append_pack = None
+
+    def _index_path(self):
+        return os.path.join(self.pack_dir, "index")
+
+    def _journal_path(self, number):
+        return os.path.join(self.pack_dir, f"journal-{number:06d}")
+
+    def _pack_path(self, number):
+        return os.path.join(self.pack_dir, f"pack-{number:06d}.pack")
+
+    def _pack_numbers(self):
+        try:
+            names = os.listdir(self.pack_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[5:11]) for name in names
+                      if name.startswith("pack-") and name.endswith(".pack"))
+
+    # Reading
+
+    def _refresh(self):
+        """Catch up with changes written since we last looked."""
+        try:
+            st = os.stat(self._index_path())
+            index_stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            index_stat = None
+        if index_stat != self._index_stat:
+            # New index written by a merge or compaction, or deleted
+            self._reset()
+            self._index_stat = index_stat
+            if index_stat is None:
+                return
+            with open(self._index_path(), "rb") as f:
+                self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self._journal_number, self._next_pack, self._index_count = \
+                _HEADER.unpack_from(self._index)
+            if magic != _MAGIC:
+                raise ValueError(f"Not a thumbnail pack index: {self._index_path()}")
+            try:
+                self._journal = open(self._journal_path(self._journal_number), "rb")
+            except FileNotFoundError:
+                return
+
+        if self._journal is not None:
+            self._journal.seek(self._journal_pos)
+            data = self._journal.read()
+            whole = len(data) - len(data) % _RECORD.size  # Skip partial writes
+            for i in range(0, whole, _RECORD.size):
+                self._journal_records[data[i:i+_KEY_SIZE]] = \
+                    _RECORD.unpack_from(data, i)[3:]
+            self._journal_pos += whole
+
+    def _lookup_index(self, binary):
+        lo, hi = 0, self._index_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = _HEADER.size + mid * _RECORD.size
+            found = self._index[start:start+_KEY_SIZE]
+            if found == binary:
+                return _RECORD.unpack_from(self._index, start)[3:]
+            elif found < binary:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _lookup(self, binary):
+        """Return `(pack, offset, length)` of a key, or None."""
+        location = self._journal_records.get(binary)
+        if location is None and self._index is not None:
+            location = self._lookup_index(binary)
+        if location is None:
+            return None
+        return location if location[2] else None
+
+    def _locate(self, key):
+        binary = _encode_key(key)
+        if binary is None:
+            return None
+        with self._lock:
+            location = self._lookup(binary)
+            if location is None:
+                self._refresh()
+                location = self._lookup(binary)
+        return location
+
+    def _view(self, pack, offset, length):
+        with self._lock:
+            mapped = self._packs.get(pack)
+            if mapped is None or len(mapped) < offset + length:
+                # Not mapped yet, or appended to since. The old map is left
+                # open for any views of it still in use.
+                with open(self._pack_path(pack), "rb") as f:
+                    mapped = self._packs[pack] = \
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped)[offset:offset+length]
+
+    def get(self, key):
+        """Return a memoryview of the thumbnail within its pack, or the
+        contents of a loose thumbnail."""
+        location = self._locate(key)
+        if location is None:
+            return super().get(key)
+        try:
+            return self._view(*location)
+        except FileNotFoundError:
+            # Pack removed by a compaction in another process
+            with self._lock:
+                self._refresh()
+            location = self._locate(key)
+            if location is None:
+                return super().get(key)
+            return self._view(*location)
+
+    def __contains__(self, key):
+        return self._locate(key) is not None or super().__contains__(key)
+
+    def keys(self):
+        return _PackKeys(self, self._loose_keys())
+
+    # Writing
+
+    def _locked(self):
+        os.makedirs(self.pack_dir, exist_ok=True)
+        return _DirectoryLock(os.path.join(self.pack_dir, "lock"), self._lock)
+
+    def _write_index(self, records, journal_number, next_pack=None):
+        """Replace the index with sorted `records`, starting `journal_number`
+        as the journal that goes with it. Packs started after it are numbered
+        from `next_pack`, or the same as before if it isn't given."""
+        if next_pack is None:
+            next_pack = self._next_pack
+        # Create the journal first, so readers of the new index find it
+        open(self._journal_path(journal_number), "ab").close()
+        tmp_path = self._index_path() + ".tmp"
+        count = 0
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, journal_number, next_pack, 0))
+            for record in records:
+                f.write(record)
+                count += 1
+            f.seek(0)
+            f.write(_HEADER.pack(_MAGIC, journal_number, next_pack, count))
+        os.replace(tmp_path, self._index_path())
+        old_journal = self._journal_number
+        self._refresh()
+        if old_journal and old_journal != journal_number:
+            try:
+                os.remove(self._journal_path(old_journal))
+            except FileNotFoundError:
+                pass
+
+    def _records(self):
+        """Yield every live record in key order, with journal records in
+        place of the index records they replace."""
+        def index_records():
+            for i in range(self._index_count):
+                start = _HEADER.size + i * _RECORD.size
+                yield self._index[start:start+_RECORD.size]
+        journal_records = [
+            _RECORD.pack(binary[:64], *struct.unpack(">IB", binary[64:]), *location)
+            for binary, location in sorted(self._journal_records.items())
+        ]
+        last = None
+        # Journal records come first among equal keys, so they win
+        for key, _, record in heapq.merge(
+            ((r[:_KEY_SIZE], 0, r) for r in journal_records),
+            ((r[:_KEY_SIZE], 1, r) for r in index_records()),
+        ):
+            if key == last:
+                continue
+            last = key
+            if _RECORD.unpack(record)[-1]:
+                yield record
+
+    def _append(self, binary, data):
+        if self._append_pack is None:
+            numbers = self._pack_numbers()
+            self._append_pack = numbers[-1] if numbers else self._next_pack
+        path = self._pack_path(self._append_pack)
+        with open(path, "ab") as f:
+            offset = f.tell()
+            if offset + len(data) > PACK_SIZE and offset:
+                self._append_pack += 1
+                return self._append(binary, data)
+            f.write(data)
+        return self._append_pack, offset, len(data)
+
+    def _write_journal(self, binary, location):
+        with open(self._journal_path(self._journal_number), "ab") as f:
+            f.write(_RECORD.pack(binary[:64], *struct.unpack(">IB", binary[64:]),
+                                 *location))
+        self._refresh()
+        if len(self._journal_records) > max(JOURNAL_MERGE_MIN, self._index_count // 8):
+            self._write_index(self._records(), self._journal_number + 1)
+
+    def _prepare(self):
+        self._refresh()
+        if self._index is None:
+            self._write_index([], 1)
+
+    def put(self, key, path):
+        binary = _encode_key(key)
+        if binary is None:
+            return super().put(key, path)
+        with open(path, "rb") as f:
+            data = f.read()
+        with self._locked():
+            self._prepare()
+            self._write_journal(binary, self._append(binary, data))
+        os.remove(path)
+        # Don't leave an outdated loose copy behind
+        super().delete(key)
+
+    def delete(self, key):
+        binary = _encode_key(key)
+        if binary is not None and self._locate(key) is not None:
+            with self._locked():
+                self._prepare()
+                self._write_journal(binary, (0, 0, 0))
+        super().delete(key)
+
+    def compact(self, live=None):
+        """Copy the thumbnails in `live`, or all of them, into new packs
+        without the space left by deleted ones. Loose thumbnails are moved
+        into the new packs too."""
+        with self._locked():
+            self._prepare()
+            loose = {key for key in self._loose_keys()
+                     if _encode_key(key) is not None}
+            sources = {}
+            for record in self._records():
+                binary = record[:_KEY_SIZE]
+                if live is None or _decode_key(binary) in live:
+                    sources[binary] = _RECORD.unpack(record)[3:]
+            # Packed thumbnails are the ones served, if both exist
+            for key in loose:
+                if live is None or key in live:
+                    sources.setdefault(_encode_key(key), key)
+
+            # Numbers are never reused, even once every pack is removed.
+            # Other processes may still have a removed pack mapped, and
+            # would read a new one's thumbnails from it.
+            old_packs = self._pack_numbers()
+            self._append_pack = max(old_packs[-1] + 1 if old_packs else 1,
+                                    self._next_pack)
+            records = []
+            for binary, source in sorted(sources.items()):
+                if isinstance(source, str):
+                    data = super().get(source)
+                else:
+                    data = self._view(*source)
+                location = self._append(binary, data)
+                records.append(_RECORD.pack(
+                    binary[:64], *struct.unpack(">IB", binary[64:]), *location
+                ))
+            self._write_index(records, self._journal_number + 1,
+                              self._append_pack + 1)
+
+            for number in old_packs:
+                os.remove(self._pack_path(number))
+        if live is not None:
+            super().compact(live)
+        for key in loose:
+            super().delete(key)
+
+
+class _PackKeys:
+    """Keys of a `PackStore`, with a listing of loose thumbnails taken once
+    instead of checking for each."""
+
+    def __init__(self, store, loose):
+        self.store = store
+        self.loose = loose
+
+    def __contains__(self, key):
+        return key in self.loose or self.store._locate(key) is not None
+
+
+class _DirectoryLock:
+    """Exclusive lock across threads and processes, held with `with`."""
+
+    def __init__(self, path, thread_lock):
+        self.path = path
+        self.thread_lock = thread_lock
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        self.file = open(self.path, "ab")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        self.file.close()  # Releases the lock
+        self.thread_lock.release()
+
+
+STORES = {
+    "pack": PackStore,
+    "loose": LooseStore,
+}
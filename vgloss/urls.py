@@ -24,9 +24,11 @@ urlpatterns = [
     path("api/action", api.Action.as_view(), name="api-action"),
     path("api/file/", api.FileListApi.as_view(), name="api-files"),
     path("api/file/<str:hash>", api.FileDetailApi.as_view(), name="api-file"),
+    path("api/folder/", api.FolderListApi.as_view(), name="api-folders"),
 
     # Files
-    path("file/<str:hash>/raw", views.FileThumbnail.as_view()),
+    path("file/thumbnails", views.FileThumbnails.as_view(), name="file-thumbs"),
+    path("file/<str:hash>/raw", views.File.as_view(), name="file-raw"),
     path("file/<str:hash>/thumbnail", views.FileThumbnail.as_view(), name="file-thumb"),
 
     # Static files
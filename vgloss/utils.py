@@ -0,0 +1,36 @@
+import os
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+def default_jobs():
+    return os.cpu_count() or 1
+
+def batched(iterable, size):
+    """Yield lists of up to `size` items from `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def imap_bounded(func, iterable, jobs=None):
+    """Like `map()`, but calls `func` in a pool of `jobs` threads.
+
+    Yields `(item, result)` tuples in the same order as `iterable`. At most
+    `2*jobs` items are in flight at once, so `iterable` can be an arbitrarily
+    long generator without everything being pulled into memory.
+    """
+    jobs = jobs or default_jobs()
+    pending = collections.deque()
+    with ThreadPoolExecutor(jobs) as executor:
+        for item in iterable:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= 2*jobs:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
@@ -1,27 +1,32 @@
-import os
+import json
+import queue
+import struct
+import asyncio
+import hashlib
+import functools
 import posixpath
-import mimetypes
-from functools import lru_cache
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.views.generic import View
-from django.http import HttpResponse, Http404
-from django.shortcuts import get_object_or_404, render
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
 
-from . import models, serializers
+from . import assets, models, serializers, thumbnail
+from .responses import (
+    BufferResponse, file_response, cache_headers, conditional_response
+)
+from .thumbnail_backends import FORMATS
 
 
-DIST_DIR = os.path.join(settings.VGLOSS_CODE_DIR, "dist")
+# Seconds to wait for a thumbnail generated on demand before giving up
+THUMBNAIL_TIMEOUT = 30
 
+# Most thumbnails sent in one response by `FileThumbnails`. Their hashes are
+# all in the URL, which many servers limit to 8KiB.
+MAX_BUNDLE_SIZE = 50
 
-def get_folders(path):
-    for entry in os.scandir(path):
-        if entry.name == ".vgloss":
-            continue
-        elif entry.is_dir() and not entry.is_symlink():
-            yield entry.name
-            for subfolder in get_folders(entry.path):
-                yield entry.name + "/" + subfolder
 
 def initial_pageload_data():
     """Return data needed on initial pageload."""
@@ -30,74 +35,247 @@ def initial_pageload_data():
         many=True,
     )
     return dict(
-        folders=list(get_folders(settings.BASE_DIR)),
+        folders=list(models.Folder.objects.exclude(path="").order_by("path")
+                     .values_list("path", flat=True)),
         tags=tag_serializer.data,
     )
 
-@lru_cache()
-def read_dist_file(path):
-    path = posixpath.normpath(path).lstrip("/")
-    abspath = os.path.abspath(os.path.join(DIST_DIR, path))
+class AsyncView(View):
+    """A class-based view whose handlers are coroutines.
 
-    if os.path.commonpath([abspath, DIST_DIR]) != DIST_DIR:
-        # abspath must be within DIST_DIR
-        return None, None, None
-    if not os.path.exists(abspath) or os.path.isdir(abspath):
-        return None, None, None
+    Django 3.1 only runs function views asynchronously, so `as_view()` wraps
+    the view in one. Under ASGI it runs on the event loop, where waiting
+    doesn't hold up a thread, and under WSGI Django runs it to completion.
+    Database queries have to go through `sync_to_async()`.
+    """
 
-    content_type, encoding = mimetypes.guess_type(abspath)
-    content_type = content_type or 'application/octet-stream'
-    is_bin = content_type.startswith("image/")
-    content = open(abspath, "rb" if is_bin else "r").read()
-    return content, content_type, encoding
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        async def async_view(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+        return functools.update_wrapper(async_view, view)
+
+def _get_file(hash):
+    return get_object_or_404(models.File, hash=hash)
 
 class DistFile(View):
+    """Serve a file of the built app from memory, see `vgloss.assets`."""
     fall_back_to_index = False
 
     def get(self, request, *args, **kwargs):
-        content, content_type, encoding = read_dist_file(request.path)
+        build = assets.get_build()
+        path = posixpath.normpath(request.path).lstrip("/")
+        asset = build.assets.get(path)
+        if asset is not None:
+            return asset.response(request)
 
         # Fallback to serving index.html
-        if self.fall_back_to_index and not content:
-            return render(
-                request,
-                "vgloss/vue-single-page.html",
-                context={
-                    "metadata": initial_pageload_data(),
-                },
-            )
-
-        #TODO: This view should do some things that django.views.static.serve
-        #      does. Namely:
-        #      * Respect HTTP_IF_MODIFIED_SINCE header
-        #      * Send Last-Modified header
-
-        response = HttpResponse(
-            content=content,
-            content_type=content_type,
-        )
-        if encoding:
-            response["Content-Encoding"] = encoding
-        return response
+        if self.fall_back_to_index:
+            return build.page_response(request, initial_pageload_data())
+        raise Http404()
 
 class VueSinglePage(DistFile):
     fall_back_to_index = True
 
 class File(View):
-    """Retrieve raw image from image hash."""
+    """Retrieve the original file of a hash, from any of its paths."""
 
     def get(self, request, hash):
+        # The content of a hash never changes, so a cached copy is always
+        # current, and there's no need to even look the file up.
+        not_modified = conditional_response(request, hash, immutable=True)
+        if not_modified:
+            return not_modified
         file = get_object_or_404(models.File, hash=hash)
-        with open(file.abspath, "rb") as f:
-            return HttpResponse(f.read(), f.mimetype)
+        for file_path in file.paths.order_by("path"):
+            try:
+                response = file_response(request, file_path.abspath, file.mimetype)
+            except FileNotFoundError:
+                # Removed since it was scanned
+                continue
+            return cache_headers(response, hash, immutable=True)
+        raise Http404()
 
-class FileThumbnail(View):
-    """Retrieve thumbnail for an image hash."""
+def choose_thumbnail(thumbnails, size, accept):
+    """Return `(size, format)` of the thumbnail to serve.
 
-    def get(self, request, hash):
-        file = get_object_or_404(models.File, hash=hash)
-        path = file.get_thumbnail_path()
-        if not path:
+    The size is the smallest at least as big as `size`, or the biggest if none
+    are. The format is the most compact one listed in the `accept` header, or
+    else the first one generated.
+    """
+    sizes = sorted(thumbnails["sizes"])
+    if size is None:
+        chosen_size = sizes[0]
+    else:
+        chosen_size = next((s for s in sizes if s >= size), sizes[-1])
+
+    chosen_format = thumbnails["formats"][0]
+    for format in ("avif", "webp", "jpeg"):
+        content_type = FORMATS[format][1]
+        if format in thumbnails["formats"] and content_type in accept:
+            chosen_format = format
+            break
+    return chosen_size, chosen_format
+
+def _stale_files(files):
+    return [file for file in files if thumbnail.needs_thumbnails(file)]
+
+def _read_thumbnails(keys):
+    store = thumbnail.get_store()
+    return [store.get(key) for key in keys]
+
+# The thumbnail store reads the disk, and may wait on a lock held by the
+# scheduler, so it's used from a thread pool rather than the event loop.
+stale_files = sync_to_async(_stale_files, thread_sensitive=False)
+read_thumbnails = sync_to_async(_read_thumbnails, thread_sensitive=False)
+
+class FileThumbnail(AsyncView):
+    """Retrieve thumbnail for an image hash.
+
+    The `size` query parameter picks the nearest size generated, in pixels.
+    The format is chosen using the Accept header. Thumbnails which haven't
+    been generated yet are generated on demand, as are sizes bigger than the
+    preview they were made from, the first time they're requested.
+    """
+
+    async def get(self, request, hash):
+        try:
+            size = int(request.GET["size"])
+        except (KeyError, ValueError):
+            size = None
+
+        file = await sync_to_async(_get_file, thread_sensitive=True)(hash)
+        if await stale_files([file]):
+            try:
+                thumbnails = await thumbnail.scheduler.generate(file, THUMBNAIL_TIMEOUT)
+            except (queue.Full, asyncio.TimeoutError):
+                response = HttpResponse("Thumbnail is being generated",
+                                        status=503, content_type="text/plain")
+                response["Retry-After"] = "5"
+                return response
+            if thumbnails is not None:
+                file.thumbnails = thumbnails
+        if thumbnail.needs_bigger_thumbnails(file, size):
+            try:
+                thumbnails = await thumbnail.scheduler.generate(
+                    file, THUMBNAIL_TIMEOUT, bigger=True
+                )
+            except (queue.Full, asyncio.TimeoutError):
+                # The biggest there is will do until they're made
+                thumbnails = None
+            if thumbnails is not None:
+                file.thumbnails = thumbnails
+        thumbnails = file.thumbnails
+        if not thumbnails["sizes"]:
             raise Http404()
-        with open(path, "rb") as f:
-            return HttpResponse(f.read(), "image/jpeg")
+
+        accept = request.META.get("HTTP_ACCEPT", "")
+        thumb_size, format = choose_thumbnail(thumbnails, size, accept)
+        # Until every size is generated, a nearer one may be served at this
+        # URL later, so it can only be cached for good if it's the one which
+        # would be chosen then.
+        immutable = (thumb_size, format) == choose_thumbnail({
+            "sizes": settings.THUMBNAIL_SIZES,
+            "formats": settings.THUMBNAIL_FORMATS,
+        }, size, accept)
+        key = file.get_thumbnail_key(thumb_size, format)
+        # Thumbnails of a hash only change if they're regenerated differently
+        etag = f"{key}-{file.thumbnail_version}"
+        not_modified = conditional_response(request, etag, immutable=immutable)
+        if not_modified:
+            patch_vary_headers(not_modified, ["Accept"])
+            return not_modified
+
+        content, = await read_thumbnails([key])
+        if content is None:
+            raise Http404()
+        response = BufferResponse([content], FORMATS[format][1])
+        patch_vary_headers(response, ["Accept"])
+        return cache_headers(response, etag, immutable=immutable)
+
+class FileThumbnails(AsyncView):
+    """Retrieve the thumbnails of many image hashes in one response.
+
+    Takes comma-separated "hashes" as a parameter, and optionally the "size"
+    and "accept" which `FileThumbnail` takes as its parameter and header.
+    Responds with a bundle: a 4-byte big-endian length, then a JSON list of
+    that length with `{hash, type, offset, length}` for each hash, in order,
+    then the thumbnails themselves at those offsets. Hashes without a
+    thumbnail have `{hash, error}` instead, and can be requested from
+    `FileThumbnail`.
+
+    A page of the gallery asks for the same bundles each time it's shown, so
+    they're cached, and checked with an ETag of the thumbnails in them.
+    """
+
+    async def get(self, request):
+        try:
+            hashes = request.GET["hashes"].split(",")[:MAX_BUNDLE_SIZE]
+            size = int(request.GET["size"]) if "size" in request.GET else None
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest("Expected a list of hashes")
+        accept = request.GET.get("accept", request.META.get("HTTP_ACCEPT", ""))
+
+        files = {
+            file.hash: file for file in await sync_to_async(list, thread_sensitive=True)(
+                models.File.objects.filter(hash__in=hashes).only(
+                    "hash", "mimetype", "thumbnail_version", "thumbnails_json",
+                    "metadata_json",
+                )
+            )
+        }
+        stale = await stale_files(files.values())
+        if stale:
+            generated = await thumbnail.scheduler.generate_many(stale, THUMBNAIL_TIMEOUT)
+            for hash, thumbnails in generated.items():
+                if thumbnails is not None:
+                    files[hash].thumbnails = thumbnails
+
+        # `(hash, format, key)` of the thumbnail chosen for each hash
+        chosen = []
+        for hash in hashes:
+            file = files.get(hash)
+            thumbnails = file.thumbnails if file else None
+            if not thumbnails or not thumbnails["sizes"]:
+                chosen.append((hash, None, None))
+                continue
+            thumb_size, format = choose_thumbnail(thumbnails, size, accept)
+            chosen.append((hash, format, file.get_thumbnail_key(thumb_size, format)))
+
+        # Like `FileThumbnail`'s ETag, for every thumbnail in the bundle
+        etag = hashlib.sha1(" ".join(
+            f"{key}-{files[hash].thumbnail_version}" if key else hash
+            for hash, _, key in chosen
+        ).encode()).hexdigest()
+        not_modified = conditional_response(request, etag)
+        if not_modified:
+            patch_vary_headers(not_modified, ["Accept"])
+            return not_modified
+
+        read = iter(await read_thumbnails([key for _, _, key in chosen if key]))
+
+        index = []
+        contents = []
+        offset = 0
+        for hash, format, key in chosen:
+            content = next(read) if key else None
+            if content is None:
+                index.append({"hash": hash, "error": 404})
+                continue
+            index.append({"hash": hash, "type": FORMATS[format][1],
+                          "offset": offset, "length": len(content)})
+            contents.append(content)
+            offset += len(content)
+
+        index = json.dumps(index).encode()
+        response = BufferResponse(
+            [struct.pack(">I", len(index)), index, *contents],
+            content_type="application/octet-stream",
+        )
+        patch_vary_headers(response, ["Accept"])
+        return cache_headers(response, etag)
@@ -0,0 +1,84 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import default_jobs
+
+
+def _list_dir(path, exclude):
+    """Return sorted `(name, abspath, stat)` tuples for entries in `path`.
+
+    `stat` is None for directories. Directories in `exclude` and symlinks to
+    directories are left out, like `os.walk()` does without following links.
+    """
+    entries = []
+    try:
+        scandir_it = os.scandir(path)
+    except OSError:
+        return entries
+    with scandir_it:
+        for entry in scandir_it:
+            try:
+                if entry.is_dir():
+                    if entry.is_symlink() or entry.path in exclude:
+                        continue
+                    entries.append((entry.name + "/", entry.path, None))
+                else:
+                    # DirEntry caches its stat result, and on most platforms
+                    # this is the only stat call made for the file.
+                    entries.append((entry.name, entry.path, entry.stat()))
+            except OSError:
+                # Race condition if file gets deleted, or a broken symlink.
+                # Act like we never saw it in the first place.
+                continue
+
+    # Directories are sorted with a trailing slash so that walking in this
+    # order yields relative paths in sorted order.
+    entries.sort(key=lambda e: e[0])
+    return entries
+
+def _before_start(relpath, is_dir, start):
+    """Are `relpath`, and everything under it if it's a directory, < `start`?"""
+    if start is None or relpath >= start:
+        return False
+    return not (is_dir and start.startswith(relpath))
+
+def walk(root, exclude=(), jobs=None, start=None, dirs=False):
+    """Yield `(relpath, abspath, stat)` for every file under `root`.
+
+    Paths are yielded in sorted order of `relpath`. Directories are listed
+    (and their files stat'd) in a pool of `jobs` threads, with subdirectories
+    being listed ahead of the one currently being yielded. This matters most
+    for network mounts, where each listing has high latency.
+
+    Directories whose absolute path is in `exclude` are not descended into. If
+    `start` is given, only paths >= `start` are yielded, and directories which
+    only contain paths before it aren't listed.
+
+    If `dirs` is true, directories are yielded too, with a `stat` of None,
+    just before the files in them. These don't follow the sorted order.
+    """
+    root = os.path.abspath(root)
+    exclude = set(os.path.abspath(path) for path in exclude)
+    with ThreadPoolExecutor(jobs or default_jobs()) as executor:
+
+        def walk_dir(listing_future, prefix):
+            entries = [
+                (prefix+name, abspath, stat)
+                for name, abspath, stat in listing_future.result()
+                if not _before_start(prefix+name, stat is None, start)
+            ]
+            # Start listing subdirectories before descending into any of them
+            subdir_futures = {
+                abspath: executor.submit(_list_dir, abspath, exclude)
+                for relpath, abspath, stat in entries
+                if stat is None
+            }
+            for relpath, abspath, stat in entries:
+                if stat is None:
+                    if dirs:
+                        yield relpath[:-1], abspath, None
+                    yield from walk_dir(subdir_futures.pop(abspath), relpath)
+                else:
+                    yield relpath, abspath, stat
+
+        yield from walk_dir(executor.submit(_list_dir, root, exclude), "")
@@ -0,0 +1,173 @@
+import os
+import sys
+import time
+import errno
+import traceback
+
+from django.conf import settings
+
+from inotify_simple import INotify, flags
+
+from . import models, scan, thumbnail
+from .utils import batched
+
+# Changes are processed once no events have arrived for this many seconds...
+DEBOUNCE_SECONDS = 0.3
+# ...or once the oldest change has waited this long, so a folder which is
+# constantly being written to still gets scanned.
+MAX_DELAY_SECONDS = 5
+# A full scan is run this often to catch anything inotify missed.
+RECONCILE_SECONDS = 60 * 60
+# Changes which fail to be scanned, like when the database is locked, are
+# tried again after this many seconds.
+RETRY_SECONDS = 5
+
+WATCH_FLAGS = (
+    flags.CREATE | flags.CLOSE_WRITE | flags.ATTRIB | flags.DELETE |
+    flags.MOVED_FROM | flags.MOVED_TO | flags.ONLYDIR | flags.DONT_FOLLOW
+)
+
+
+class Watcher:
+    """Keeps the database up to date by watching `BASE_DIR` with inotify.
+
+    Paths named in events are collected until things quiet down, then only
+    those paths are scanned and thumbnailed. A full scan is run at startup and
+    every `reconcile_interval` seconds, in case events were missed.
+    """
+
+    def __init__(self, jobs=None, debounce=DEBOUNCE_SECONDS,
+                 reconcile_interval=RECONCILE_SECONDS):
+        self.jobs = jobs
+        self.debounce = debounce
+        self.reconcile_interval = reconcile_interval
+
+        self.inotify = INotify()
+        self.watches = {}  # Watch descriptor -> relative path of folder
+        self.pending = set()
+        self.first_event_time = None
+        self.last_event_time = None
+        self.retry_time = None
+        self.last_reconcile_time = None
+        self.needs_reconcile = True
+
+    def add_watches(self, relpath):
+        """Watch the folder `relpath` and every folder inside of it."""
+        for cwd, dirs, files in os.walk(os.path.join(settings.BASE_DIR, relpath)):
+            dirs[:] = [
+                d for d in dirs
+                if os.path.join(cwd, d) != settings.DATA_DIR
+            ]
+            try:
+                wd = self.inotify.add_watch(cwd, WATCH_FLAGS)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    print("Too many folders to watch. Increase "
+                          "fs.inotify.max_user_watches. Changes will only be "
+                          "picked up by periodic full scans.", file=sys.stderr)
+                    return
+                # Folder disappeared before we could watch it
+                continue
+            folder = os.path.relpath(cwd, settings.BASE_DIR)
+            self.watches[wd] = "" if folder == "." else folder
+
+    def read_events(self, timeout=None):
+        """Wait up to `timeout` seconds for events and record changed paths."""
+        events = self.inotify.read(
+            timeout=None if timeout is None else int(timeout * 1000)
+        )
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                self.needs_reconcile = True
+                continue
+            if event.mask & flags.IGNORED:
+                self.watches.pop(event.wd, None)
+                continue
+            folder = self.watches.get(event.wd)
+            if folder is None:
+                continue
+            relpath = folder + "/" + event.name if folder else event.name
+            if os.path.join(settings.BASE_DIR, relpath) == settings.DATA_DIR:
+                continue
+
+            if event.mask & flags.ISDIR and event.mask & (flags.CREATE | flags.MOVED_TO):
+                # Anything created in the folder before the watch was added is
+                # picked up since the whole folder is scanned.
+                self.add_watches(relpath)
+            self.pending.add(relpath)
+
+            now = time.monotonic()
+            self.last_event_time = now
+            if self.first_event_time is None:
+                self.first_event_time = now
+
+    def get_timeout(self):
+        """Seconds until `run()` has something to do, or None to wait forever."""
+        now = time.monotonic()
+        deadlines = []
+        if self.reconcile_interval:
+            deadlines.append(self.last_reconcile_time + self.reconcile_interval)
+        if self.pending:
+            deadlines.append(max(self.retry_time or 0, min(
+                self.last_event_time + self.debounce,
+                self.first_event_time + MAX_DELAY_SECONDS,
+            )))
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - now)
+
+    def is_pending_ready(self):
+        now = time.monotonic()
+        if self.retry_time is not None and now < self.retry_time:
+            return False
+        return self.pending and (
+            now - self.last_event_time >= self.debounce or
+            now - self.first_event_time >= MAX_DELAY_SECONDS
+        )
+
+    def process_pending(self):
+        """Scan and thumbnail the paths that changed.
+
+        If that fails, they're left pending, and tried again after
+        `RETRY_SECONDS`.
+        """
+        paths = sorted(self.pending)
+        start = time.monotonic()
+        try:
+            hashes = scan.scan_paths(paths, self.jobs)
+            for batch in batched(hashes, scan.SCAN_BATCH_SIZE):
+                thumbnail.generate_thumbnails(
+                    models.File.objects.filter(hash__in=batch), self.jobs
+                )
+        except Exception:
+            self.retry_time = time.monotonic() + RETRY_SECONDS
+            raise
+        self.pending.clear()
+        self.first_event_time = self.last_event_time = self.retry_time = None
+        print(f"Scanned {len(paths)} changed paths in "
+              f"{time.monotonic() - start:.2f}s", file=sys.stderr)
+
+    def reconcile(self):
+        """Run a full scan."""
+        self.pending.clear()
+        self.first_event_time = self.last_event_time = self.retry_time = None
+        self.needs_reconcile = False
+        self.last_reconcile_time = time.monotonic()
+
+        scan.scan_all(self.jobs)
+        thumbnail.generate_all_thumbnails(self.jobs)
+
+    def run(self):
+        # Watch before the first scan, so nothing changes unnoticed in between
+        self.add_watches("")
+        while True:
+            try:
+                if self.needs_reconcile or (
+                        self.reconcile_interval and
+                        time.monotonic() - self.last_reconcile_time >= self.reconcile_interval):
+                    self.reconcile()
+                elif self.is_pending_ready():
+                    self.process_pending()
+            except Exception:
+                traceback.print_exc()
+            self.read_events(self.get_timeout())